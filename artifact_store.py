@@ -0,0 +1,72 @@
+import os
+import re
+import threading
+import time
+import uuid
+
+from metrics import log
+
+# Optional local copies of generated images (off by default; images go straight to storage)
+ARTIFACT_STORE_ENABLED = os.getenv("ARTIFACT_STORE_ENABLED", "").lower() in ("1", "true", "yes")
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", os.path.join(os.path.dirname(__file__), "static", "generated"))
+ARTIFACT_STORE_MAX_BYTES = int(os.getenv("ARTIFACT_STORE_MAX_BYTES", str(200 * 1024 * 1024)))
+# Local copies older than this are removed by sweep() (0 = size limit only)
+ARTIFACT_STORE_MAX_AGE_SECONDS = int(os.getenv("ARTIFACT_STORE_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+
+# Files written by save_artifact; sweep() never touches anything else in ARTIFACT_DIR
+ARTIFACT_NAME_PATTERN = re.compile(r"^thumb_\d+_[0-9a-f]{8}\.\w+$")
+
+_lock = threading.Lock()
+
+
+def save_artifact(data, suffix=".png", force=False):
+    """
+    Writes `data` to a uniquely named file in ARTIFACT_DIR and trims the directory
+    back under ARTIFACT_STORE_MAX_BYTES (oldest files first).
+    Returns the path, or None when the store is disabled and `force` is not set.
+    """
+    if not (ARTIFACT_STORE_ENABLED or force):
+        return None
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    filename = f"thumb_{int(time.time())}_{uuid.uuid4().hex[:8]}{suffix}"
+    path = os.path.join(ARTIFACT_DIR, filename)
+    with open(path, "wb") as f:
+        f.write(data)
+    log(f"Image saved locally to: {path}")
+    sweep(keep=path)
+    return path
+
+
+def sweep(keep=None, max_bytes=ARTIFACT_STORE_MAX_BYTES, max_age=ARTIFACT_STORE_MAX_AGE_SECONDS):
+    """
+    Removes stored files older than `max_age` seconds, then the oldest until
+    the store's files in ARTIFACT_DIR are back under `max_bytes`. Files the
+    store didn't write are left alone. Returns the removed paths.
+    """
+    removed = []
+    if not os.path.isdir(ARTIFACT_DIR):
+        return removed
+    cutoff = time.time() - max_age if max_age else None
+    with _lock:
+        entries = []
+        total = 0
+        for entry in os.scandir(ARTIFACT_DIR):
+            if not entry.is_file() or not ARTIFACT_NAME_PATTERN.match(entry.name):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            expired = cutoff is not None and mtime < cutoff
+            if not expired and total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                removed.append(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+    return removed
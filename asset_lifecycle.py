@@ -0,0 +1,133 @@
+import hashlib
+import os
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import artifact_store
+from database import (record_assets, get_recent_assets, update_asset_urls, get_expired_assets, mark_assets_deleted,
+                      clear_asset_local_paths)
+from storage_backends import BACKENDS
+from metrics import log, Counter
+
+# Uploaded objects older than this are deleted from the storage backends
+ASSET_RETENTION_DAYS = float(os.getenv("ASSET_RETENTION_DAYS", "30"))
+ASSET_SWEEP_INTERVAL = float(os.getenv("ASSET_SWEEP_INTERVAL", "3600"))
+# Expired assets handled per sweep
+ASSET_SWEEP_BATCH = int(os.getenv("ASSET_SWEEP_BATCH", "1000"))
+# Images shown by the 履歴 command (a reply carries the text plus up to 4 images)
+HISTORY_IMAGES = 4
+# URLs expiring sooner than this are re-signed before being sent again
+URL_REFRESH_MARGIN_SECONDS = 300
+
+ASSETS_DELETED = Counter("thumbnail_assets_deleted_total", "Local copies and remote objects removed by the sweep",
+                         ["where"])
+ASSET_URLS_RESIGNED = Counter("thumbnail_asset_urls_resigned_total", "Expired asset URLs signed again for 履歴")
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def record_delivery(user_id, prompt, images):
+    """
+    Records the uploaded objects behind `images` (upload_renditions results)
+    as delivered to `user_id`. Images from before asset tracking are skipped.
+    """
+    rows = []
+    for image in images:
+        image_id = uuid.uuid4().hex
+        for rendition, asset in (image.get("assets") or {}).items():
+            expires_at = asset["expires_at"]
+            rows.append({
+                "image_id": image_id,
+                "rendition": rendition,
+                "line_user_id": user_id,
+                "prompt_hash": prompt_hash(prompt),
+                "local_path": asset.get("local_path"),
+                "backend": asset["backend"],
+                "object_name": asset["name"],
+                "url": asset["url"],
+                "url_expires_at": datetime.fromtimestamp(expires_at) if expires_at else None,
+                "bytes": asset["bytes"],
+            })
+    if rows:
+        record_assets(rows)
+
+
+def history(user_id, images=HISTORY_IMAGES):
+    """
+    The user's most recent images still in storage, newest first, as
+    {"original": url, "preview": url}. Expired signed URLs are re-signed;
+    images whose URL can't be renewed are left out.
+    """
+    by_image = OrderedDict()
+    for row in get_recent_assets(user_id, images):
+        by_image.setdefault(row["image_id"], {})[row["rendition"]] = row
+
+    refresh_before = datetime.now() + timedelta(seconds=URL_REFRESH_MARGIN_SECONDS)
+    results, updates = [], []
+    for renditions in by_image.values():
+        urls = {}
+        for rendition in ("original", "preview"):
+            row = renditions.get(rendition)
+            url = row and _current_url(row, refresh_before, updates)
+            if not url:
+                break
+            urls[rendition] = url
+        else:
+            results.append(urls)
+    if updates:
+        update_asset_urls(updates)
+        ASSET_URLS_RESIGNED.inc(len(updates))
+    return results
+
+
+def _current_url(row, refresh_before, updates):
+    expires_at = row["url_expires_at"]
+    if expires_at is None or datetime.fromisoformat(str(expires_at)) > refresh_before:
+        return row["url"]
+    backend = BACKENDS.get(row["backend"])
+    try:
+        signed = backend().sign_url(row["object_name"]) if backend else None
+    except Exception as e:
+        log(f"Could not re-sign {row['backend']}/{row['object_name']}: {e}")
+        signed = None
+    if not signed:
+        return None
+    url, expires_at = signed
+    updates.append((row["id"], url, datetime.fromtimestamp(expires_at)))
+    return url
+
+
+def sweep():
+    """
+    Evicts local copies past the artifact store's size / age limits and
+    deletes remote objects older than ASSET_RETENTION_DAYS, batched per
+    backend. Returns (local files removed, remote objects deleted).
+    """
+    removed = artifact_store.sweep() if artifact_store.ARTIFACT_STORE_ENABLED else []
+    if removed:
+        clear_asset_local_paths(removed)
+        ASSETS_DELETED.inc(len(removed), where="local")
+
+    deletable = [name for name, backend in BACKENDS.items() if backend.deletable]
+    cutoff = datetime.now() - timedelta(days=ASSET_RETENTION_DAYS)
+    by_backend = {}
+    for row in get_expired_assets(cutoff, deletable, ASSET_SWEEP_BATCH):
+        by_backend.setdefault(row["backend"], set()).add(row["object_name"])
+
+    gone = []
+    for name, object_names in by_backend.items():
+        try:
+            deleted = BACKENDS[name]().delete_many(sorted(object_names))
+        except Exception as e:
+            log(f"Deleting expired {name} objects failed: {e}")
+            continue
+        gone.extend((name, object_name) for object_name in deleted)
+    if gone:
+        mark_assets_deleted(gone)
+        ASSETS_DELETED.inc(len(gone), where="remote")
+    if removed or gone:
+        log(f"Asset sweep: {len(removed)} local copies and {len(gone)} remote objects removed")
+    return len(removed), len(gone)
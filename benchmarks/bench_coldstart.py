@@ -0,0 +1,150 @@
+"""
+Cold-start cost of the web app, as a serverless platform sees it.
+
+1. Import time: runs `python -X importtime -c "import main"` in fresh
+   processes and reports the total plus the slowest top-level imports.
+2. Time to first response: starts uvicorn with main:app in a fresh process
+   and times process start -> first response for a signed Stripe webhook and
+   a signed LINE follow event (answered by a local fake LINE API).
+
+Fails (exit 1) if the median import time exceeds --max-import-ms, so it can
+guard against cold-start regressions in CI.
+
+Usage: python benchmarks/bench_coldstart.py [--runs 5] [--max-import-ms 0]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from fakes import FakeLine
+from loadtest import LINE_CHANNEL_SECRET, STRIPE_WEBHOOK_SECRET, line_event, checkout_event, line_signature, stripe_signature
+
+
+def app_env(workdir, line_url):
+    env = dict(os.environ)
+    env.update({
+        "DB_PATH": os.path.join(workdir, "bot.db"),
+        "LINE_CHANNEL_SECRET": LINE_CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "coldstart-token",
+        "LINE_API_ENDPOINT": line_url,
+        "GOOGLE_API": "coldstart-key",
+        "GOOGLE_CLOUD_PROJECT": "coldstart",
+        "STRIPE_API_KEY": "sk_test_coldstart",
+        "STRIPE_WEBHOOK_SECRET": STRIPE_WEBHOOK_SECRET,
+    })
+    env.pop("GOOGLE_APPLICATION_CREDENTIALS_JSON", None)
+    return env
+
+
+def import_times(env):
+    """
+    (total_us, {top-level module: cumulative_us}) for one `import main`.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=ROOT, env=env, capture_output=True, text=True)
+    modules = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        # Two leading spaces = imported directly by main
+        depth = (len(name) - len(name.lstrip())) // 2
+        if name.strip() == "main":
+            total = int(cumulative)
+        elif depth == 1:
+            modules[name.strip()] = int(cumulative)
+    return total, modules
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def first_response(env, route, body, headers):
+    """
+    Seconds from spawning uvicorn to the first response on `route`.
+    """
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-W", "ignore", "-m", "uvicorn", "main:app",
+                                "--port", str(port), "--log-level", "warning"],
+                               cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            request = urllib.request.Request(f"http://127.0.0.1:{port}{route}", data=body, method="POST",
+                                             headers={"Content-Type": "application/json", **headers})
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    response.read()
+                return time.perf_counter() - start
+            except urllib.error.HTTPError as e:
+                raise RuntimeError(f"{route} returned {e.code}")
+            except (urllib.error.URLError, ConnectionError):
+                if process.poll() is not None:
+                    raise RuntimeError("uvicorn exited")
+                time.sleep(0.005)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest top-level imports to show")
+    parser.add_argument("--max-import-ms", type=float, default=0, help="fail above this median (0 = no limit)")
+    args = parser.parse_args()
+
+    with FakeLine() as line:
+        workdir = tempfile.mkdtemp(prefix="coldstart-")
+        env = app_env(workdir, line.url)
+
+        totals, per_module = [], {}
+        for _ in range(args.runs):
+            total, modules = import_times(env)
+            totals.append(total / 1000)
+            for name, value in modules.items():
+                per_module.setdefault(name, []).append(value / 1000)
+        median_import = statistics.median(totals)
+        print(f"import main: median {median_import:.0f}ms, min {min(totals):.0f}ms, max {max(totals):.0f}ms "
+              f"({args.runs} runs)")
+        slowest = sorted(per_module.items(), key=lambda item: -statistics.median(item[1]))[:args.top]
+        for name, values in slowest:
+            print(f"  {name:>24}: {statistics.median(values):.0f}ms")
+
+        print("time to first response (process start -> response):")
+        for route, make in (("/stripe_webhook", lambda: json.dumps(checkout_event("Ucoldstart")).encode()),
+                            ("/callback", lambda: json.dumps({"destination": "Ucoldstart",
+                                                               "events": [line_event("Ucoldstart", "follow")]}).encode())):
+            latencies = []
+            for _ in range(args.runs):
+                body = make()
+                headers = ({"Stripe-Signature": stripe_signature(body)} if route == "/stripe_webhook"
+                           else {"X-Line-Signature": line_signature(body)})
+                latencies.append(first_response(env, route, body, headers))
+            print(f"  POST {route:>15}: median {statistics.median(latencies) * 1000:.0f}ms, "
+                  f"max {max(latencies) * 1000:.0f}ms")
+
+    if args.max_import_ms and median_import > args.max_import_ms:
+        print(f"import time {median_import:.0f}ms exceeds {args.max_import_ms:.0f}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Microbenchmark for the SQLite access layer.
+
+Runs the "はい" confirmation sequence from N concurrent threads against a
+scratch database and reports confirmations/sec for:
+
+  before: a fresh sqlite3.connect() per call, rollback journal, and the
+          original five round trips (get_user, get_pending_prompt, decrement,
+          get_user, clear_pending_prompt)
+  after:  database.py's per-thread WAL connections and the combined
+          get_or_create_user + decrement_credit ... RETURNING
+
+Usage: python benchmarks/bench_db.py [--threads 8] [--ops 500]
+"""
+import argparse
+import contextlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+
+def legacy_confirmation(db_path, user_id):
+    def connect():
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get_user():
+        conn = connect()
+        row = conn.execute("SELECT * FROM users WHERE line_user_id = ?", (user_id,)).fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def write(sql, params):
+        conn = connect()
+        conn.execute(sql, params)
+        conn.commit()
+        conn.close()
+
+    get_user()
+    get_user()  # get_pending_prompt went through get_user again
+    write("UPDATE users SET credits = credits - 1, is_free_trial_used = 1, pending_prompt = NULL WHERE line_user_id = ?", (user_id,))
+    get_user()
+    write("UPDATE users SET pending_prompt = ? WHERE line_user_id = ?", (None, user_id))
+
+
+def pooled_confirmation(db_path, user_id):
+    database.get_or_create_user(user_id)
+    database.decrement_credit(user_id)
+
+
+def seed(db_path, users):
+    conn = sqlite3.connect(db_path)
+    conn.execute("""CREATE TABLE users (
+        line_user_id TEXT PRIMARY KEY,
+        credits INTEGER DEFAULT 1,
+        is_free_trial_used BOOLEAN DEFAULT 0,
+        pending_prompt TEXT,
+        created_at DATETIME
+    )""")
+    conn.executemany("INSERT INTO users VALUES (?, ?, 0, 'prompt', ?)",
+                     [(u, 1_000_000, datetime.now()) for u in users])
+    conn.commit()
+    conn.close()
+
+
+def run(label, confirmation, threads, ops, pooled):
+    tmpdir = tempfile.mkdtemp()
+    db_path = os.path.join(tmpdir, "bench.db")
+    users = [f"U{i:04d}" for i in range(threads)]
+    seed(db_path, users)
+    if pooled:
+        database.DB_PATH = db_path
+    errors = []
+
+    def worker(user_id):
+        try:
+            for _ in range(ops):
+                confirmation(db_path, user_id)
+        except sqlite3.OperationalError as e:
+            errors.append(e)
+        finally:
+            database.close_connection()
+
+    workers = [threading.Thread(target=worker, args=(u,)) for u in users]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    total = threads * ops
+    return (f"{label:>7}: {total} confirmations in {elapsed:.2f}s = {total / elapsed:,.0f} ops/sec"
+            f" ({len(errors)} lock errors)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{args.threads} concurrent writers x {args.ops} confirmations each")
+    for label, fn, pooled in (("before", legacy_confirmation, False), ("after", pooled_confirmation, True)):
+        # The per-call prints in database.py would dominate the timing
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            line = run(label, fn, args.threads, args.ops, pooled)
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Upload latency against a local fake GCS endpoint.
+
+Compares the old per-upload pattern (new storage.Client + get_bucket for
+every image) with a long-lived GCSUploader, sequentially and with
+upload_many, and prints per-upload latency percentiles.
+
+Usage: python benchmarks/bench_gcs.py [--uploads 40] [--size-kb 2048] [--latency 0.02] [--uniform-access]
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakes import FakeGCS
+from stats import summarize
+
+
+def signing_credentials(token_uri):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from google.oauth2 import service_account
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode()
+    return service_account.Credentials.from_service_account_info({
+        "type": "service_account",
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "private_key": pem,
+        "token_uri": token_uri,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uploads", type=int, default=40)
+    parser.add_argument("--size-kb", type=int, default=2048)
+    parser.add_argument("--latency", type=float, default=0.02, help="fake server latency per request (s)")
+    parser.add_argument("--uniform-access", action="store_true", help="reject ACLs, forcing signed URLs")
+    args = parser.parse_args()
+
+    with FakeGCS(latency=args.latency, uniform_access=args.uniform_access) as fake:
+        os.environ["STORAGE_EMULATOR_HOST"] = fake.url
+        from google.cloud import storage
+        import gcs_utils
+
+        data = os.urandom(args.size_kb * 1024)
+        quiet = open(os.devnull, "w")
+
+        # Signed URLs need a private key; the emulator's anonymous credentials have none
+        credentials = signing_credentials(fake.url + "/token") if args.uniform_access else None
+
+        def fresh_uploader():
+            client = storage.Client(project="bench", credentials=credentials)
+            return gcs_utils.GCSUploader("bench-thumbnails", client=client)
+
+        results = {}
+        with contextlib.redirect_stdout(quiet):
+            latencies = []
+            for _ in range(args.uploads):
+                start = time.perf_counter()
+                fresh_uploader().upload_bytes(data)
+                latencies.append(time.perf_counter() - start)
+            results["fresh client per upload"] = (latencies, sum(latencies))
+
+            uploader = fresh_uploader()
+            latencies = []
+            for _ in range(args.uploads):
+                start = time.perf_counter()
+                uploader.upload_bytes(data)
+                latencies.append(time.perf_counter() - start)
+            results["shared uploader"] = (latencies, sum(latencies))
+
+            uploader = fresh_uploader()
+            latencies = []
+            original = uploader.upload_bytes
+
+            def timed(*a, **kw):
+                start = time.perf_counter()
+                try:
+                    return original(*a, **kw)
+                finally:
+                    latencies.append(time.perf_counter() - start)
+
+            uploader.upload_bytes = timed
+            start = time.perf_counter()
+            urls = uploader.upload_many([data] * args.uploads)
+            wall = time.perf_counter() - start
+            results[f"upload_many x{uploader.concurrency}"] = (latencies, wall)
+
+        print(f"{args.uploads} uploads of {args.size_kb} KB, fake latency {args.latency * 1000:.0f} ms/request, "
+              f"{fake.requests} requests served, {sum(1 for u in urls if u)} upload_many successes")
+        for label, (latencies, wall) in results.items():
+            print(f"{label:>26}: {summarize(latencies)}  wall {wall:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Burst of generations against a local fake Gemini that returns 429s.
+
+Compares the bare genai.Client (one attempt, no limiter) with GeminiClient
+(token bucket + concurrency cap + jittered retries) for the same burst and
+prints success rate, latency percentiles, retries and rate limiter queue wait.
+
+Usage: python benchmarks/bench_gemini.py [--requests 40] [--threads 20] [--latency 0.5]
+       [--failure-rate 0.3] [--rpm 600] [--concurrency 4]
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from fakes import FakeGemini
+from stats import summarize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--threads", type=int, default=20, help="concurrent jobs issuing requests")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake generation latency (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.3, help="share of requests answered with 429")
+    parser.add_argument("--rpm", type=float, default=600)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--png", default=os.path.join(ROOT, "static", "generated", "thumb_1764434129.png"))
+    args = parser.parse_args()
+
+    with open(args.png, "rb") as f:
+        png = f.read()
+
+    from google import genai
+    from google.genai import types
+    import gemini_client
+
+    def run(generate):
+        latencies, failures = [], 0
+
+        def one(_):
+            start = time.perf_counter()
+            try:
+                generate(model="fake-image-model", contents="bench")
+                return time.perf_counter() - start
+            except Exception:
+                return None
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            for latency in pool.map(one, range(args.requests)):
+                if latency is None:
+                    failures += 1
+                else:
+                    latencies.append(latency)
+        return latencies, failures, time.perf_counter() - start
+
+    quiet = open(os.devnull, "w")
+    for name in ("bare genai.Client", "GeminiClient"):
+        with FakeGemini(png, generation_latency=args.latency, failure_rate=args.failure_rate, seed=1) as fake:
+            if name == "GeminiClient":
+                client = gemini_client.GeminiClient(api_key="bench", base_url=fake.url, rpm=args.rpm,
+                                                    concurrency=args.concurrency, backoff_base=0.25)
+                generate = client.generate_content
+            else:
+                bare = genai.Client(api_key="bench", http_options=types.HttpOptions(base_url=fake.url))
+                generate = bare.models.generate_content
+            retries_before = sum(gemini_client.GEMINI_RETRIES._values.values())
+            with contextlib.redirect_stdout(quiet):
+                latencies, failures, wall = run(generate)
+            retries = sum(gemini_client.GEMINI_RETRIES._values.values()) - retries_before
+            print(f"{name:>18}: {len(latencies)}/{args.requests} succeeded in {wall:.1f}s, "
+                  f"{fake.failures} 429s served, {retries} retries")
+            print(f"{'':>18}  {summarize(latencies)}")
+
+    queue = gemini_client.GEMINI_QUEUE_SECONDS._values.get(())
+    if queue:
+        print(f"rate limiter queue wait: n={queue[-1]} mean={queue[-2] / queue[-1] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Pushes and a multicast against a local fake LINE API that fails some requests.
+
+Compares the synchronous LineBotApi (new connection handling per call, no
+retry) with LineMessenger (pooled aiohttp session, jittered retries, retry
+keys) for the same burst of pushes, and prints how many users got their
+message, duplicates, errors and latency percentiles. Then multicasts one
+message to --recipients users and reports the number of API requests.
+
+Usage: python benchmarks/bench_line.py [--pushes 200] [--threads 20] [--latency 0.02]
+       [--failure-rate 0.05] [--lost-response-rate 0.02] [--recipients 1200]
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from fakes import FakeLine
+from stats import summarize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pushes", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=20, help="concurrent jobs pushing")
+    parser.add_argument("--latency", type=float, default=0.02, help="fake LINE API latency (s)")
+    parser.add_argument("--failure-rate", type=float, default=0.05, help="share of requests failing with 500")
+    parser.add_argument("--lost-response-rate", type=float, default=0.02,
+                        help="share of requests accepted but answered with 500")
+    parser.add_argument("--recipients", type=int, default=1200)
+    args = parser.parse_args()
+
+    from linebot import LineBotApi
+    from linebot.models import TextSendMessage
+    from line_client import LineMessenger
+
+    quiet = open(os.devnull, "w")
+    for name in ("LineBotApi", "LineMessenger"):
+        with FakeLine(latency=args.latency, failure_rate=args.failure_rate,
+                      lost_response_rate=args.lost_response_rate, seed=1) as fake:
+            if name == "LineMessenger":
+                client = LineMessenger("bench", endpoint=fake.url, backoff_base=0.05)
+            else:
+                client = LineBotApi("bench", endpoint=fake.url)
+            latencies, errors = [], 0
+
+            def one(i):
+                start = time.perf_counter()
+                try:
+                    client.push_message(f"U{i}", TextSendMessage(text="生成完了！"))
+                    return time.perf_counter() - start
+                except Exception:
+                    return None
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(quiet):
+                with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                    for latency in pool.map(one, range(args.pushes)):
+                        if latency is None:
+                            errors += 1
+                        else:
+                            latencies.append(latency)
+            wall = time.perf_counter() - start
+            received = Counter(user_id for kind, user_id, _, _ in fake.messages if kind == "push")
+            duplicates = sum(count - 1 for count in received.values())
+            print(f"{name:>14}: {len(received)}/{args.pushes} users received their push in {wall:.1f}s, "
+                  f"{duplicates} duplicates, {errors} errors raised, {fake.failures} failures injected")
+            print(f"{'':>14}  {summarize(latencies)}")
+
+            if name == "LineMessenger":
+                fake.failure_rate = fake.lost_response_rate = 0
+                before = fake.requests
+                recipients = [f"M{i}" for i in range(args.recipients)]
+                start = time.perf_counter()
+                failed = client.multicast(recipients, TextSendMessage(text="お知らせ"))
+                reached = len({user_id for kind, user_id, _, _ in fake.messages if kind == "multicast"})
+                print(f"{'multicast':>14}: {reached}/{args.recipients} users in {fake.requests - before} requests, "
+                      f"{len(failed)} failed, {(time.perf_counter() - start) * 1000:.0f}ms")
+                client.close()
+
+
+if __name__ == "__main__":
+    main()
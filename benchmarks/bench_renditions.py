@@ -0,0 +1,76 @@
+"""
+Encode time and output size of the LINE renditions for sample images.
+
+Usage: python benchmarks/bench_renditions.py [--runs 5] [images...]
+Defaults to every PNG in static/generated/.
+"""
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import renditions
+from stats import summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def encode_png_optimized(data):
+    buf = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        image.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def encode_webp(data):
+    buf = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        image.convert("RGB").save(buf, format="WEBP", quality=90, method=4)
+    return buf.getvalue()
+
+
+def measure(fn, data, runs):
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn(data)
+        latencies.append(time.perf_counter() - start)
+    return latencies, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("images", nargs="*")
+    args = parser.parse_args()
+    paths = args.images or sorted(glob.glob(os.path.join(ROOT, "static", "generated", "*.png")))
+
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as image:
+            size = image.size
+        print(f"{os.path.basename(path)}: {size[0]}x{size[1]} PNG, {len(data):,} bytes")
+
+        latencies, result = measure(renditions.make_renditions, data, args.runs)
+        original, preview = result["original"][0], result["preview"][0]
+        print(f"  renditions (JPEG q{renditions.ORIGINAL_JPEG_QUALITY} + {renditions.PREVIEW_MAX_SIDE}px preview): "
+              f"{summarize(latencies)}")
+        print(f"    original {len(original):,} bytes ({len(original) / len(data):.0%}), "
+              f"preview {len(preview):,} bytes ({len(preview) / len(data):.1%})")
+        print(f"    bytes sent to LINE per delivery: {len(data) * 2:,} -> {len(original) + len(preview):,}")
+
+        # For comparison only: LINE does not accept WebP, and optimized PNG stays large
+        for label, fn in (("optimized PNG", encode_png_optimized), ("WebP q90", encode_webp)):
+            latencies, encoded = measure(fn, data, args.runs)
+            print(f"  {label}: {summarize(latencies)}, {len(encoded):,} bytes")
+
+
+if __name__ == "__main__":
+    main()
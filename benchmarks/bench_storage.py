@@ -0,0 +1,95 @@
+"""
+Upload tail latency through StorageRouter with fake backends.
+
+Each fake backend sleeps for a lognormal latency around --latency, with a
+--tail-rate share of uploads stalling --tail-factor times longer and a
+--failure-rate share failing. Compares a single backend, fallback only and
+fallback + hedging, and prints per-upload latency percentiles.
+
+Usage: python benchmarks/bench_storage.py [--uploads 300] [--threads 8] [--latency 0.05]
+       [--tail-rate 0.05] [--tail-factor 20] [--failure-rate 0.02]
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stats import summarize
+from storage_backends import Backend, StorageRouter
+
+
+class FakeBackend(Backend):
+    def __init__(self, name, latency, tail_rate, tail_factor, failure_rate, seed):
+        self.name = name
+        self.latency = latency
+        self.tail_rate = tail_rate
+        self.tail_factor = tail_factor
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def upload(self, data, content_type, name):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * self._random.lognormvariate(0, 0.3)
+            if self._random.random() < self.tail_rate:
+                delay *= self.tail_factor
+            fail = self._random.random() < self.failure_rate
+        time.sleep(delay)
+        if fail:
+            raise RuntimeError(f"{self.name} failed")
+        return f"https://{self.name}.invalid/{self.calls}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uploads", type=int, default=300)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="median backend latency (s)")
+    parser.add_argument("--tail-rate", type=float, default=0.05)
+    parser.add_argument("--tail-factor", type=float, default=20)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    args = parser.parse_args()
+
+    def backends():
+        return [FakeBackend(name, args.latency * scale, args.tail_rate, args.tail_factor, args.failure_rate, seed)
+                for seed, (name, scale) in enumerate((("primary", 1.0), ("secondary", 1.5)))]
+
+    scenarios = [
+        ("single backend", lambda: StorageRouter(backends()[:1], hedging=False)),
+        ("fallback", lambda: StorageRouter(backends(), hedging=False)),
+        ("fallback + hedging", lambda: StorageRouter(backends(), hedging=True, hedge_min_samples=20,
+                                                     hedge_default_delay=args.latency * 4)),
+    ]
+
+    data = os.urandom(64 * 1024)
+    quiet = open(os.devnull, "w")
+    for name, make_router in scenarios:
+        router = make_router()
+        latencies, failures = [], 0
+
+        def one(_):
+            start = time.perf_counter()
+            url = router.upload(data, "image/jpeg")
+            return time.perf_counter() - start, url
+
+        with contextlib.redirect_stdout(quiet):
+            with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                for latency, url in pool.map(one, range(args.uploads)):
+                    if url:
+                        latencies.append(latency)
+                    else:
+                        failures += 1
+        calls = sum(backend.calls for backend in router.backends)
+        print(f"{name:>20}: {summarize(latencies)}, {failures} failed, {calls} backend calls")
+
+
+if __name__ == "__main__":
+    main()
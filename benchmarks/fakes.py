@@ -0,0 +1,372 @@
+"""
+Local stand-ins for the external services the bot talks to, for benchmarks.
+Each fake is a threaded HTTP server on 127.0.0.1 with a random port and an
+optional artificial latency per request.
+"""
+import base64
+import email
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+class FakeServer:
+    handler_class = None
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        handler = type("Handler", (self.handler_class,), {"fake": self})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    fake = None
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; avoid Nagle + delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def begin(self):
+        with self.fake.lock:
+            self.fake.requests += 1
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+
+
+class _GCSHandler(FakeHandler):
+    # Just enough of the JSON API for google-cloud-storage: bucket lookup,
+    # multipart and resumable uploads, ACL patches and deletes (also batched),
+    # plus an OAuth token endpoint.
+
+    def do_GET(self):
+        self.begin()
+        path = urlparse(self.path).path
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)/acl", path)
+        if match:
+            if self.fake.uniform_access:
+                return self.send_json(400, {"error": {"code": 400, "message": "Cannot use ACL API with uniform bucket-level access"}})
+            obj = self.fake.objects.get((match.group(1), unquote(match.group(2))))
+            return self.send_json(200, {"items": obj["meta"].get("acl", []) if obj else []})
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)", path)
+        if match:
+            return self.send_json(200, {"kind": "storage#bucket", "name": match.group(1), "id": match.group(1)})
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)", path)
+        if match:
+            obj = self.fake.objects.get((match.group(1), unquote(match.group(2))))
+            if obj:
+                return self.send_json(200, obj["meta"])
+        self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def do_POST(self):
+        self.begin()
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        body = self.read_body()
+        if parsed.path == "/token":
+            # OAuth token endpoint for service-account credentials pointed at the fake
+            return self.send_json(200, {"access_token": "fake-token", "expires_in": 3600, "token_type": "Bearer"})
+        if parsed.path == "/batch/storage/v1":
+            return self._batch(body)
+        match = re.fullmatch(r"/upload/storage/v1/b/([^/]+)/o", parsed.path)
+        if not match:
+            return self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+        bucket = match.group(1)
+        upload_type = query.get("uploadType", ["media"])[0]
+        if upload_type == "multipart":
+            metadata, data = self._split_multipart(body)
+            name = metadata.get("name") or query.get("name", [""])[0]
+            return self.send_json(200, self.fake.store(bucket, name, data, metadata.get("contentType")))
+        if upload_type == "resumable":
+            metadata = json.loads(body or b"{}")
+            name = metadata.get("name") or query.get("name", [""])[0]
+            upload_id = uuid.uuid4().hex
+            self.fake.sessions[upload_id] = (bucket, name, metadata.get("contentType"))
+            location = f"{self.fake.url}/upload/storage/v1/b/{bucket}/o?uploadType=resumable&upload_id={upload_id}"
+            return self.send_json(200, {}, headers={"Location": location})
+        name = query.get("name", [""])[0]
+        self.send_json(200, self.fake.store(bucket, name, body, self.headers.get("Content-Type")))
+
+    def do_PUT(self):
+        self.begin()
+        query = parse_qs(urlparse(self.path).query)
+        body = self.read_body()
+        session = self.fake.sessions.pop(query.get("upload_id", [""])[0], None)
+        if not session:
+            return self.send_json(404, {"error": {"code": 404, "message": "No such upload"}})
+        bucket, name, content_type = session
+        self.send_json(200, self.fake.store(bucket, name, body, content_type))
+
+    def do_PATCH(self):
+        self.begin()
+        path = urlparse(self.path).path
+        patch = json.loads(self.read_body() or b"{}")
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)", path)
+        obj = match and self.fake.objects.get((match.group(1), unquote(match.group(2))))
+        if not obj:
+            return self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+        if "acl" in patch and self.fake.uniform_access:
+            return self.send_json(400, {"error": {"code": 400, "message": "Cannot use ACL API with uniform bucket-level access"}})
+        obj["meta"].update(patch)
+        self.send_json(200, obj["meta"])
+
+    def do_DELETE(self):
+        self.begin()
+        path = urlparse(self.path).path
+        match = re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)", path)
+        if match and self.fake.objects.pop((match.group(1), unquote(match.group(2))), None):
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_json(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def _batch(self, body):
+        # multipart/mixed of application/http sub-requests; only deletes are supported
+        message = email.message_from_bytes(b"Content-Type: " + self.headers.get("Content-Type", "").encode()
+                                           + b"\r\n\r\n" + body)
+        boundary = uuid.uuid4().hex
+        parts = []
+        for index, part in enumerate(message.get_payload()):
+            method, uri = part.get_payload().split(" ", 2)[:2]
+            match = re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)", urlparse(uri).path)
+            with self.fake.lock:
+                found = method == "DELETE" and match and self.fake.objects.pop(
+                    (match.group(1), unquote(match.group(2))), None)
+            status = "204 No Content" if found else "404 Not Found"
+            content = "" if found else json.dumps({"error": {"code": 404, "message": "Not Found"}})
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{index + 1}>\r\n\r\n"
+                         f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{content}\r\n")
+        payload = ("".join(parts) + f"--{boundary}--\r\n").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/mixed; boundary={boundary}")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _split_multipart(self, body):
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers.get("Content-Type", "")).group(1).encode()
+        parts = [p for p in body.split(b"--" + boundary) if p.strip() not in (b"", b"--")]
+        metadata = json.loads(parts[0].split(b"\r\n\r\n", 1)[1].strip())
+        data = parts[1].split(b"\r\n\r\n", 1)[1]
+        if data.endswith(b"\r\n"):
+            data = data[:-2]
+        return metadata, data
+
+
+class FakeGCS(FakeServer):
+    """
+    Point google-cloud-storage at it with STORAGE_EMULATOR_HOST=<fake.url>.
+    With uniform_access=True, ACL patches fail like a bucket with uniform
+    bucket-level access.
+    """
+    handler_class = _GCSHandler
+
+    def __init__(self, latency=0.0, uniform_access=False):
+        super().__init__(latency)
+        self.uniform_access = uniform_access
+        self.objects = {}
+        self.sessions = {}
+
+    def store(self, bucket, name, data, content_type):
+        meta = {
+            "kind": "storage#object",
+            "bucket": bucket,
+            "name": name,
+            "id": f"{bucket}/{name}/1",
+            "generation": "1",
+            "size": str(len(data)),
+            "contentType": content_type or "application/octet-stream",
+        }
+        with self.lock:
+            self.objects[(bucket, name)] = {"meta": meta, "data": data}
+        return meta
+
+
+class _GeminiHandler(FakeHandler):
+
+    def do_POST(self):
+        self.begin()
+        body = json.loads(self.read_body() or b"{}")
+        fake = self.fake
+        if not re.search(r"/models/[^/:]+:generateContent$", urlparse(self.path).path):
+            return self.send_json(404, {"error": {"code": 404, "message": "Not Found", "status": "NOT_FOUND"}})
+        if fake.should_fail():
+            with fake.lock:
+                fake.failures += 1
+            return self.send_json(fake.failure_status, {"error": {
+                "code": fake.failure_status, "message": "Resource has been exhausted (fake)", "status": "RESOURCE_EXHAUSTED"}})
+        image_size = body.get("generationConfig", {}).get("imageConfig", {}).get("imageSize")
+        latency = fake.size_latency.get(image_size, fake.generation_latency)
+        if latency:
+            time.sleep(latency)
+        self.send_json(200, {
+            "candidates": [{
+                "content": {"role": "model", "parts": [{"inlineData": {"mimeType": "image/png", "data": fake.png_b64}}]},
+                "finishReason": "STOP",
+            }],
+        })
+
+
+class FakeGemini(FakeServer):
+    """
+    generateContent endpoint that returns a canned PNG after `generation_latency`
+    seconds (or `size_latency[imageSize]`, e.g. {"1K": 0.3}), or an error with
+    `failure_status` (429 by default) at `failure_rate`.
+    Point google-genai at it with HttpOptions(base_url=fake.url).
+    """
+    handler_class = _GeminiHandler
+
+    def __init__(self, png_bytes, generation_latency=0.0, failure_rate=0.0, failure_status=429, latency=0.0, seed=None,
+                 size_latency=None):
+        super().__init__(latency)
+        self.size_latency = size_latency or {}
+        self.png_b64 = base64.b64encode(png_bytes).decode("ascii")
+        self.generation_latency = generation_latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.failures = 0
+        self._random = random.Random(seed)
+
+    def should_fail(self):
+        with self.lock:
+            return self._random.random() < self.failure_rate
+
+
+class _LineHandler(FakeHandler):
+
+    def do_POST(self):
+        self.begin()
+        path = urlparse(self.path).path
+        payload = json.loads(self.read_body() or b"{}")
+        fake = self.fake
+        if path == "/v2/bot/message/reply":
+            kind, user_ids = "reply", [None]
+        elif path == "/v2/bot/message/push":
+            kind, user_ids = "push", [payload.get("to")]
+        elif path == "/v2/bot/message/multicast":
+            kind, user_ids = "multicast", payload.get("to", [])
+        else:
+            return self.send_json(404, {"message": "Not found"})
+        if fake.should_fail():
+            return self.send_json(fake.failure_status, {"message": "fake failure"})
+        if not fake.accept_retry_key(self.headers.get("X-Line-Retry-Key")):
+            return self.send_json(409, {"message": "The retry key is already accepted"})
+        fake.record(kind, user_ids, payload)
+        if fake.should_lose_response():
+            # Accepted, but the client never hears back
+            return self.send_json(fake.failure_status, {"message": "fake failure after accepting"})
+        self.send_json(200, {})
+
+
+class FakeLine(FakeServer):
+    """
+    LINE Messaging API reply/push/multicast endpoints. Every accepted message is
+    recorded; `wait_for` blocks until a user has received a matching push.
+    `failure_rate` requests fail with `failure_status` before being accepted,
+    `lost_response_rate` fail after (the message is delivered anyway). A
+    repeated X-Line-Retry-Key is answered with 409 like the real API.
+    Point LineBotApi / LineMessenger at it with endpoint=fake.url.
+    """
+    handler_class = _LineHandler
+
+    def __init__(self, latency=0.0, failure_rate=0.0, failure_status=500, seed=None, lost_response_rate=0.0):
+        super().__init__(latency)
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.lost_response_rate = lost_response_rate
+        self.failures = 0
+        self.messages = []  # (kind, user_id, payload, timestamp)
+        self.retry_keys = set()
+        self.condition = threading.Condition(self.lock)
+        self._random = random.Random(seed)
+
+    def should_fail(self):
+        with self.lock:
+            fail = self._random.random() < self.failure_rate
+            self.failures += fail
+            return fail
+
+    def should_lose_response(self):
+        with self.lock:
+            lost = self._random.random() < self.lost_response_rate
+            self.failures += lost
+            return lost
+
+    def accept_retry_key(self, retry_key):
+        with self.lock:
+            if retry_key in self.retry_keys:
+                return False
+            if retry_key:
+                self.retry_keys.add(retry_key)
+            return True
+
+    def record(self, kind, user_ids, payload):
+        with self.condition:
+            now = time.time()
+            for user_id in user_ids:
+                self.messages.append((kind, user_id, payload, now))
+            self.condition.notify_all()
+
+    def wait_for(self, user_id, predicate, timeout, since=0.0):
+        """
+        Waits until `user_id` got a push/multicast whose payload satisfies
+        `predicate`, recorded after `since`. Returns the payload or None.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                for kind, uid, payload, ts in self.messages:
+                    if uid == user_id and ts >= since and predicate(payload):
+                        return payload
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+
+def has_image(payload):
+    return any(message.get("type") == "image" for message in payload.get("messages", []))
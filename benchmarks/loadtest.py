@@ -0,0 +1,329 @@
+"""
+End-to-end load test of the FastAPI app against local fakes.
+
+Boots main.app under uvicorn with LINE, Gemini and GCS pointed at the fakes
+in fakes.py and a scratch SQLite database, then drives concurrent users
+through follow -> Stripe purchase -> (prompt -> "はい" -> image) conversations
+using correctly signed /callback and /stripe_webhook requests.
+
+Reports throughput, end-to-end and webhook latency, per-stage p50/p95/p99
+from /metrics and SQLite contention (per-op latency and lock errors).
+
+Usage: python benchmarks/loadtest.py [--users 20] [--conversations 3] [--gemini-latency 1.0]
+       [--gemini-failure-rate 0.0] [--gemini-rpm 600] [--gcs-latency 0.02] [--line-latency 0.01] [--line-failure-rate 0.0] [--concurrency 20]
+       [--job-backend sqlite --worker-processes 2] [--variations 1]
+       [--progressive manual|auto --gemini-draft-latency 0.3] [--duplicate-rate 0.0]
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from fakes import FakeGCS, FakeGemini, FakeLine, has_image
+from stats import summarize
+
+LINE_CHANNEL_SECRET = "loadtest-channel-secret"
+STRIPE_WEBHOOK_SECRET = "whsec_loadtest"
+
+
+def line_signature(body):
+    digest = hmac.new(LINE_CHANNEL_SECRET.encode(), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+
+def stripe_signature(body):
+    timestamp = int(time.time())
+    signed = f"{timestamp}.".encode() + body
+    digest = hmac.new(STRIPE_WEBHOOK_SECRET.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def line_event(user_id, event_type, text=None):
+    event = {
+        "type": event_type,
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+    }
+    if event_type == "message":
+        event["message"] = {"type": "text", "id": uuid.uuid4().hex[:12], "text": text}
+    return event
+
+
+def checkout_event(user_id):
+    return {
+        "id": f"evt_{uuid.uuid4().hex}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": f"cs_{uuid.uuid4().hex}", "object": "checkout.session",
+                            "client_reference_id": user_id}},
+    }
+
+
+class Client:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.latencies = {"callback": [], "stripe_webhook": []}
+        self.errors = {"callback": 0, "stripe_webhook": 0}
+
+    def post(self, route, body, headers):
+        request = urllib.request.Request(self.base_url + route, data=body, method="POST",
+                                         headers={"Content-Type": "application/json", **headers})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                response.read()
+                ok = True
+        except urllib.error.URLError as e:
+            print(f"{route} failed: {e}", file=sys.stderr)
+            ok = False
+        with self.lock:
+            self.latencies[route.strip("/")].append(time.perf_counter() - start)
+            if not ok:
+                self.errors[route.strip("/")] += 1
+
+    def callback(self, *events):
+        body = json.dumps({"destination": "Uloadtest", "events": list(events)}).encode()
+        self.post("/callback", body, {"X-Line-Signature": line_signature(body)})
+
+    def stripe(self, event):
+        body = json.dumps(event).encode()
+        self.post("/stripe_webhook", body, {"Stripe-Signature": stripe_signature(body)})
+
+    def get(self, route):
+        with urllib.request.urlopen(self.base_url + route, timeout=30) as response:
+            return response.read().decode()
+
+
+def parse_histograms(text, name, label):
+    """
+    {label_value: [(upper_bound, cumulative_count), ...]} for a histogram in /metrics output.
+    """
+    result = {}
+    prefix = name + "_bucket{"
+    for line in text.splitlines():
+        if not line.startswith(prefix):
+            continue
+        labels, value = line[len(prefix):].rsplit("} ", 1)
+        pairs = dict(part.split("=", 1) for part in labels.split(","))
+        key = pairs[label].strip('"')
+        bound = pairs["le"].strip('"')
+        bound = float("inf") if bound == "+Inf" else float(bound)
+        result.setdefault(key, []).append((bound, float(value)))
+    return result
+
+
+def histogram_quantile(buckets, q):
+    buckets = sorted(buckets)
+    total = buckets[-1][1]
+    if not total:
+        return 0.0
+    target = q * total
+    lower_bound, lower_count = 0.0, 0.0
+    for bound, count in buckets:
+        if count >= target:
+            if bound == float("inf"):
+                return lower_bound
+            span = count - lower_count
+            fraction = (target - lower_count) / span if span else 1.0
+            return lower_bound + (bound - lower_bound) * fraction
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+def parse_counter(text, name):
+    values = {}
+    for line in text.splitlines():
+        if line.startswith(name + "{") or line.startswith(name + " "):
+            key, value = line.rsplit(" ", 1)
+            values[key[len(name):] or "total"] = float(value)
+    return values
+
+
+def start_server(app):
+    import uvicorn
+    config = uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--conversations", type=int, default=3, help="prompt -> はい rounds per user")
+    parser.add_argument("--concurrency", type=int, default=20, help="users driven at the same time")
+    parser.add_argument("--variations", type=int, default=1, help="images per prompt (\"N案\")")
+    parser.add_argument("--progressive", choices=("off", "manual", "auto"), default="off",
+                        help="PROGRESSIVE_DELIVERY mode; manual sends 高画質 after each draft")
+    parser.add_argument("--gemini-draft-latency", type=float, default=None, help="latency of 1K drafts (s)")
+    parser.add_argument("--gemini-latency", type=float, default=1.0)
+    parser.add_argument("--gemini-failure-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-rpm", type=float, default=600, help="GeminiClient rate limit")
+    parser.add_argument("--gcs-latency", type=float, default=0.02)
+    parser.add_argument("--line-latency", type=float, default=0.01)
+    parser.add_argument("--line-failure-rate", type=float, default=0.0, help="share of LINE API calls answered with 500")
+    parser.add_argument("--png", default=os.path.join(ROOT, "static", "generated", "thumb_1764434129.png"))
+    parser.add_argument("--duplicate-rate", type=float, default=0.0,
+                        help="share of confirmations double-tapped and redelivered by LINE")
+    parser.add_argument("--job-backend", choices=("inprocess", "sqlite"), default="inprocess")
+    parser.add_argument("--worker-processes", type=int, default=2, help="with --job-backend sqlite")
+    parser.add_argument("--timeout", type=float, default=120.0, help="max wait for each image (s)")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's log output")
+    args = parser.parse_args()
+
+    with open(args.png, "rb") as f:
+        png = f.read()
+
+    size_latency = {"1K": args.gemini_draft_latency} if args.gemini_draft_latency is not None else None
+    gemini = FakeGemini(png, generation_latency=args.gemini_latency, failure_rate=args.gemini_failure_rate,
+                        size_latency=size_latency).start()
+    gcs = FakeGCS(latency=args.gcs_latency).start()
+    line = FakeLine(latency=args.line_latency, failure_rate=args.line_failure_rate).start()
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.update({
+        "DB_PATH": os.path.join(workdir, "bot.db"),
+        "LINE_CHANNEL_SECRET": LINE_CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "loadtest-token",
+        "LINE_API_ENDPOINT": line.url,
+        "GOOGLE_API": "loadtest-key",
+        "GEMINI_BASE_URL": gemini.url,
+        "GEMINI_RPM": str(args.gemini_rpm),
+        "STORAGE_EMULATOR_HOST": gcs.url,
+        "GOOGLE_CLOUD_PROJECT": "loadtest",
+        "STRIPE_API_KEY": "sk_test_loadtest",
+        "STRIPE_WEBHOOK_SECRET": STRIPE_WEBHOOK_SECRET,
+        "JOB_BACKEND": args.job_backend,
+        "PROGRESSIVE_DELIVERY": args.progressive,
+    })
+    # The loaded .env must not override the fakes
+    os.environ.pop("GOOGLE_APPLICATION_CREDENTIALS_JSON", None)
+
+    if not args.verbose:
+        sys.stdout = open(os.path.join(workdir, "app.log"), "w")
+    import main as bot
+    server, thread, base_url = start_server(bot.app)
+    workers = None
+    if args.job_backend == "sqlite":
+        worker_log = open(os.path.join(workdir, "worker.log"), "w")
+        workers = subprocess.Popen([sys.executable, "-W", "ignore", "-m", "worker",
+                                    "--processes", str(args.worker_processes)],
+                                   cwd=ROOT, stdout=worker_log, stderr=subprocess.STDOUT)
+    client = Client(base_url)
+
+    e2e = []
+    finals = []
+    images = []
+    failed = []
+    lock = threading.Lock()
+
+    def run_user(index):
+        user_id = f"U{index:032x}"
+        client.callback(line_event(user_id, "follow"))
+        client.stripe(checkout_event(user_id))
+        for round_ in range(args.conversations):
+            suffix = f" {args.variations}案" if args.variations > 1 else ""
+            client.callback(line_event(user_id, "message", f"テスト {index}-{round_}: 猫がハンバーガーを食べる{suffix}"))
+            start = time.time()
+            confirm = line_event(user_id, "message", "はい")
+            client.callback(confirm)
+            if random.random() < args.duplicate_rate:
+                # A second tap, then LINE redelivering the first one
+                client.callback(line_event(user_id, "message", "はい"))
+                client.callback(confirm)
+            # The job pushes either the image or an error message
+            payload = line.wait_for(user_id, lambda p: True, args.timeout, since=start)
+            with lock:
+                if payload and has_image(payload):
+                    e2e.append(time.time() - start)
+                    images.append(sum(message.get("type") == "image" for message in payload["messages"]))
+                else:
+                    failed.append(user_id)
+            if args.progressive != "off" and payload and has_image(payload):
+                if args.progressive == "manual":
+                    client.callback(line_event(user_id, "message", "高画質"))
+                final = line.wait_for(user_id, lambda p: has_image(p) and "高画質版が完成" in json.dumps(p, ensure_ascii=False),
+                                      args.timeout, since=start)
+                with lock:
+                    if final:
+                        finals.append(time.time() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(run_user, range(args.users)))
+    wall = time.perf_counter() - start
+
+    metrics_text = client.get("/metrics")
+    server.should_exit = True
+    thread.join(timeout=30)
+    if workers:
+        workers.terminate()
+        workers.wait(timeout=30)
+    sys.stdout = sys.__stdout__
+
+    delivered = len(e2e)
+    print(f"{args.users} users x {args.conversations} conversations, concurrency {args.concurrency}, "
+          f"jobs {args.job_backend}, "
+          f"Gemini {args.gemini_latency:.2f}s (failure rate {args.gemini_failure_rate:.0%}), "
+          f"GCS {args.gcs_latency * 1000:.0f}ms, LINE {args.line_latency * 1000:.0f}ms")
+    print(f"delivered {sum(images)} images in {delivered} pushes in {wall:.1f}s = {sum(images) / wall:.2f} images/s, "
+          f"{len(failed)} not delivered, {gemini.failures} injected Gemini failures, "
+          f"{line.failures} injected LINE failures")
+    print(f"  prompt confirmed -> image pushed: {summarize(e2e)}")
+    # thumbnail_coalesced_requests_total{reason="..."} N -> reason=N
+    coalesced = [f"{reason}={count}" for reason, count in
+                 re.findall(r'^thumbnail_coalesced_requests_total\{reason="([^"]*)"\} (\S+)$', metrics_text, re.M)]
+    print(f"  {gemini.requests} Gemini calls, coalesced: {', '.join(coalesced) or 'none'}")
+    if args.progressive != "off":
+        print(f"  prompt confirmed -> final pushed: {summarize(finals)}")
+    for route, latencies in client.latencies.items():
+        print(f"  POST /{route}: {summarize(latencies)} ({client.errors[route]} errors)")
+
+    print("per stage (from /metrics, bucket-interpolated):")
+    for stage, buckets in sorted(parse_histograms(metrics_text, "thumbnail_stage_seconds", "stage").items()):
+        count = int(sorted(buckets)[-1][1])
+        p50, p95, p99 = (histogram_quantile(buckets, q) * 1000 for q in (0.5, 0.95, 0.99))
+        print(f"  {stage:>18}: n={count} p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms")
+
+    print("database:")
+    for op, buckets in sorted(parse_histograms(metrics_text, "thumbnail_db_seconds", "op").items()):
+        count = int(sorted(buckets)[-1][1])
+        p95 = histogram_quantile(buckets, 0.95) * 1000
+        print(f"  {op:>26}: n={count} p95={p95:.2f}ms")
+    lock_errors = parse_counter(metrics_text, "thumbnail_db_lock_errors_total")
+    print(f"  lock errors: {int(sum(lock_errors.values()))}")
+    print(f"app log: {os.path.join(workdir, 'app.log') if not args.verbose else 'stdout'}")
+
+    for fake in (gemini, gcs, line):
+        fake.stop()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    """
+    One-line latency summary (in milliseconds) for benchmark output.
+    """
+    if not latencies:
+        return "n=0"
+    return (f"n={len(latencies)} p50={percentile(latencies, 50) * 1000:.1f}ms "
+            f"p95={percentile(latencies, 95) * 1000:.1f}ms p99={percentile(latencies, 99) * 1000:.1f}ms "
+            f"max={max(latencies) * 1000:.1f}ms")
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from metrics import Counter
+
+# Webhook event IDs remembered for dropping LINE redeliveries
+EVENT_DEDUP_SIZE = int(os.getenv("EVENT_DEDUP_SIZE", "10000"))
+EVENT_DEDUP_TTL_SECONDS = float(os.getenv("EVENT_DEDUP_TTL_SECONDS", "3600"))
+
+COALESCED = Counter("thumbnail_coalesced_requests_total",
+                    "Duplicate triggers attached to in-flight work instead of starting more, by reason", ["reason"])
+
+
+def generation_dedup_key(user_id, prompt):
+    """
+    Job dedup key for generating `prompt` for `user_id`: a second confirmation of
+    the same pending prompt attaches to the job already in flight.
+    """
+    digest = hashlib.sha256(f"{user_id}\0{prompt}".encode("utf-8")).hexdigest()[:32]
+    return f"generate:{digest}"
+
+
+class RecentKeys:
+    """
+    Bounded set of keys seen in the last `ttl` seconds, oldest dropped first.
+    """
+
+    def __init__(self, max_size=EVENT_DEDUP_SIZE, ttl=EVENT_DEDUP_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """
+        Records `key`. Returns False if it was already seen within the TTL.
+        """
+        now = time.monotonic()
+        with self._lock:
+            while self._keys:
+                oldest, seen_at = next(iter(self._keys.items()))
+                if now - seen_at <= self.ttl and len(self._keys) < self.max_size:
+                    break
+                del self._keys[oldest]
+            if key in self._keys:
+                return False
+            self._keys[key] = now
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time: callers arriving while a call for the
+    same key is in flight wait for it and get its result (or exception).
+    """
+
+    def __init__(self, reason):
+        self.reason = reason
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            COALESCED.inc(reason=self.reason)
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
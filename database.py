@@ -1,99 +1,641 @@
+import json
 import sqlite3
 import os
-from datetime import datetime
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "bot.db")
+from metrics import log, instrument_db, CREDITS
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        line_user_id TEXT PRIMARY KEY,
-        credits INTEGER DEFAULT 1,
-        is_free_trial_used BOOLEAN DEFAULT 0,
-        pending_prompt TEXT,
-        created_at DATETIME
-    )''')
-    
-    # Check if pending_prompt column exists (migration for existing db)
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "bot.db"))
+# How long a connection waits on a locked database before raising "database is locked"
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+# Per-connection prepared statement cache
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "128"))
+# Reserved credits not committed or refunded within this window are refunded by
+# expire_stale_reservations(). Must be well above the worst-case generation time.
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "900"))
+# Durable jobs: a claimed job is retried by another worker if its lease is not
+# renewed in time, up to JOB_MAX_ATTEMPTS claims.
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# One connection per thread, reused across calls
+_local = threading.local()
+# Database paths whose schema init_db() has created in this process
+_initialized_paths = set()
+_init_lock = threading.RLock()
+
+def _connect(path):
+    # isolation_level=None: single statements autocommit, multi-statement
+    # writes go through transaction() with an explicit BEGIN IMMEDIATE.
+    conn = sqlite3.connect(
+        path,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    return conn
+
+def get_connection():
+    """
+    Returns this thread's connection to DB_PATH, opening it (and creating the
+    schema, once per process) on first use.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = _connect(DB_PATH)
+        _local.conn = conn
+        _local.path = DB_PATH
+    if DB_PATH not in _initialized_paths:
+        _ensure_schema()
+    return conn
+
+def _ensure_schema():
+    # The schema is created on first use rather than at import, so a cold start
+    # that never touches the database doesn't pay for it. init_db() calls back
+    # into get_connection(); the flag stops that from recursing.
+    with _init_lock:
+        if DB_PATH in _initialized_paths or getattr(_local, "initializing", False):
+            return
+        _local.initializing = True
+        try:
+            init_db()
+        finally:
+            _local.initializing = False
+        _initialized_paths.add(DB_PATH)
+
+def close_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextmanager
+def transaction():
+    """
+    Runs the enclosed statements in one write transaction on this thread's connection.
+    """
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        c.execute("SELECT pending_prompt FROM users LIMIT 1")
-    except sqlite3.OperationalError:
-        c.execute("ALTER TABLE users ADD COLUMN pending_prompt TEXT")
-
-    # Transactions table
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions (
-        id TEXT PRIMARY KEY,
-        line_user_id TEXT,
-        amount INTEGER,
-        credits_added INTEGER,
-        status TEXT,
-        created_at DATETIME
-    )''')
-    
-    conn.commit()
-    conn.close()
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+@instrument_db
+def init_db():
+    with transaction() as c:
+        # Users table
+        c.execute('''CREATE TABLE IF NOT EXISTS users (
+            line_user_id TEXT PRIMARY KEY,
+            credits INTEGER DEFAULT 1,
+            is_free_trial_used BOOLEAN DEFAULT 0,
+            pending_prompt TEXT,
+            created_at DATETIME
+        )''')
+
+        # Check if pending_prompt column exists (migration for existing db)
+        try:
+            c.execute("SELECT pending_prompt FROM users LIMIT 1")
+        except sqlite3.OperationalError:
+            c.execute("ALTER TABLE users ADD COLUMN pending_prompt TEXT")
+
+        # Transactions table
+        c.execute('''CREATE TABLE IF NOT EXISTS transactions (
+            id TEXT PRIMARY KEY,
+            line_user_id TEXT,
+            amount INTEGER,
+            credits_added INTEGER,
+            status TEXT,
+            created_at DATETIME
+        )''')
+
+        # Credit reservations: a credit is taken from users.credits when a
+        # generation starts and the reservation is later committed or refunded.
+        c.execute('''CREATE TABLE IF NOT EXISTS credit_reservations (
+            id TEXT PRIMARY KEY,
+            line_user_id TEXT,
+            status TEXT,
+            created_at DATETIME,
+            expires_at DATETIME,
+            amount INTEGER DEFAULT 1
+        )''')
+
+        # Check if amount column exists (migration for existing db)
+        try:
+            c.execute("SELECT amount FROM credit_reservations LIMIT 1")
+        except sqlite3.OperationalError:
+            c.execute("ALTER TABLE credit_reservations ADD COLUMN amount INTEGER DEFAULT 1")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_reservations_status_expires ON credit_reservations (status, expires_at)")
 
+        # Latest progressive-delivery draft per user, for upgrading it to the final size
+        c.execute('''CREATE TABLE IF NOT EXISTS drafts (
+            line_user_id TEXT PRIMARY KEY,
+            prompt TEXT,
+            seed INTEGER,
+            created_at DATETIME,
+            upgraded_at DATETIME
+        )''')
+
+        # Every uploaded object delivered to a user, for the 履歴 command and for
+        # expiring remote objects and local copies
+        c.execute('''CREATE TABLE IF NOT EXISTS assets (
+            id TEXT PRIMARY KEY,
+            image_id TEXT,
+            rendition TEXT,
+            line_user_id TEXT,
+            prompt_hash TEXT,
+            local_path TEXT,
+            backend TEXT,
+            object_name TEXT,
+            url TEXT,
+            url_expires_at DATETIME,
+            bytes INTEGER,
+            created_at DATETIME,
+            deleted_at DATETIME
+        )''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_assets_user_created ON assets (line_user_id, created_at)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_assets_deleted_created ON assets (deleted_at, created_at)")
+
+        # Stripe webhook inbox: events are stored on receipt and applied afterwards, once each
+        c.execute('''CREATE TABLE IF NOT EXISTS stripe_events (
+            id TEXT PRIMARY KEY,
+            type TEXT,
+            payload TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            received_at DATETIME,
+            applied_at DATETIME
+        )''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_stripe_events_status ON stripe_events (status, received_at)")
+
+        # Durable job queue for worker processes (JOB_BACKEND=sqlite)
+        c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            payload TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            max_attempts INTEGER,
+            lease_owner TEXT,
+            lease_expires_at DATETIME,
+            run_after DATETIME,
+            last_error TEXT,
+            created_at DATETIME,
+            finished_at DATETIME,
+            dedup_key TEXT
+        )''')
+
+        # Check if dedup_key column exists (migration for existing db)
+        try:
+            c.execute("SELECT dedup_key FROM jobs LIMIT 1")
+        except sqlite3.OperationalError:
+            c.execute("ALTER TABLE jobs ADD COLUMN dedup_key TEXT")
+        # At most one queued / running job per dedup key
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_dedup ON jobs (dedup_key) "
+                  "WHERE dedup_key IS NOT NULL AND status IN ('queued', 'running')")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs (status, run_after)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_lease ON jobs (status, lease_expires_at)")
+
+@instrument_db
 def get_user(line_user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE line_user_id = ?", (line_user_id,))
-    user = c.fetchone()
-    conn.close()
-    if user:
-        return dict(user)
+    row = get_connection().execute("SELECT * FROM users WHERE line_user_id = ?", (line_user_id,)).fetchone()
+    if row:
+        return dict(row)
     return None
 
+@instrument_db
 def create_user(line_user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO users (line_user_id, credits, is_free_trial_used, created_at) VALUES (?, ?, ?, ?)",
-                  (line_user_id, 1, 0, datetime.now()))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass # User already exists
-    conn.close()
+    # Does nothing if the user already exists
+    get_connection().execute(
+        "INSERT OR IGNORE INTO users (line_user_id, credits, is_free_trial_used, created_at) VALUES (?, ?, ?, ?)",
+        (line_user_id, 1, 0, datetime.now()))
 
+@instrument_db
+def get_or_create_user(line_user_id):
+    """
+    Returns the user record (including pending_prompt), creating the user first if needed.
+    """
+    user = get_user(line_user_id)
+    if user is None:
+        create_user(line_user_id)
+        user = get_user(line_user_id)
+    return user
+
+@instrument_db
 def set_pending_prompt(line_user_id, prompt):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE users SET pending_prompt = ? WHERE line_user_id = ?", (prompt, line_user_id))
-    conn.commit()
-    conn.close()
+    get_connection().execute("UPDATE users SET pending_prompt = ? WHERE line_user_id = ?", (prompt, line_user_id))
 
+@instrument_db
 def get_pending_prompt(line_user_id):
-    user = get_user(line_user_id)
-    if user:
-        return user.get("pending_prompt")
+    row = get_connection().execute("SELECT pending_prompt FROM users WHERE line_user_id = ?", (line_user_id,)).fetchone()
+    if row:
+        return row["pending_prompt"]
     return None
 
 def clear_pending_prompt(line_user_id):
     set_pending_prompt(line_user_id, None)
 
+@instrument_db
+def set_pending_prompts(updates):
+    """
+    Writes many (line_user_id, prompt) pending prompt updates in one transaction.
+    """
+    with transaction() as c:
+        c.executemany("UPDATE users SET pending_prompt = ? WHERE line_user_id = ?",
+                      [(prompt, line_user_id) for line_user_id, prompt in updates])
+
+@instrument_db
 def add_credits(line_user_id, amount):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("UPDATE users SET credits = credits + ? WHERE line_user_id = ?", (amount, line_user_id))
-    conn.commit()
-    conn.close()
+    """
+    Adds credits and returns the new balance (None if the user does not exist).
+    """
+    # fetchall() steps the statement to completion so the write commits right away
+    rows = get_connection().execute(
+        "UPDATE users SET credits = credits + ? WHERE line_user_id = ? RETURNING credits",
+        (amount, line_user_id)).fetchall()
+    return rows[0]["credits"] if rows else None
 
+@instrument_db
 def decrement_credit(line_user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    print(f"DB: Decrementing credit for {line_user_id}")
-    c.execute("UPDATE users SET credits = credits - 1, is_free_trial_used = 1, pending_prompt = NULL WHERE line_user_id = ?", (line_user_id,))
-    print(f"DB: Rows updated: {c.rowcount}")
-    conn.commit()
-    conn.close()
+    """
+    Spends one credit, clears the pending prompt and returns the new balance
+    (None if the user does not exist).
+    """
+    log(f"DB: Decrementing credit for {line_user_id}")
+    rows = get_connection().execute(
+        "UPDATE users SET credits = credits - 1, is_free_trial_used = 1, pending_prompt = NULL WHERE line_user_id = ? RETURNING credits",
+        (line_user_id,)).fetchall()
+    log(f"DB: Rows updated: {len(rows)}")
+    return rows[0]["credits"] if rows else None
 
+@instrument_db
 def record_transaction(tx_id, line_user_id, amount, credits_added, status):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO transactions (id, line_user_id, amount, credits_added, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-              (tx_id, line_user_id, amount, credits_added, status, datetime.now()))
-    conn.commit()
-    conn.close()
+    get_connection().execute(
+        "INSERT INTO transactions (id, line_user_id, amount, credits_added, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        (tx_id, line_user_id, amount, credits_added, status, datetime.now()))
+
+@instrument_db
+def store_stripe_event(event_id, event_type, payload):
+    """
+    Adds a verified Stripe event to the inbox. Returns False if it was already
+    there (a Stripe retry or replay).
+    """
+    cur = get_connection().execute(
+        "INSERT OR IGNORE INTO stripe_events (id, type, payload, status, received_at) VALUES (?, ?, ?, 'pending', ?)",
+        (event_id, event_type, payload, datetime.now()))
+    return cur.rowcount == 1
+
+@instrument_db
+def get_stripe_event(event_id):
+    row = get_connection().execute("SELECT * FROM stripe_events WHERE id = ?", (event_id,)).fetchone()
+    return dict(row) if row else None
+
+@instrument_db
+def pending_stripe_events(received_before=None):
+    """
+    Ids of events not applied yet, oldest first, optionally only those received before `received_before`.
+    """
+    rows = get_connection().execute(
+        "SELECT id FROM stripe_events WHERE status = 'pending' AND received_at < ? ORDER BY received_at",
+        (received_before or datetime.now(),)).fetchall()
+    return [row["id"] for row in rows]
+
+@instrument_db
+def apply_credit_purchase(event_id, tx_id, line_user_id, amount, credits_added):
+    """
+    Grants the credits of a purchase and records the transaction in one
+    transaction, and marks the Stripe event applied. Does nothing if the event
+    was already applied; the credits are not granted twice for one transaction
+    id. Returns True if credits were granted.
+    """
+    with transaction() as c:
+        rows = c.execute(
+            "UPDATE stripe_events SET status = 'applied', attempts = attempts + 1, applied_at = ? "
+            "WHERE id = ? AND status = 'pending' RETURNING id",
+            (datetime.now(), event_id)).fetchall()
+        if not rows:
+            return False
+        cur = c.execute(
+            "INSERT OR IGNORE INTO transactions (id, line_user_id, amount, credits_added, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (tx_id, line_user_id, amount, credits_added, "completed", datetime.now()))
+        if cur.rowcount != 1:
+            log(f"DB: Transaction {tx_id} already recorded, not granting credits again")
+            return False
+        c.execute("UPDATE users SET credits = credits + ? WHERE line_user_id = ?", (credits_added, line_user_id))
+    return True
+
+@instrument_db
+def mark_stripe_event(event_id, status, error=None):
+    get_connection().execute(
+        "UPDATE stripe_events SET status = ?, attempts = attempts + 1, last_error = ?, applied_at = ? WHERE id = ?",
+        (status, error, datetime.now(), event_id))
+
+@instrument_db
+def save_draft(line_user_id, prompt, seed):
+    """
+    Remembers the draft just delivered to the user, replacing any older one.
+    """
+    get_connection().execute(
+        "INSERT OR REPLACE INTO drafts (line_user_id, prompt, seed, created_at, upgraded_at) VALUES (?, ?, ?, ?, NULL)",
+        (line_user_id, prompt, seed, datetime.now()))
+
+@instrument_db
+def claim_draft_upgrade(line_user_id, max_age_seconds):
+    """
+    Marks the user's latest draft as upgraded and returns its (prompt, seed), or
+    None if there is no draft younger than `max_age_seconds` left to upgrade.
+    """
+    rows = get_connection().execute(
+        "UPDATE drafts SET upgraded_at = ? WHERE line_user_id = ? AND upgraded_at IS NULL AND created_at > ? "
+        "RETURNING prompt, seed",
+        (datetime.now(), line_user_id, datetime.now() - timedelta(seconds=max_age_seconds))).fetchall()
+    return (rows[0]["prompt"], rows[0]["seed"]) if rows else None
+
+@instrument_db
+def record_assets(rows):
+    """
+    Adds asset rows: dicts with image_id, rendition, line_user_id, prompt_hash,
+    local_path, backend, object_name, url, url_expires_at and bytes.
+    """
+    now = datetime.now()
+    get_connection().executemany(
+        "INSERT INTO assets (id, image_id, rendition, line_user_id, prompt_hash, local_path, backend, object_name, "
+        "url, url_expires_at, bytes, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(uuid.uuid4().hex, row["image_id"], row["rendition"], row["line_user_id"], row["prompt_hash"],
+          row["local_path"], row["backend"], row["object_name"], row["url"], row["url_expires_at"], row["bytes"], now)
+         for row in rows])
+
+@instrument_db
+def get_recent_assets(line_user_id, images):
+    """
+    Live asset rows of the user's `images` most recently delivered images, newest first.
+    """
+    rows = get_connection().execute(
+        "SELECT * FROM assets WHERE deleted_at IS NULL AND image_id IN ("
+        "  SELECT image_id FROM assets WHERE line_user_id = ? AND deleted_at IS NULL "
+        "  GROUP BY image_id ORDER BY MAX(created_at) DESC LIMIT ?) "
+        "ORDER BY created_at DESC",
+        (line_user_id, images)).fetchall()
+    return [dict(row) for row in rows]
+
+@instrument_db
+def update_asset_urls(updates):
+    """
+    Stores re-signed URLs: `updates` is a list of (asset_id, url, url_expires_at).
+    """
+    get_connection().executemany("UPDATE assets SET url = ?, url_expires_at = ? WHERE id = ?",
+                                 [(url, expires_at, asset_id) for asset_id, url, expires_at in updates])
+
+@instrument_db
+def get_expired_assets(created_before, backends, limit=1000):
+    """
+    Live asset rows on `backends` created before `created_before`, oldest first.
+    """
+    placeholders = ",".join("?" * len(backends))
+    rows = get_connection().execute(
+        f"SELECT * FROM assets WHERE deleted_at IS NULL AND created_at < ? AND backend IN ({placeholders}) "
+        "ORDER BY created_at LIMIT ?",
+        (created_before, *backends, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+@instrument_db
+def mark_assets_deleted(objects):
+    """
+    Marks every row of each deleted (backend, object_name) as deleted; one
+    object can back several rows when the generation cache shared it.
+    """
+    now = datetime.now()
+    get_connection().executemany(
+        "UPDATE assets SET deleted_at = ? WHERE backend = ? AND object_name = ? AND deleted_at IS NULL",
+        [(now, backend, object_name) for backend, object_name in objects])
+
+@instrument_db
+def clear_asset_local_paths(paths):
+    """
+    Forgets local copies that were evicted from disk.
+    """
+    get_connection().executemany("UPDATE assets SET local_path = NULL WHERE local_path = ?",
+                                 [(path,) for path in paths])
+
+@instrument_db
+def reserve_credit(line_user_id, amount=1):
+    """
+    Atomically takes `amount` credits from the user if they have that many.
+    Returns a reservation id, or None if the user has too few credits.
+    """
+    now = datetime.now()
+    with transaction() as c:
+        rows = c.execute(
+            "UPDATE users SET credits = credits - ? WHERE line_user_id = ? AND credits >= ? RETURNING credits",
+            (amount, line_user_id, amount)).fetchall()
+        if not rows:
+            return None
+        reservation_id = uuid.uuid4().hex
+        c.execute(
+            "INSERT INTO credit_reservations (id, line_user_id, status, created_at, expires_at, amount) VALUES (?, ?, ?, ?, ?, ?)",
+            (reservation_id, line_user_id, "reserved", now, now + timedelta(seconds=RESERVATION_TTL_SECONDS), amount))
+    CREDITS.inc(amount, action="reserved")
+    log(f"DB: Reserved credit {reservation_id} for {line_user_id} (left: {rows[0]['credits']})")
+    return reservation_id
+
+@instrument_db
+def commit_reservation(reservation_id, prompt=None, used=None):
+    """
+    Marks reserved credits as spent, clears the pending prompt and returns the
+    user's remaining credits. With `prompt`, the pending prompt is only cleared
+    if it is still that prompt (the user may have sent a new one meanwhile).
+    With `used`, only that many of the reserved credits are spent and the rest
+    go back to the user.
+    Returns None if the reservation was no longer reserved (already committed,
+    refunded or expired).
+    """
+    with transaction() as c:
+        rows = c.execute(
+            "UPDATE credit_reservations SET status = 'committed' WHERE id = ? AND status = 'reserved' RETURNING line_user_id, amount",
+            (reservation_id,)).fetchall()
+        if not rows:
+            log(f"DB: Reservation {reservation_id} is not reserved, cannot commit")
+            return None
+        amount = rows[0]["amount"]
+        used = amount if used is None else min(used, amount)
+        users = c.execute(
+            "UPDATE users SET is_free_trial_used = 1, credits = credits + ?, "
+            "pending_prompt = CASE WHEN ? IS NULL OR pending_prompt = ? THEN NULL ELSE pending_prompt END "
+            "WHERE line_user_id = ? RETURNING credits",
+            (amount - used, prompt, prompt, rows[0]["line_user_id"])).fetchall()
+    CREDITS.inc(used, action="spent")
+    if amount > used:
+        CREDITS.inc(amount - used, action="refunded")
+    return users[0]["credits"] if users else None
+
+@instrument_db
+def refund_reservation(reservation_id):
+    """
+    Returns reserved credits to the user. Returns True if credits were refunded.
+    """
+    with transaction() as c:
+        rows = c.execute(
+            "UPDATE credit_reservations SET status = 'refunded' WHERE id = ? AND status = 'reserved' RETURNING line_user_id, amount",
+            (reservation_id,)).fetchall()
+        if not rows:
+            return False
+        c.execute("UPDATE users SET credits = credits + ? WHERE line_user_id = ?",
+                  (rows[0]["amount"], rows[0]["line_user_id"]))
+    CREDITS.inc(rows[0]["amount"], action="refunded")
+    log(f"DB: Refunded reservation {reservation_id}")
+    return True
+
+@instrument_db
+def expire_stale_reservations():
+    """
+    Refunds reservations that were neither committed nor refunded before they expired
+    (e.g. the process died mid-generation). Returns how many were expired.
+    """
+    with transaction() as c:
+        rows = c.execute(
+            "UPDATE credit_reservations SET status = 'expired' WHERE status = 'reserved' AND expires_at < ? RETURNING line_user_id, amount",
+            (datetime.now(),)).fetchall()
+        c.executemany("UPDATE users SET credits = credits + ? WHERE line_user_id = ?",
+                      [(row["amount"], row["line_user_id"]) for row in rows])
+    if rows:
+        CREDITS.inc(sum(row["amount"] for row in rows), action="expired")
+        log(f"DB: Expired {len(rows)} stale credit reservations")
+    return len(rows)
+
+def _job_dict(row):
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+@instrument_db
+def enqueue_job(name, payload, max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Adds a job for the worker processes and returns its id. `payload` must be JSON serialisable.
+    """
+    job_id = uuid.uuid4().hex
+    now = datetime.now()
+    get_connection().execute(
+        "INSERT INTO jobs (id, name, payload, status, attempts, max_attempts, run_after, created_at) "
+        "VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)",
+        (job_id, name, json.dumps(payload), max_attempts, now, now))
+    return job_id
+
+@instrument_db
+def enqueue_job_once(dedup_key, name, payload, max_attempts=JOB_MAX_ATTEMPTS):
+    """
+    Like enqueue_job(), unless a job with `dedup_key` is already queued or
+    running. Returns (job_id, created); job_id is the existing job's when not created.
+    """
+    job_id = uuid.uuid4().hex
+    now = datetime.now()
+    with transaction() as c:
+        inserted = c.execute(
+            "INSERT OR IGNORE INTO jobs (id, name, payload, status, attempts, max_attempts, run_after, created_at, dedup_key) "
+            "VALUES (?, ?, ?, 'queued', 0, ?, ?, ?, ?)",
+            (job_id, name, json.dumps(payload), max_attempts, now, now, dedup_key)).rowcount
+        if inserted:
+            return job_id, True
+        row = c.execute("SELECT id FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running')",
+                        (dedup_key,)).fetchone()
+    return row["id"], False
+
+@instrument_db
+def find_active_job(dedup_key):
+    """
+    Id of the queued or running job with `dedup_key`, or None.
+    """
+    row = get_connection().execute(
+        "SELECT id FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running')", (dedup_key,)).fetchone()
+    return row["id"] if row else None
+
+@instrument_db
+def claim_job(worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Leases the oldest runnable job to `worker_id` and returns it, or None if there
+    is nothing to do. Jobs whose lease expired (the worker died) are runnable
+    again while they have attempts left.
+    """
+    now = datetime.now()
+    with transaction() as c:
+        rows = c.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires_at = ? "
+            "WHERE id = (SELECT id FROM jobs "
+            "  WHERE (status = 'queued' AND run_after <= ?) "
+            "     OR (status = 'running' AND lease_expires_at < ? AND attempts < max_attempts) "
+            "  ORDER BY created_at LIMIT 1) "
+            "RETURNING *",
+            (worker_id, now + timedelta(seconds=lease_seconds), now, now)).fetchall()
+    return _job_dict(rows[0]) if rows else None
+
+@instrument_db
+def heartbeat_job(job_id, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Extends the lease on a running job. Returns False if `worker_id` no longer holds it.
+    """
+    rows = get_connection().execute(
+        "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = 'running' AND lease_owner = ? RETURNING id",
+        (datetime.now() + timedelta(seconds=lease_seconds), job_id, worker_id)).fetchall()
+    return bool(rows)
+
+@instrument_db
+def complete_job(job_id, worker_id):
+    rows = get_connection().execute(
+        "UPDATE jobs SET status = 'succeeded', finished_at = ?, lease_owner = NULL "
+        "WHERE id = ? AND lease_owner = ? RETURNING id",
+        (datetime.now(), job_id, worker_id)).fetchall()
+    return bool(rows)
+
+@instrument_db
+def fail_job(job_id, worker_id, error, retry_delay=0):
+    """
+    Records a failed attempt. The job is queued again after `retry_delay` seconds
+    if it has attempts left, otherwise it is marked failed. Returns the new status.
+    """
+    now = datetime.now()
+    rows = get_connection().execute(
+        "UPDATE jobs SET "
+        "status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END, "
+        "run_after = ?, last_error = ?, lease_owner = NULL, "
+        "finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE ? END "
+        "WHERE id = ? AND lease_owner = ? RETURNING status",
+        (now + timedelta(seconds=retry_delay), str(error), now, job_id, worker_id)).fetchall()
+    return rows[0]["status"] if rows else None
+
+@instrument_db
+def fail_abandoned_jobs():
+    """
+    Marks jobs whose last attempt's lease expired as failed; their credit
+    reservations are refunded by expire_stale_reservations(). Returns how many.
+    """
+    rows = get_connection().execute(
+        "UPDATE jobs SET status = 'failed', last_error = 'lease expired', finished_at = ?, lease_owner = NULL "
+        "WHERE status = 'running' AND lease_expires_at < ? AND attempts >= max_attempts RETURNING id",
+        (datetime.now(), datetime.now())).fetchall()
+    if rows:
+        log(f"DB: Failed {len(rows)} abandoned jobs")
+    return len(rows)
+
+@instrument_db
+def get_job(job_id):
+    row = get_connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _job_dict(row) if row else None
+
+@instrument_db
+def count_jobs(statuses=("queued", "running")):
+    placeholders = ",".join("?" * len(statuses))
+    row = get_connection().execute(
+        f"SELECT COUNT(*) AS n FROM jobs WHERE status IN ({placeholders})", tuple(statuses)).fetchone()
+    return row["n"]
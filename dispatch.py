@@ -0,0 +1,103 @@
+import contextvars
+import os
+import queue
+import threading
+from collections import deque
+
+from metrics import log
+
+# Threads handling webhook events (replies, DB updates, job submission)
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "8"))
+# Events waiting across all users before submit() starts pushing back
+EVENT_QUEUE_LIMIT = int(os.getenv("EVENT_QUEUE_LIMIT", "1000"))
+# How long submit() waits for room before giving up
+EVENT_SUBMIT_TIMEOUT = float(os.getenv("EVENT_SUBMIT_TIMEOUT", "2"))
+
+
+class DispatcherFullError(Exception):
+    pass
+
+
+class KeyedDispatcher:
+    """
+    Runs callables on a fixed pool of worker threads. Work for different keys
+    runs concurrently; work for the same key (a LINE user) runs one at a time
+    in submission order, so a prompt and its "はい" never race.
+    """
+
+    def __init__(self, workers=EVENT_WORKERS, queue_limit=EVENT_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._queues = {}  # key -> deque of pending work; present while the key is scheduled or running
+        self._ready = queue.Queue()  # keys with work and no worker on them
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+        self._threads = []
+        self.rejected = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"event-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        log(f"Event dispatcher started (workers={self.workers}, queue_limit={self.queue_limit})")
+
+    def submit(self, key, func, *args, timeout=EVENT_SUBMIT_TIMEOUT):
+        """
+        Queues func(*args) behind earlier work for `key`. Blocks up to `timeout`
+        seconds while the dispatcher is full, then raises DispatcherFullError.
+        """
+        context = contextvars.copy_context()
+        with self._space:
+            if not self._space.wait_for(lambda: self._pending < self.queue_limit, timeout=timeout):
+                self.rejected += 1
+                raise DispatcherFullError(f"{self._pending} events already queued")
+            self._pending += 1
+            work = self._queues.get(key)
+            if work is None:
+                self._queues[key] = deque([(context, func, args)])
+                self._ready.put(key)
+            else:
+                work.append((context, func, args))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "active_keys": len(self._queues),
+                "workers": self.workers,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self, timeout=None):
+        """
+        Lets queued work finish, then stops the worker threads.
+        """
+        with self._space:
+            if not self._space.wait_for(lambda: self._pending == 0, timeout=timeout):
+                log(f"Dispatcher shutdown timed out with {self._pending} events queued")
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lock:
+                context, func, args = self._queues[key].popleft()
+            try:
+                context.run(func, *args)
+            except Exception as e:
+                log(f"Event handler error for {key}: {e}")
+            with self._space:
+                self._pending -= 1
+                self._space.notify_all()
+                if self._queues[key]:
+                    # More work for this key: go to the back of the line so other users get a turn
+                    self._ready.put(key)
+                else:
+                    del self._queues[key]
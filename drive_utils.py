@@ -1,38 +1,75 @@
+import io
 import os
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+import threading
+import uuid
+import mimetypes
+
+from google_credentials import load_service_account_credentials
+from metrics import log
 
 # User provided folder ID
 FOLDER_ID = "1HHBZ8dtDRGpsyBjjue_S1uK87b-0-bxi"
 SCOPES = ['https://www.googleapis.com/auth/drive']
+# File names looked up per files().list query when deleting
+DRIVE_DELETE_QUERY_BATCH = 50
 
-def upload_to_drive(file_path):
+# httplib2 connections are not thread-safe, so one Drive client per thread
+_local = threading.local()
+
+def get_service():
     """
-    Uploads a file to the specified Google Drive folder and makes it public.
-    Returns the direct view URL.
+    This thread's Drive API client, built on first use and reused.
+    Returns None if GOOGLE_APPLICATION_CREDENTIALS is not set.
     """
-    try:
-        # Get credentials path (set by image_gen.py)
+    service = getattr(_local, "service", None)
+    if service is None:
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+
+        # GOOGLE_APPLICATION_CREDENTIALS_JSON-only hosts get the path set here
+        load_service_account_credentials()
         creds_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
         if not creds_path:
-            print("Error: GOOGLE_APPLICATION_CREDENTIALS not set")
+            log("Error: GOOGLE_APPLICATION_CREDENTIALS not set")
             return None
 
         creds = service_account.Credentials.from_service_account_file(creds_path, scopes=SCOPES)
-        service = build('drive', 'v3', credentials=creds)
+        service = _local.service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+    return service
+
+def upload_to_drive(file_path):
+    """
+    Uploads a file to the specified Google Drive folder and makes it public.
+    Returns the direct view URL.
+    """
+    with open(file_path, "rb") as f:
+        return upload_bytes_to_drive(f.read(), name=os.path.basename(file_path))
 
+def upload_bytes_to_drive(data, content_type="image/png", name=None):
+    """
+    Uploads in-memory image bytes to the Drive folder and makes them public.
+    Returns the direct view URL, or None on failure.
+    """
+    try:
+        from googleapiclient.http import MediaIoBaseUpload
+
+        service = get_service()
+        if service is None:
+            return None
+
+        if not name:
+            name = f"thumbnail_{uuid.uuid4()}{mimetypes.guess_extension(content_type) or '.png'}"
         file_metadata = {
-            'name': os.path.basename(file_path),
+            'name': name,
             'parents': [FOLDER_ID]
         }
-        media = MediaFileUpload(file_path, mimetype='image/png')
+        media = MediaIoBaseUpload(io.BytesIO(data), mimetype=content_type)
         
         # Upload
-        print(f"Uploading {file_metadata['name']} to Drive Folder {FOLDER_ID}...")
+        log(f"Uploading {file_metadata['name']} to Drive Folder {FOLDER_ID}...")
         file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
         file_id = file.get('id')
-        print(f"Upload successful! File ID: {file_id}")
+        log(f"Upload successful! File ID: {file_id}")
         
         # Make public (anyone with link can view)
         permission = {
@@ -40,15 +77,58 @@ def upload_to_drive(file_path):
             'role': 'reader',
         }
         service.permissions().create(fileId=file_id, body=permission).execute()
-        print("File made public.")
+        log("File made public.")
         
         # Return direct link suitable for LINE
         link = f"https://drive.google.com/uc?export=view&id={file_id}"
-        print(f"Returning link: {link}")
+        log(f"Returning link: {link}")
         return link
         
     except Exception as e:
-        print(f"Drive Upload Error: {e}")
+        log(f"Drive Upload Error: {e}")
         import traceback
         traceback.print_exc()
         return None
+
+def _quote(value):
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+def delete_from_drive(names):
+    """
+    Deletes the files called `names` from the Drive folder. Returns the names
+    that are gone, including ones that were already missing.
+    Raises if Drive is not configured.
+    """
+    from googleapiclient.errors import HttpError
+
+    service = get_service()
+    if service is None:
+        raise RuntimeError("Drive is not configured")
+
+    gone = []
+    for start in range(0, len(names), DRIVE_DELETE_QUERY_BATCH):
+        chunk = names[start:start + DRIVE_DELETE_QUERY_BATCH]
+        wanted = " or ".join(f"name = '{_quote(name)}'" for name in chunk)
+        query = f"'{FOLDER_ID}' in parents and trashed = false and ({wanted})"
+        file_ids = {}
+        page_token = None
+        while True:
+            result = service.files().list(q=query, fields="nextPageToken, files(id, name)", pageSize=1000,
+                                          pageToken=page_token).execute()
+            for file in result.get("files", []):
+                file_ids.setdefault(file["name"], []).append(file["id"])
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                break
+
+        for name in chunk:
+            try:
+                for file_id in file_ids.get(name, []):
+                    service.files().delete(fileId=file_id).execute()
+            except HttpError as e:
+                if e.resp.status != 404:
+                    log(f"Drive delete of {name} failed: {e}")
+                    continue
+            gone.append(name)
+    log(f"Deleted {len(gone)}/{len(names)} files from Drive")
+    return gone
@@ -1,62 +1,219 @@
 import os
-from google.cloud import storage
+import asyncio
+import mimetypes
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import log
+from google_credentials import load_service_account_credentials
 
 # Get Project ID from env
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 BUCKET_NAME = f"{PROJECT_ID}-thumbnails" # Unique bucket name
+# Parallel uploads for upload_many (also the size of the HTTP connection pool)
+GCS_UPLOAD_CONCURRENCY = int(os.getenv("GCS_UPLOAD_CONCURRENCY", "8"))
+SIGNED_URL_EXPIRATION = 3600 # 1 hour
+# GCS accepts at most 100 calls per batch request
+GCS_BATCH_SIZE = 100
+
+
+class GCSUploader:
+    """
+    Long-lived uploader that keeps one storage client (and its HTTP connection
+    pool), the bucket handle, and whether the bucket accepts public ACLs or
+    needs signed URLs, so each upload is a single upload request plus at most
+    one ACL call.
+    """
+
+    def __init__(self, bucket_name=BUCKET_NAME, client=None, concurrency=GCS_UPLOAD_CONCURRENCY):
+        self.bucket_name = bucket_name
+        self.concurrency = concurrency
+        self._client = client
+        self._bucket = None
+        self._url_mode = None  # None (unknown), "public" or "signed"
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                # google-cloud-storage is slow to import; only load it for the first upload
+                from google.cloud import storage
+                from requests.adapters import HTTPAdapter
+
+                # It will automatically use GOOGLE_APPLICATION_CREDENTIALS
+                load_service_account_credentials()
+                self._client = storage.Client()
+                # Size the underlying requests session pool for concurrent uploads
+                adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+                self._client._http.mount("https://", adapter)
+                self._client._http.mount("http://", adapter)
+            return self._client
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            client = self.client
+            with self._lock:
+                if self._bucket is None:
+                    from google.api_core import exceptions as gcs_exceptions
+
+                    # Get or Create Bucket
+                    try:
+                        self._bucket = client.get_bucket(self.bucket_name)
+                    except gcs_exceptions.NotFound:
+                        log(f"Bucket {self.bucket_name} not found. Creating...")
+                        self._bucket = client.create_bucket(self.bucket_name, location="US") # or ASIA
+        return self._bucket
+
+    def upload_bytes(self, data, content_type="image/png", blob_name=None):
+        """
+        Uploads `data` and returns a URL LINE can fetch. Raises on failure.
+        """
+        # Blob Name (Unique)
+        if not blob_name:
+            extension = mimetypes.guess_extension(content_type) or ".png"
+            blob_name = f"thumbnail_{uuid.uuid4()}{extension}"
+        blob = self.bucket.blob(blob_name)
+
+        log(f"Uploading to GCS Bucket: {self.bucket_name}...")
+        blob.upload_from_string(data, content_type=content_type)
+        url = self._url_for(blob)
+        log(f"Upload successful! URL: {url}")
+        return url
+
+    def sign_url(self, blob_name, expiration=SIGNED_URL_EXPIRATION):
+        blob = self.bucket.blob(blob_name)
+        return blob.generate_signed_url(version="v4", expiration=expiration, method="GET")
+
+    @property
+    def signed_urls(self):
+        """
+        True once uploads get signed (expiring) URLs instead of public ones.
+        """
+        return self._url_mode == "signed"
+
+    def delete_many(self, blob_names):
+        """
+        Deletes blobs, GCS_BATCH_SIZE per batch request. Returns the names that
+        are gone (deleted now or already missing); the rest failed.
+        """
+        from google.api_core.exceptions import NotFound
+
+        # Resolve the bucket first; inside a batch its lookup would be deferred too
+        bucket = self.bucket
+        gone = []
+        for start in range(0, len(blob_names), GCS_BATCH_SIZE):
+            chunk = blob_names[start:start + GCS_BATCH_SIZE]
+            try:
+                with self.client.batch():
+                    for name in chunk:
+                        bucket.blob(name).delete()
+                gone.extend(chunk)
+                continue
+            except Exception as e:
+                # The batch only reports its last error (often a 404 for an already
+                # deleted blob), so settle this chunk blob by blob
+                log(f"GCS batch delete incomplete, checking each blob: {e}")
+            for name in chunk:
+                try:
+                    bucket.blob(name).delete()
+                except NotFound:
+                    pass
+                except Exception as e:
+                    log(f"GCS delete of {name} failed: {e}")
+                    continue
+                gone.append(name)
+        return gone
+
+    def upload_many(self, items, content_type="image/png"):
+        """
+        Uploads several images concurrently. Items are byte strings or
+        (bytes, content_type) tuples. Returns a list of URLs in the same order,
+        with None for uploads that failed.
+        """
+        pool = self._get_pool()
+        futures = [pool.submit(self._timed_upload, item, content_type) for item in items]
+        return [future.result() for future in futures]
+
+    async def upload_many_async(self, items, content_type="image/png"):
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        return await asyncio.gather(*[
+            loop.run_in_executor(pool, self._timed_upload, item, content_type) for item in items
+        ])
+
+    def _timed_upload(self, item, content_type):
+        data, content_type = item if isinstance(item, tuple) else (item, content_type)
+        start = time.perf_counter()
+        try:
+            return self.upload_bytes(data, content_type)
+        except Exception as e:
+            log(f"GCS Upload Error: {e}")
+            return None
+        finally:
+            log(f"GCS upload took {time.perf_counter() - start:.3f}s ({len(data)} bytes)")
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="gcs")
+            return self._pool
+
+    def _url_for(self, blob):
+        # Make Public (Legacy method, or use IAM)
+        # Note: 'publicRead' is rejected when 'Uniform Bucket-Level Access' is on.
+        # Once we've seen that, go straight to signed URLs for every later upload.
+        if self._url_mode != "signed":
+            from google.api_core import exceptions as gcs_exceptions
+
+            try:
+                blob.make_public()
+                self._url_mode = "public"
+                return blob.public_url
+            except (gcs_exceptions.BadRequest, gcs_exceptions.Forbidden) as e:
+                log(f"Could not make blob public via ACL, using signed URLs from now on: {e}")
+                self._url_mode = "signed"
+        # Signed URL is SAFER and EASIER (valid for 1 hour).
+        return blob.generate_signed_url(
+            version="v4",
+            expiration=SIGNED_URL_EXPIRATION,
+            method="GET"
+        )
+
+
+_uploader = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader():
+    global _uploader
+    with _uploader_lock:
+        if _uploader is None:
+            _uploader = GCSUploader()
+    return _uploader
+
 
 def upload_to_gcs(file_path):
     """
     Uploads a file to Google Cloud Storage and makes it public.
     Returns the public URL.
     """
+    with open(file_path, "rb") as f:
+        return upload_bytes_to_gcs(f.read())
+
+def upload_bytes_to_gcs(data, content_type="image/png"):
+    """
+    Uploads in-memory image bytes to Google Cloud Storage and makes them public.
+    Returns the public URL, or None on failure.
+    """
     try:
-        # Initialize client
-        # It will automatically use GOOGLE_APPLICATION_CREDENTIALS
-        storage_client = storage.Client()
-        
-        # Get or Create Bucket
-        try:
-            bucket = storage_client.get_bucket(BUCKET_NAME)
-        except:
-            print(f"Bucket {BUCKET_NAME} not found. Creating...")
-            bucket = storage_client.create_bucket(BUCKET_NAME, location="US") # or ASIA
-            
-        # Blob Name (Unique)
-        blob_name = f"thumbnail_{uuid.uuid4()}.png"
-        blob = bucket.blob(blob_name)
-        
-        print(f"Uploading to GCS Bucket: {BUCKET_NAME}...")
-        blob.upload_from_filename(file_path)
-        
-        # Make Public (Legacy method, or use IAM)
-        # For simplicity, we'll try to make the object public reader
-        # Note: 'publicRead' might be disabled by 'Uniform Bucket-Level Access'
-        # If so, we need to use the public URL format if the bucket allows it.
-        
-        try:
-            blob.make_public()
-            url = blob.public_url
-        except Exception as e:
-            print(f"Could not make blob public via ACL: {e}")
-            # Fallback: If Uniform Bucket Level Access is on, we can't use ACLs.
-            # We assume the user might need to make the bucket public manually if this fails.
-            # Or we can return a signed URL (valid for 1 hour).
-            # Signed URL is SAFER and EASIER.
-            
-            print("Generating Signed URL...")
-            url = blob.generate_signed_url(
-                version="v4",
-                expiration=3600, # 1 hour
-                method="GET"
-            )
-            
-        print(f"Upload successful! URL: {url}")
-        return url
-        
+        return get_uploader().upload_bytes(data, content_type)
     except Exception as e:
-        print(f"GCS Upload Error: {e}")
+        log(f"GCS Upload Error: {e}")
         import traceback
         traceback.print_exc()
         return None
@@ -0,0 +1,134 @@
+import os
+import random
+import threading
+import time
+
+from metrics import log, Counter, Histogram
+
+# Overridable so benchmarks can point the client at a local fake
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+# Requests per minute allowed to start across all jobs, and how many may start back to back.
+# These limits are per process: with JOB_BACKEND=sqlite each worker process has its own
+# limiter, so divide the account's quota by WORKER_PROCESSES.
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_BURST = int(os.getenv("GEMINI_BURST", "5"))
+# Requests in flight at once across all jobs in the process
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "4"))
+# Per-call HTTP timeout; 4K generations regularly take 20-40s
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "120"))
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "4"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+GEMINI_QUEUE_SECONDS = Histogram("thumbnail_gemini_queue_seconds", "Time spent waiting for the Gemini rate limiter")
+GEMINI_REQUESTS = Counter("thumbnail_gemini_requests_total", "Gemini requests by outcome", ["result"])
+GEMINI_RETRIES = Counter("thumbnail_gemini_retries_total", "Gemini retries by reason", ["reason"])
+
+
+class RateLimiter:
+    """
+    Token bucket (`rate` starts per second, up to `burst` at once) combined with a
+    cap on concurrent calls. Shared by every job in the process.
+    """
+
+    def __init__(self, rate, burst, concurrency):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self.waiting = 0
+
+    def acquire(self):
+        """
+        Blocks until a call may start. Returns the seconds spent waiting.
+        """
+        start = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        try:
+            self._slots.acquire()
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    delay = (1 - self._tokens) / self.rate
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        return time.monotonic() - start
+
+    def release(self):
+        self._slots.release()
+
+
+def _retry_reason(error):
+    """
+    Short reason string if `error` is worth retrying, otherwise None.
+    """
+    import httpx
+    from google.genai import errors
+
+    if isinstance(error, errors.APIError):
+        return str(error.code) if error.code in RETRYABLE_STATUS else None
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.TransportError):
+        return "connection"
+    return None
+
+
+class GeminiClient:
+    """
+    Wraps genai.Client.models.generate_content with a shared rate limiter,
+    per-call timeouts and jittered exponential backoff on 429 / 5xx / timeouts.
+    """
+
+    def __init__(self, api_key=None, base_url=GEMINI_BASE_URL, rpm=GEMINI_RPM, burst=GEMINI_BURST,
+                 concurrency=GEMINI_CONCURRENCY, timeout=GEMINI_TIMEOUT_SECONDS, max_attempts=GEMINI_MAX_ATTEMPTS,
+                 backoff_base=GEMINI_BACKOFF_BASE, backoff_max=GEMINI_BACKOFF_MAX):
+        # google-genai takes ~0.5s to import, so only load it once a client is needed
+        from google import genai
+        from google.genai import types
+
+        http_options = types.HttpOptions(base_url=base_url, timeout=int(timeout * 1000))
+        self.client = genai.Client(api_key=api_key, http_options=http_options)
+        self.limiter = RateLimiter(rpm / 60, burst, concurrency)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def generate_content(self, **kwargs):
+        attempt = 1
+        while True:
+            GEMINI_QUEUE_SECONDS.observe(self.limiter.acquire())
+            try:
+                response = self.client.models.generate_content(**kwargs)
+            except Exception as e:
+                reason = _retry_reason(e)
+                if reason is None or attempt >= self.max_attempts:
+                    GEMINI_REQUESTS.inc(result="error")
+                    raise
+                GEMINI_RETRIES.inc(reason=reason)
+                # Full jitter keeps retrying jobs from synchronising into a new burst
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+                log(f"Gemini request failed ({reason}), retry {attempt}/{self.max_attempts - 1} in {delay:.1f}s: {e}")
+            else:
+                GEMINI_REQUESTS.inc(result="success")
+                return response
+            finally:
+                # Don't hold a concurrency slot while backing off
+                self.limiter.release()
+            time.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        return {"waiting": self.limiter.waiting}
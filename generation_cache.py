@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+
+# Opt-in: repeated prompts reuse the stored image (and uploaded URL) instead of calling Gemini
+GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+GENERATION_CACHE_DIR = os.getenv("GENERATION_CACHE_DIR", os.path.join(os.path.dirname(__file__), "cache", "generations"))
+GENERATION_CACHE_MAX_BYTES = int(os.getenv("GENERATION_CACHE_MAX_BYTES", str(500 * 1024 * 1024)))
+# Uploaded URLs are reused for at most this long after upload
+GENERATION_CACHE_URL_MAX_AGE = int(os.getenv("GENERATION_CACHE_URL_MAX_AGE", "3000"))
+# ...and only while every signed URL in the entry stays valid at least this much longer,
+# so LINE can still fetch the image after it is delivered
+GENERATION_CACHE_URL_MIN_TTL = int(os.getenv("GENERATION_CACHE_URL_MIN_TTL", "900"))
+
+
+def normalize_prompt(text):
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+def cache_key(prompt, model, aspect_ratio, image_size, *extra):
+    # `extra` (e.g. a variation index) is only part of the key when given, so older keys stay valid
+    material = json.dumps([normalize_prompt(prompt), model, aspect_ratio, image_size, *extra], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """
+    Content-addressed on-disk cache of generated images, evicted least recently
+    used first once the directory grows past `max_bytes`.
+    """
+
+    def __init__(self, directory=GENERATION_CACHE_DIR, max_bytes=GENERATION_CACHE_MAX_BYTES,
+                 url_max_age=GENERATION_CACHE_URL_MAX_AGE, url_min_ttl=GENERATION_CACHE_URL_MIN_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.url_max_age = url_max_age
+        self.url_min_ttl = url_min_ttl
+        self.hits = 0
+        self.misses = 0
+        self.url_hits = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_image(self, key):
+        path = self._path(key, ".png")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put_image(self, key, data):
+        self._write_atomic(self._path(key, ".png"), data)
+        self._evict()
+
+    def get_urls(self, key):
+        path = self._path(key, ".json")
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        now = time.time()
+        expires_at = entry.get("expires_at")
+        if now - entry["stored_at"] > self.url_max_age or (expires_at and expires_at - now < self.url_min_ttl):
+            return None
+        with self._lock:
+            self.url_hits += 1
+        return entry["urls"]
+
+    def put_urls(self, key, urls):
+        """
+        Stores the uploaded URLs for `key` (a dict, e.g. {"original": ..., "preview": ...}).
+        The entry expires with the first of its signed URLs (the "expires_at" of
+        each asset in urls["assets"], when present).
+        """
+        expiries = [asset["expires_at"] for asset in (urls.get("assets") or {}).values() if asset.get("expires_at")]
+        entry = json.dumps({"urls": urls, "stored_at": time.time(), "expires_at": min(expiries, default=None)})
+        self._write_atomic(self._path(key, ".json"), entry.encode("utf-8"))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "url_hits": self.url_hits,
+                "evictions": self.evictions,
+            }
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _write_atomic(self, path, data):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".png"):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                for stale in (path, path[:-len(".png")] + ".json"):
+                    try:
+                        os.remove(stale)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                self.evictions += 1
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the shared cache, or None when GENERATION_CACHE_ENABLED is off.
+    """
+    global _cache
+    if not GENERATION_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = GenerationCache()
+    return _cache
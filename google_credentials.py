@@ -0,0 +1,29 @@
+import os
+import threading
+
+from metrics import log
+
+_credentials_loaded = False
+_credentials_lock = threading.Lock()
+
+
+def load_service_account_credentials():
+    """
+    Writes GOOGLE_APPLICATION_CREDENTIALS_JSON (if set) to a temp file and points
+    GOOGLE_APPLICATION_CREDENTIALS at it, for hosts that only take env vars.
+    Called by every Google client (GCS, Drive) before it is built.
+    """
+    global _credentials_loaded
+    with _credentials_lock:
+        if _credentials_loaded:
+            return
+        _credentials_loaded = True
+        creds_json = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
+        if creds_json:
+            import tempfile
+            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as temp:
+                temp.write(creds_json)
+                temp_path = temp.name
+
+            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = temp_path
+            log(f"Loaded Service Account credentials to {temp_path}")
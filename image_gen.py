@@ -1,79 +1,111 @@
 import os
-import time
-from google import genai
-from google.genai import types
+import threading
+from gemini_client import GeminiClient
+from generation_cache import get_cache, cache_key
+from metrics import log, timed
 
 # Configuration
 # Configuration
 # User strictly requested this model via AI Studio API
 IMAGE_MODEL_ID = "gemini-3-pro-image-preview"
+ASPECT_RATIO = "16:9"
+IMAGE_SIZE = "4K"
+# Fast, small rendition used for progressive delivery drafts
+DRAFT_IMAGE_SIZE = os.getenv("DRAFT_IMAGE_SIZE", "1K")
 
 _client = None
+_client_lock = threading.Lock()
 
 def get_client():
+    """
+    The process-wide GeminiClient. Its rate limiter is shared by every job and
+    variation thread in this process, but not across worker processes.
+    """
     global _client
-    if _client is None:
-        # Use AI Studio API Key
-        api_key = os.environ.get("GOOGLE_API")
-        if not api_key:
-            print("Warning: GOOGLE_API environment variable not set.")
-        
-        _client = genai.Client(api_key=api_key)
+    with _client_lock:
+        if _client is None:
+            # Use AI Studio API Key
+            api_key = os.environ.get("GOOGLE_API")
+            if not api_key:
+                log("Warning: GOOGLE_API environment variable not set.")
+
+            # Rate limited and retried; shared by every generation job in the process
+            _client = GeminiClient(api_key=api_key)
     return _client
 
-def generate_thumbnail(user_text: str) -> str:
+def generation_cache_key(user_text: str, variant: int = 0, image_size: str = IMAGE_SIZE, seed: int = None) -> str:
+    """
+    Cache key for `user_text` under the current model configuration. Each
+    variation of a prompt (variant 1, 2, ...) and each explicit seed is cached separately.
+    """
+    extra = (variant,) if variant else ()
+    if seed is not None:
+        extra += ("seed", seed)
+    return cache_key(user_text, IMAGE_MODEL_ID, ASPECT_RATIO, image_size, *extra)
+
+def generate_thumbnail(user_text: str, variant: int = 0, image_size: str = IMAGE_SIZE, seed: int = None) -> bytes:
     """
     Generates a YouTube thumbnail using Gemini 3 Pro Image Preview via AI Studio.
+    `variant` distinguishes the images of a multi-variation request in the cache.
+    `image_size` ("1K", "2K", "4K") trades detail for latency; passing the same
+    `seed` for a draft and its final keeps them as close as the model allows.
+    Returns the PNG bytes; nothing is written to disk here (see artifact_store).
     """
+    from google.genai import types
+
     client = get_client()
     
-    output_dir = os.path.join(os.path.dirname(__file__), "static", "generated")
-    os.makedirs(output_dir, exist_ok=True)
-    
-    filename = f"thumb_{int(time.time())}.png"
-    output_path = os.path.join(output_dir, filename)
-    
+    cache = get_cache()
+    if cache:
+        key = generation_cache_key(user_text, variant, image_size, seed)
+        cached = cache.get_image(key)
+        if cached:
+            log(f"Generation cache hit ({len(cached)} bytes)")
+            return cached
+
     try:
         # User requested Japanese prompt and strict usage of this model
         prompt = f"高品質なYouTubeサムネイル, 8K, 鮮やかな色: {user_text}"
-        print(f"Sending request to {IMAGE_MODEL_ID} with prompt: {prompt[:50]}...")
+        log(f"Sending request to {IMAGE_MODEL_ID} with prompt: {prompt[:50]}...")
         
-        response = client.models.generate_content(
-            model=IMAGE_MODEL_ID,
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                image_config=types.ImageConfig(
-                    aspect_ratio="16:9",
-                    image_size="4K"
+        with timed("gemini"):
+            response = client.generate_content(
+                model=IMAGE_MODEL_ID,
+                contents=prompt,
+                config=types.GenerateContentConfig(
+                    seed=seed,
+                    image_config=types.ImageConfig(
+                        aspect_ratio=ASPECT_RATIO,
+                        image_size=image_size
+                    )
                 )
             )
-        )
         
         # Extract image from response
-        image_data = None
-        if response.parts:
-            for part in response.parts:
-                if part.inline_data:
-                    image_data = part.inline_data.data
-                    break
-        
-        if not image_data and response.candidates:
-             for part in response.candidates[0].content.parts:
-                 if part.inline_data:
-                     image_data = part.inline_data.data
-                     break
+        with timed("image_extract"):
+            image_data = None
+            if response.parts:
+                for part in response.parts:
+                    if part.inline_data:
+                        image_data = part.inline_data.data
+                        break
+            
+            if not image_data and response.candidates:
+                 for part in response.candidates[0].content.parts:
+                     if part.inline_data:
+                         image_data = part.inline_data.data
+                         break
 
         if image_data:
-            print(f"Image generated! Size: {len(image_data)} bytes")
-            with open(output_path, "wb") as f:
-                f.write(image_data)
-            print(f"Image saved locally to: {output_path}")
-            return output_path
+            log(f"Image generated! Size: {len(image_data)} bytes")
+            if cache:
+                cache.put_image(key, image_data)
+            return image_data
         else:
-            print("Gemini returned no inline image data.")
-            print(f"Response: {response}")
+            log("Gemini returned no inline image data.")
+            log(f"Response: {response}")
             raise Exception("No image generated")
 
     except Exception as e:
-        print(f"Gemini 3 Generation Error: {e}")
+        log(f"Gemini 3 Generation Error: {e}")
         raise e
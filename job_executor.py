@@ -0,0 +1,281 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from database import enqueue_job, enqueue_job_once, find_active_job, get_job, count_jobs
+from metrics import log, trace_id_var
+
+# How many generation jobs may run at the same time (each one holds a thread
+# for the blocking Gemini / GCS / LINE SDK calls).
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", "4"))
+# Maximum number of queued + running jobs before new submissions are rejected.
+GENERATION_QUEUE_LIMIT = int(os.getenv("GENERATION_QUEUE_LIMIT", "100"))
+# How many finished jobs are kept around for status lookups.
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", "1000"))
+# "inprocess" runs jobs on this process's JobExecutor; "sqlite" queues them in
+# the jobs table for `python -m worker` processes.
+JOB_BACKEND = os.getenv("JOB_BACKEND", "inprocess")
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, name, func, args, kwargs, dedup_key=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.dedup_key = dedup_key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"  # queued -> running -> succeeded / failed
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Run the job in the submitter's context so it keeps the webhook's trace ID
+        self.context = contextvars.copy_context()
+        self.trace_id = trace_id_var.get()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobExecutor:
+    """
+    Runs blocking jobs on a thread pool, scheduled from the asyncio event loop.
+    At most `concurrency` jobs run at once; the rest wait on a semaphore.
+    `submit` is thread-safe so it can be called from webhook handler threads.
+    """
+
+    def __init__(self, concurrency=GENERATION_CONCURRENCY, queue_limit=GENERATION_QUEUE_LIMIT,
+                 history_size=JOB_HISTORY_SIZE):
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.history_size = history_size
+        self._loop = None
+        self._pool = None
+        self._semaphore = None
+        self._jobs = OrderedDict()
+        # dedup_key -> queued / running job, see submit_once
+        self._inflight = {}
+        self._tasks = set()
+        self._active = 0
+        self._accepting = False
+        self._lock = threading.Lock()
+
+    def start(self, loop=None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="job")
+        self._accepting = True
+        log(f"Job executor started (concurrency={self.concurrency}, queue_limit={self.queue_limit})")
+
+    def submit(self, name, func, *args, **kwargs):
+        return self._submit(None, name, func, args, kwargs)[0]
+
+    def submit_once(self, dedup_key, name, func, *args, **kwargs):
+        """
+        Submits a job unless one with `dedup_key` is still queued or running.
+        Returns (job, created); job is the in-flight one when not created.
+        """
+        return self._submit(dedup_key, name, func, args, kwargs)
+
+    def find(self, dedup_key):
+        """
+        The queued or running job with `dedup_key`, or None.
+        """
+        with self._lock:
+            return self._inflight.get(dedup_key)
+
+    def _submit(self, dedup_key, name, func, args, kwargs):
+        with self._lock:
+            if not self._accepting:
+                raise RuntimeError("Job executor is not accepting jobs")
+            if dedup_key is not None and dedup_key in self._inflight:
+                return self._inflight[dedup_key], False
+            if self._active >= self.queue_limit:
+                raise QueueFullError(f"{self._active} jobs already queued")
+            job = Job(name, func, args, kwargs, dedup_key)
+            if dedup_key is not None:
+                self._inflight[dedup_key] = job
+            self._active += 1
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history_size:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest.status in ("queued", "running"):
+                    break
+                del self._jobs[oldest_id]
+
+        if self._on_loop_thread():
+            self._schedule(job)
+        else:
+            self._loop.call_soon_threadsafe(self._schedule, job)
+        log(f"Job {job.id} ({name}) queued")
+        return job, True
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job.status == "running")
+            return {
+                "active": self._active,
+                "running": running,
+                "queued": self._active - running,
+                "concurrency": self.concurrency,
+            }
+
+    async def drain(self, timeout=None):
+        """
+        Stops accepting new jobs and waits for queued and running jobs to finish.
+        """
+        with self._lock:
+            self._accepting = False
+        # Let any submissions scheduled via call_soon_threadsafe create their tasks.
+        await asyncio.sleep(0)
+        pending = set(self._tasks)
+        if pending:
+            log(f"Draining {len(pending)} jobs...")
+            done, not_done = await asyncio.wait(pending, timeout=timeout)
+            if not_done:
+                log(f"Drain timed out, {len(not_done)} jobs still running")
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _on_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _schedule(self, job):
+        task = self._loop.create_task(self._run(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job):
+        try:
+            async with self._semaphore:
+                job.status = "running"
+                job.started_at = time.time()
+                call = functools.partial(job.context.run, job.func, *job.args, **job.kwargs)
+                try:
+                    await self._loop.run_in_executor(self._pool, call)
+                    job.status = "succeeded"
+                except Exception as e:
+                    job.status = "failed"
+                    job.error = str(e)
+                    log(f"Job {job.id} ({job.name}) failed: {e}")
+                finally:
+                    job.finished_at = time.time()
+                    log(f"Job {job.id} ({job.name}) {job.status} in {job.finished_at - job.started_at:.1f}s")
+                    # Finished jobs stay in the history for /jobs/{id}; only keep their status.
+                    # The arguments can hold large values (e.g. a speculation Future with the image bytes).
+                    job.func = job.args = job.kwargs = job.context = None
+        finally:
+            with self._lock:
+                self._active -= 1
+                if job.dedup_key is not None:
+                    self._inflight.pop(job.dedup_key, None)
+
+
+class StoredJob:
+    def __init__(self, row):
+        self.id = row["id"]
+        self.name = row["name"]
+        self.status = row["status"]
+        self.row = row
+
+    def to_dict(self):
+        row = self.row
+        return {
+            "id": row["id"],
+            "trace_id": row["payload"].get("trace_id"),
+            "name": row["name"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "error": row["last_error"],
+            "created_at": row["created_at"],
+            "finished_at": row["finished_at"],
+        }
+
+
+class SQLiteJobQueue:
+    """
+    Same submit / submit_once / find / get / stats / drain surface as JobExecutor, but jobs go to the
+    durable jobs table and run in `python -m worker` processes. Jobs are looked
+    up there by name (see worker.JOB_HANDLERS), so `func` is not stored and the
+    arguments must be JSON serialisable.
+    """
+
+    def __init__(self, queue_limit=GENERATION_QUEUE_LIMIT):
+        self.queue_limit = queue_limit
+
+    def start(self, loop=None):
+        log(f"Jobs go to the SQLite queue (queue_limit={self.queue_limit})")
+
+    def submit(self, name, func, *args):
+        if count_jobs() >= self.queue_limit:
+            raise QueueFullError(f"{self.queue_limit} jobs already queued")
+        job_id = enqueue_job(name, {"args": list(args), "trace_id": trace_id_var.get()})
+        log(f"Job {job_id} ({name}) queued for workers")
+        return StoredJob(get_job(job_id))
+
+    def submit_once(self, dedup_key, name, func, *args):
+        """
+        Queues a job unless one with `dedup_key` is still queued or running, in
+        any process. Returns (job, created).
+        """
+        job_id = find_active_job(dedup_key)
+        if job_id is None:
+            if count_jobs() >= self.queue_limit:
+                raise QueueFullError(f"{self.queue_limit} jobs already queued")
+            job_id, created = enqueue_job_once(dedup_key, name, {"args": list(args), "trace_id": trace_id_var.get()})
+        else:
+            created = False
+        if created:
+            log(f"Job {job_id} ({name}) queued for workers")
+        return StoredJob(get_job(job_id)), created
+
+    def find(self, dedup_key):
+        job_id = find_active_job(dedup_key)
+        return self.get(job_id) if job_id else None
+
+    def get(self, job_id):
+        row = get_job(job_id)
+        return StoredJob(row) if row else None
+
+    def stats(self):
+        return {
+            "queued": count_jobs(("queued",)),
+            "running": count_jobs(("running",)),
+            "failed": count_jobs(("failed",)),
+        }
+
+    async def drain(self, timeout=None):
+        # Queued jobs are durable; workers keep processing them
+        pass
+
+
+def create_executor():
+    if JOB_BACKEND == "sqlite":
+        return SQLiteJobQueue()
+    return JobExecutor()
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from metrics import log, Counter, Histogram
+
+# Overridable so benchmarks can point the bot at a local fake
+LINE_API_ENDPOINT = os.getenv("LINE_API_ENDPOINT", "https://api.line.me")
+# Keep-alive connections to the LINE API shared by every job and webhook handler
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", "32"))
+LINE_TIMEOUT_SECONDS = float(os.getenv("LINE_TIMEOUT_SECONDS", "10"))
+LINE_MAX_ATTEMPTS = int(os.getenv("LINE_MAX_ATTEMPTS", "4"))
+LINE_BACKOFF_BASE = float(os.getenv("LINE_BACKOFF_BASE", "0.5"))
+LINE_BACKOFF_MAX = float(os.getenv("LINE_BACKOFF_MAX", "8"))
+# The multicast API takes at most 500 recipients per request
+MULTICAST_BATCH_SIZE = 500
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+LINE_REQUESTS = Counter("thumbnail_line_requests_total", "LINE API requests by endpoint and outcome",
+                        ["endpoint", "result"])
+LINE_RETRIES = Counter("thumbnail_line_retries_total", "LINE API retries by reason", ["reason"])
+LINE_REQUEST_SECONDS = Histogram("thumbnail_line_request_seconds", "LINE API call latency including retries",
+                                 ["endpoint"])
+
+
+class LineApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"LINE API error {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+def _as_json(messages):
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    return [message if isinstance(message, dict) else message.as_json_dict() for message in messages]
+
+
+class AsyncLineClient:
+    """
+    LINE Messaging API client on one pooled aiohttp session. Retries 429 / 5xx /
+    connection errors with jittered exponential backoff. Push and multicast
+    requests carry an X-Line-Retry-Key, so a retry of a request LINE already
+    accepted is answered with 409 instead of delivering the message twice.
+    Messages are linebot.models send messages or plain dicts.
+    """
+
+    def __init__(self, access_token, endpoint=LINE_API_ENDPOINT, pool_size=LINE_POOL_SIZE,
+                 timeout=LINE_TIMEOUT_SECONDS, max_attempts=LINE_MAX_ATTEMPTS, backoff_base=LINE_BACKOFF_BASE,
+                 backoff_max=LINE_BACKOFF_MAX):
+        self.endpoint = endpoint.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._session = None
+
+    async def reply_message(self, reply_token, messages):
+        await self._post("/v2/bot/message/reply", "reply", {"replyToken": reply_token, "messages": _as_json(messages)})
+
+    async def push_message(self, to, messages, retry_key=None):
+        await self._post("/v2/bot/message/push", "push", {"to": to, "messages": _as_json(messages)},
+                         retry_key or str(uuid.uuid4()))
+
+    async def multicast(self, to, messages):
+        """
+        Sends `messages` to every user in `to`, MULTICAST_BATCH_SIZE recipients per
+        request, with the batches in flight concurrently. Returns the user IDs of
+        batches that failed for good.
+        """
+        messages = _as_json(messages)
+        batches = [list(to[i:i + MULTICAST_BATCH_SIZE]) for i in range(0, len(to), MULTICAST_BATCH_SIZE)]
+        results = await asyncio.gather(*[
+            self._post("/v2/bot/message/multicast", "multicast", {"to": batch, "messages": messages},
+                       str(uuid.uuid4()))
+            for batch in batches
+        ], return_exceptions=True)
+        failed = []
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                log(f"Multicast to {len(batch)} users failed: {result}")
+                failed.extend(batch)
+        return failed
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if self._session is None:
+            # aiohttp is only needed once the first message goes out
+            import aiohttp
+
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _post(self, path, endpoint, payload, retry_key=None):
+        import aiohttp
+
+        body = json.dumps(payload)
+        headers = {"X-Line-Retry-Key": retry_key} if retry_key else None
+        start = time.perf_counter()
+        attempt = 1
+        while True:
+            try:
+                async with self._get_session().post(self.endpoint + path, data=body, headers=headers) as response:
+                    status = response.status
+                    text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, text = None, str(e) or type(e).__name__
+                reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection"
+            else:
+                reason = str(status) if status in RETRYABLE_STATUS else None
+
+            if status == 200 or (status == 409 and retry_key and attempt > 1):
+                # 409 on a retry: an earlier attempt went through and only its response was lost
+                LINE_REQUESTS.inc(endpoint=endpoint, result="success")
+                LINE_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+                return
+            if reason is None or attempt >= self.max_attempts:
+                LINE_REQUESTS.inc(endpoint=endpoint, result="error")
+                raise LineApiError(status, _error_message(text))
+            LINE_RETRIES.inc(reason=reason)
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+            log(f"LINE {endpoint} failed ({reason}), retry {attempt}/{self.max_attempts - 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def _error_message(text):
+    try:
+        return json.loads(text).get("message", text)
+    except (ValueError, AttributeError):
+        return text
+
+
+class LineMessenger:
+    """
+    Blocking facade over AsyncLineClient for the webhook handlers and job
+    threads: calls run on one background event loop, so every thread shares the
+    same connection pool. Same call shape as LineBotApi's reply/push/multicast.
+    The loop starts on first use, after any worker processes have forked.
+    """
+
+    def __init__(self, access_token, endpoint=LINE_API_ENDPOINT, **client_options):
+        self.client = AsyncLineClient(access_token, endpoint, **client_options)
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def reply_message(self, reply_token, messages):
+        return self._run(self.client.reply_message(reply_token, messages))
+
+    def push_message(self, to, messages, retry_key=None):
+        return self._run(self.client.push_message(to, messages, retry_key))
+
+    def multicast(self, to, messages):
+        return self._run(self.client.multicast(list(to), messages))
+
+    def close(self):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.client.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop()).result()
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="line-client", daemon=True).start()
+                self._loop = loop
+            return self._loop
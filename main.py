@@ -1,32 +1,37 @@
+import asyncio
 import os
 import sys
+from datetime import datetime, timedelta
 from fastapi import FastAPI, Request, HTTPException, Header
-from linebot import LineBotApi, WebhookHandler
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage, FollowEvent, ImageSendMessage
+from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageSendMessage, FollowEvent
 from dotenv import load_dotenv
 
+# Load .env before importing modules that read configuration at import time
+load_dotenv()
+
 #
 # Add parent dir to path to import other modules if needed
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from database import init_db, get_user, create_user, add_credits, decrement_credit, set_pending_prompt, get_pending_prompt, clear_pending_prompt
+from database import create_user, save_draft, claim_draft_upgrade, reserve_credit, refund_reservation, expire_stale_reservations, fail_abandoned_jobs
+from stripe_utils import receive_stripe_webhook, apply_stripe_event, replay_pending_stripe_events, get_payment_link
+from job_executor import create_executor, QueueFullError, JOB_BACKEND
+from dispatch import KeyedDispatcher, DispatcherFullError
+from pipeline import line_bot_api, run_generation_job, run_upgrade_job, parse_variations, PROGRESSIVE, PROGRESSIVE_DELIVERY, DRAFT_UPGRADE_TTL_SECONDS
+from renditions import shutdown_pool as shutdown_rendition_pool
 from image_gen import generate_thumbnail
-from stripe_utils import handle_stripe_webhook, get_payment_link
-from gcs_utils import upload_to_gcs
-
-load_dotenv()
-
-# Setup Google Credentials for GCS (Service Account)
-creds_json = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
-if creds_json:
-    import tempfile
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as temp:
-        temp.write(creds_json)
-        temp_path = temp.name
-    
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = temp_path
-    print(f"Loaded Service Account credentials to {temp_path}")
+from speculative import SpeculativeGenerator, SPECULATIVE_GENERATION
+from generation_cache import get_cache
+from state_cache import state_cache
+from storage_backends import get_storage
+from coalesce import RecentKeys, generation_dedup_key, COALESCED
+from asset_lifecycle import history as asset_history, sweep as sweep_assets, ASSET_SWEEP_INTERVAL
+import metrics
+from metrics import log, timed, new_trace_id
 
 from fastapi.staticfiles import StaticFiles
 
@@ -38,36 +43,166 @@ os.makedirs(static_dir, exist_ok=True)
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
 # LINE Bot Setup
-LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-handler = WebhookHandler(LINE_CHANNEL_SECRET)
+parser = WebhookParser(LINE_CHANNEL_SECRET)
+
+# Webhook events are handled here: concurrently across users, in order per user
+dispatcher = KeyedDispatcher()
+# Webhook event IDs already dispatched, so LINE redeliveries are dropped
+recent_events = RecentKeys()
+# Generation jobs run here, off the webhook path (or in worker processes with JOB_BACKEND=sqlite)
+executor = create_executor()
+# Optional: start generating when the prompt arrives, deliver on "はい".
+# Worker processes can't use a result held in this process, so in-process jobs only.
+speculator = SpeculativeGenerator(generate_thumbnail) if SPECULATIVE_GENERATION and JOB_BACKEND == "inprocess" else None
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "60"))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv("RESERVATION_SWEEP_INTERVAL", "60"))
+# Stripe events still pending this long after receipt are applied by the sweep
+STRIPE_REPLAY_AFTER_SECONDS = float(os.getenv("STRIPE_REPLAY_AFTER_SECONDS", "60"))
+
+def _dict_samples(stats):
+    return [({"key": key}, value) for key, value in (stats or {}).items() if value is not None]
+
+metrics.register_collector("thumbnail_event_dispatcher", "Webhook event dispatcher state",
+                           lambda: _dict_samples(dispatcher.stats()))
+metrics.register_collector("thumbnail_jobs", "Generation job executor state", lambda: _dict_samples(executor.stats()))
+metrics.register_collector("thumbnail_generation_cache", "Generation cache counters",
+                           lambda: _dict_samples(get_cache().stats() if get_cache() else None))
+metrics.register_collector("thumbnail_speculation", "Speculative generation counters",
+                           lambda: _dict_samples(speculator.stats() if speculator else None))
+metrics.register_collector("thumbnail_storage_backends", "Upload counts and p95 latency per storage backend",
+                           lambda: _dict_samples(get_storage().stats()))
+metrics.register_collector("thumbnail_state_cache", "Conversation state cache size",
+                           lambda: _dict_samples(state_cache.stats()))
+
+async def expire_reservations_loop():
+    while True:
+        try:
+            await run_in_threadpool(expire_stale_reservations)
+            if JOB_BACKEND == "sqlite":
+                await run_in_threadpool(fail_abandoned_jobs)
+            await run_in_threadpool(replay_pending_stripe_events,
+                                    datetime.now() - timedelta(seconds=STRIPE_REPLAY_AFTER_SECONDS))
+        except Exception as e:
+            log(f"Reservation sweep error: {e}")
+        await asyncio.sleep(RESERVATION_SWEEP_INTERVAL)
+
+async def asset_sweep_loop():
+    while True:
+        try:
+            await run_in_threadpool(sweep_assets)
+        except Exception as e:
+            log(f"Asset sweep error: {e}")
+        await asyncio.sleep(ASSET_SWEEP_INTERVAL)
+
+@app.on_event("startup")
+async def startup():
+    dispatcher.start()
+    executor.start()
+    state_cache.start()
+    # Purchases acknowledged before the last shutdown but never applied
+    await run_in_threadpool(replay_pending_stripe_events)
+    # Keep a reference so the task isn't garbage collected
+    app.state.reservation_sweep = asyncio.get_running_loop().create_task(expire_reservations_loop())
+    app.state.asset_sweep = asyncio.get_running_loop().create_task(asset_sweep_loop())
 
-# Initialize DB
-init_db()
+@app.on_event("shutdown")
+async def shutdown():
+    # Finish queued events first, they may still submit jobs
+    await run_in_threadpool(dispatcher.shutdown, SHUTDOWN_DRAIN_TIMEOUT)
+    await executor.drain(timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    # Write any pending prompts still held only in memory
+    await run_in_threadpool(state_cache.stop)
+    shutdown_rendition_pool()
+    await run_in_threadpool(line_bot_api.close)
+    if speculator:
+        speculator.shutdown()
 
 @app.post("/callback")
 async def callback(request: Request, x_line_signature: str = Header(None)):
     body = await request.body()
     try:
-        handler.handle(body.decode("utf-8"), x_line_signature)
+        with timed("webhook_parse"):
+            events = parser.parse(body.decode("utf-8"), x_line_signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
+    try:
+        # submit() blocks briefly when the dispatcher is full, so keep it off the event loop
+        await run_in_threadpool(dispatch_events, events)
+    except DispatcherFullError:
+        # Non-2xx makes LINE redeliver the batch later
+        raise HTTPException(status_code=503, detail="Busy")
     return "OK"
 
+def event_key(event):
+    source = event.source
+    return getattr(source, "user_id", None) or getattr(source, "group_id", None) or getattr(source, "room_id", None) or ""
+
+def dispatch_events(events):
+    for event in events:
+        # Older payloads have no webhookEventId; those are never deduplicated
+        event_id = getattr(event, "webhook_event_id", None)
+        if event_id and not recent_events.add(event_id):
+            COALESCED.inc(reason="redelivered_event")
+            log(f"Dropping redelivered event {event_id}")
+            continue
+        # Each event gets its own trace ID, inherited by any job it starts
+        new_trace_id()
+        try:
+            dispatcher.submit(event_key(event), handle_event, event)
+        except DispatcherFullError:
+            # Not handled; let LINE's redelivery of it through
+            if event_id:
+                recent_events.discard(event_id)
+            raise
+
+def handle_event(event):
+    with timed("event_handle"):
+        if isinstance(event, FollowEvent):
+            handle_follow(event)
+        elif isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+            handle_message(event)
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = executor.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats():
+    cache = get_cache()
+    return {
+        "jobs": executor.stats(),
+        "generation_cache": cache.stats() if cache else None,
+        "speculation": speculator.stats() if speculator else None,
+        "state_cache": state_cache.stats(),
+        "storage": get_storage().stats(),
+    }
+
 @app.post("/stripe_webhook")
 async def stripe_webhook(request: Request):
     payload = await request.body()
     sig_header = request.headers.get("stripe-signature")
     
     try:
-        handle_stripe_webhook(payload, sig_header)
+        event_id = await run_in_threadpool(receive_stripe_webhook, payload, sig_header)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
+    # The event is stored, so acknowledge now and apply it off the request path
+    if event_id:
+        try:
+            await run_in_threadpool(dispatcher.submit, "stripe", apply_stripe_event, event_id)
+        except DispatcherFullError:
+            log(f"Dispatcher full, Stripe event {event_id} will be applied by the sweep")
     return "OK"
 
-@handler.add(FollowEvent)
 def handle_follow(event):
     user_id = event.source.user_id
     create_user(user_id)
@@ -76,19 +211,17 @@ def handle_follow(event):
         TextSendMessage(text="登録ありがとうございます！\nYouTubeサムネイル生成Botです。\n\n作りたいサムネイルのイメージを文章で送ってください。\n\n初回は1回無料で生成できます。\nその後は10回980円で追加できます。")
     )
 
-@handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     user_text = event.message.text.strip()
     
-    user = get_user(user_id)
-    if not user:
-        create_user(user_id)
-        user = get_user(user_id)
+    # Served from memory for active users; the credit balance is only a hint here
+    user = state_cache.get_user(user_id)
     
     # 1. Handle Confirmation "はい"
     if user_text == "はい":
-        pending_prompt = get_pending_prompt(user_id)
+        # Not the cached copy: a job in a worker process may have just cleared it
+        pending_prompt = state_cache.get_pending_prompt(user_id)
         if not pending_prompt:
             line_bot_api.reply_message(
                 event.reply_token,
@@ -96,75 +229,127 @@ def handle_message(event):
             )
             return
 
-        # Credit Check
-        print(f"User {user_id} credits before: {user['credits']}")
-        if user["credits"] <= 0:
+        # A repeated "はい" while this prompt is still generating attaches to that job
+        dedup_key = generation_dedup_key(user_id, pending_prompt)
+        if executor.find(dedup_key):
+            reply_already_generating(event, pending_prompt)
+            return
+
+        # Reserve credits up front (one per variation) so concurrent confirmations can't both pass the check
+        base_prompt, count = parse_variations(pending_prompt)
+        log(f"User {user_id} credits before: {user['credits']}")
+        reservation_id = reserve_credit(user_id, count)
+        # The balance changed (or was stale); reload it on the next message
+        state_cache.invalidate(user_id)
+        if not reservation_id:
             payment_link = get_payment_link(user_id)
+            needed = f"（{count}案には{count}枚必要です）" if count > 1 else ""
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text=f"チケットが不足しています{needed}。\nこちらから購入してください（10回分 980円）:\n{payment_link}")
+            )
+            return
+
+        # Claim a speculative generation of this exact prompt, if one was started
+        speculation = speculator.take(user_id, base_prompt) if speculator else None
+
+        try:
+            _, created = executor.submit_once(dedup_key, "generate", run_generation_job, user_id, pending_prompt,
+                                              reservation_id, speculation)
+        except QueueFullError:
+            refund_reservation(reservation_id)
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text=f"チケットが不足しています。\nこちらから購入してください（10回分 980円）:\n{payment_link}")
+                TextSendMessage(text="ただいま混み合っています。しばらくしてからもう一度「はい」と送ってください。")
             )
             return
+        if not created:
+            # Another process queued the same job in the meantime
+            refund_reservation(reservation_id)
+            reply_already_generating(event, pending_prompt)
+            return
 
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text=f"「{pending_prompt}」で画像を生成しています...少々お待ちください（約10-20秒）")
         )
-        
+
+    # 2. Handle Upgrade of the latest draft "高画質"
+    elif user_text == "高画質" and PROGRESSIVE_DELIVERY != "off":
+        draft = claim_draft_upgrade(user_id, DRAFT_UPGRADE_TTL_SECONDS)
+        if not draft:
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="高画質にできる下書きが見つかりません。")
+            )
+            return
+        PROGRESSIVE.inc(event="upgrade_requested")
+        prompt, seed = draft
         try:
-            image_path = generate_thumbnail(pending_prompt)
-            
-            # Upload to Google Cloud Storage
-            image_url = upload_to_gcs(image_path)
-            print(f"Upload result URL: {image_url}")
-            
-            if image_url:
-                decrement_credit(user_id) # Enable credit deduction
-                print(f"Decremented credit for {user_id}")
-                
-                # Check new balance
-                updated_user = get_user(user_id)
-                print(f"User {user_id} credits after: {updated_user['credits']}")
-                
-                clear_pending_prompt(user_id)
-                
-                # Send Image and Text (Use Push Message)
-                line_bot_api.push_message(
-                    user_id,
-                    [
-                        TextSendMessage(text=f"生成完了！\n残りチケット: {updated_user['credits']}枚"),
-                        ImageSendMessage(original_content_url=image_url, preview_image_url=image_url)
-                    ]
-                )
-            else:
-                print("Upload failed, credit not deducted.")
-                line_bot_api.push_message(
-                    user_id,
-                    TextSendMessage(text="画像のアップロードに失敗しました。")
-                )
-            
-        except Exception as e:
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(text=f"エラーが発生しました: {str(e)}")
+            executor.submit("upgrade", run_upgrade_job, user_id, prompt, seed)
+        except QueueFullError:
+            # Put the draft back so the user can ask again
+            save_draft(user_id, prompt, seed)
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="ただいま混み合っています。しばらくしてからもう一度「高画質」と送ってください。")
             )
-            
-    # 2. Handle Cancellation "いいえ"
+            return
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text="高画質版を生成しています...少々お待ちください")
+        )
+
+    # 3. Handle History "履歴"
+    elif user_text == "履歴":
+        images = asset_history(user_id)
+        if not images:
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="表示できる生成履歴がありません。")
+            )
+            return
+        line_bot_api.reply_message(
+            event.reply_token,
+            [TextSendMessage(text=f"最近生成した画像（{len(images)}枚）です。")] + [
+                ImageSendMessage(original_content_url=urls["original"], preview_image_url=urls["preview"])
+                for urls in images
+            ]
+        )
+
+    # 4. Handle Cancellation "いいえ"
     elif user_text == "いいえ":
-        clear_pending_prompt(user_id)
+        state_cache.clear_pending_prompt(user_id)
+        if speculator:
+            speculator.discard(user_id)
         line_bot_api.reply_message(
             event.reply_token,
             TextSendMessage(text="キャンセルしました。")
         )
 
-    # 3. Handle New Prompt
+    # 5. Handle New Prompt
     else:
-        set_pending_prompt(user_id, user_text)
+        state_cache.set_pending_prompt(user_id, user_text)
+        base_prompt, count = parse_variations(user_text)
+        # Only speculate on single images, for users who could actually confirm (replaces any older speculation)
+        if speculator:
+            if count == 1 and user["credits"] > 0:
+                speculator.start(user_id, base_prompt)
+            else:
+                speculator.discard(user_id)
+        tickets = f"\n{count}案を生成します（チケット{count}枚）" if count > 1 else ""
         line_bot_api.reply_message(
             event.reply_token,
-            TextSendMessage(text=f"「{user_text}」\nこの内容で画像を生成しますか？\n(はい/いいえ)")
+            TextSendMessage(text=f"「{user_text}」{tickets}\nこの内容で画像を生成しますか？\n(はい/いいえ)")
         )
 
+def reply_already_generating(event, prompt):
+    COALESCED.inc(reason="confirmation")
+    line_bot_api.reply_message(
+        event.reply_token,
+        TextSendMessage(text=f"「{prompt}」は生成中です。完成したらお送りしますので少々お待ちください。")
+    )
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,181 @@
+import contextvars
+import functools
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Seconds; covers SQLite calls (ms) up to 4K Gemini generations (tens of seconds)
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+_registry = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+# Trace ID of the webhook / job being handled, included in every log line
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+
+def new_trace_id():
+    trace_id = uuid.uuid4().hex[:12]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+
+def log(message):
+    print(f"[{trace_id_var.get()}] {message}")
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    body = ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return "{" + body + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {state[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+def register_collector(name, documentation, collect):
+    """
+    Registers a gauge whose samples are read at scrape time. `collect()` returns
+    a list of (labels_dict, value) pairs.
+    """
+    with _registry_lock:
+        _collectors.append((name, documentation, collect))
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry)
+        collectors = list(_collectors)
+    for metric in metrics:
+        lines.extend(metric.render())
+    for name, documentation, collect in collectors:
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in collect():
+            names = tuple(labels)
+            lines.append(f"{name}{_format_labels(names, tuple(labels[n] for n in names))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram("thumbnail_stage_seconds", "Time spent in each stage of a request", ["stage"])
+DB_SECONDS = Histogram("thumbnail_db_seconds", "Time spent in database operations", ["op"])
+DB_LOCK_ERRORS = Counter("thumbnail_db_lock_errors_total", "SQLite 'database is locked' errors", ["op"])
+GENERATIONS = Counter("thumbnail_generations_total", "Generation jobs by result", ["result"])
+CREDITS = Counter("thumbnail_credits_total", "Credit movements", ["action"])
+
+
+@contextmanager
+def timed(stage):
+    """
+    Records how long the enclosed block takes under thumbnail_stage_seconds{stage=...}.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        log(f"{stage} took {elapsed * 1000:.1f}ms")
+
+
+def instrument_db(func):
+    """
+    Decorator for database.py functions: times each call and counts lock errors.
+    """
+    op = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if "locked" in str(e):
+                DB_LOCK_ERRORS.inc(op=op)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, op=op)
+    return wrapper
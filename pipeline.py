@@ -0,0 +1,285 @@
+import contextvars
+import os
+import random
+import re
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from linebot.models import TextSendMessage, ImageSendMessage
+
+from database import get_user, commit_reservation, refund_reservation, save_draft, claim_draft_upgrade
+from image_gen import generate_thumbnail, generation_cache_key, IMAGE_SIZE, DRAFT_IMAGE_SIZE
+from storage_backends import get_storage
+from generation_cache import get_cache
+from renditions import create_renditions
+from artifact_store import save_artifact
+from asset_lifecycle import record_delivery
+from state_cache import state_cache
+from coalesce import SingleFlight
+from line_client import LineMessenger
+from metrics import log, timed, GENERATIONS, Counter, Histogram
+
+LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+
+# Pooled, retrying LINE client (endpoint overridable with LINE_API_ENDPOINT for benchmarks)
+line_bot_api = LineMessenger(LINE_CHANNEL_ACCESS_TOKEN)
+
+# A push carries at most 5 messages: the status text plus up to 4 images
+MAX_VARIATIONS = 4
+# The lookbehind keeps the whole number in the count ("猫 12案" is 12, not "猫 1" + 2)
+VARIATIONS_PATTERN = re.compile(r"^(.*?\S)\s*(?<!\d)(\d+)案$", re.DOTALL)
+# Variations of one job run here in parallel (Gemini concurrency is capped by GeminiClient)
+VARIATION_WORKERS = int(os.getenv("VARIATION_WORKERS", "8"))
+_variation_pool = ThreadPoolExecutor(max_workers=VARIATION_WORKERS, thread_name_prefix="variation")
+# Progressive delivery: push a fast DRAFT_IMAGE_SIZE draft first, then the full-size
+# final. "off", "manual" (final when the user sends "高画質") or "auto".
+PROGRESSIVE_DELIVERY = os.getenv("PROGRESSIVE_DELIVERY", "off").lower()
+# How long after the draft "高画質" still upgrades it
+DRAFT_UPGRADE_TTL_SECONDS = int(os.getenv("DRAFT_UPGRADE_TTL_SECONDS", "86400"))
+
+_identical_generations = SingleFlight("identical_generation")
+
+DELIVERY_SECONDS = Histogram("thumbnail_delivery_seconds", "Job start to image pushed, by kind", ["kind"])
+PROGRESSIVE = Counter("thumbnail_progressive_total", "Progressive delivery drafts, upgrade requests and finals",
+                      ["event"])
+
+
+def upload_renditions(image_data, local_path=None):
+    """
+    Encodes the LINE original/preview renditions of a generated image and uploads
+    both concurrently through the storage backends (with fallback and hedging).
+    Returns {"original": url, "preview": url, "assets": {...}}, or None if either
+    upload failed (the one that did upload is deleted again). "assets" says where
+    each rendition is stored, for the asset history.
+    """
+    with timed("renditions"):
+        renditions = create_renditions(image_data)
+    keys = ("original", "preview")
+    storage = get_storage()
+    with timed("upload"):
+        stored = storage.upload_objects([renditions[key] for key in keys])
+    if not all(stored):
+        storage.discard(stored)
+        return None
+    urls = {key: obj.url for key, obj in zip(keys, stored)}
+    # Each rendition is a (bytes, content_type) pair
+    urls["assets"] = {key: dict(obj._asdict(), bytes=len(renditions[key][0])) for key, obj in zip(keys, stored)}
+    urls["assets"]["original"]["local_path"] = local_path
+    return urls
+
+
+class RetryableJobError(Exception):
+    pass
+
+
+def parse_variations(text):
+    """
+    Splits a trailing "N案" (N variations, e.g. "猫のサムネ 3案") off a prompt.
+    Returns (prompt, count) with the suffix removed whenever it matches; count is
+    1 without a suffix and clamped to 1..MAX_VARIATIONS.
+    """
+    match = VARIATIONS_PATTERN.match(unicodedata.normalize("NFKC", text))
+    if not match:
+        return text, 1
+    return match.group(1).strip(), max(1, min(int(match.group(2)), MAX_VARIATIONS))
+
+
+def generate_and_upload(prompt, variant=0, speculation=None, image_size=IMAGE_SIZE, seed=None):
+    """
+    One generated, uploaded image for `prompt`: {"original": url, "preview": url},
+    or None if the upload failed. Raises if generation fails.
+    """
+    cache = get_cache()
+    if not cache:
+        return _generate_and_upload(prompt, variant, speculation, image_size, seed, None, None)
+    cache_key = generation_cache_key(prompt, variant, image_size, seed)
+    # With the cache on, identical generations in flight for other jobs share one Gemini call and upload
+    return _identical_generations.do(cache_key, _generate_and_upload, prompt, variant, speculation, image_size, seed,
+                                     cache, cache_key)
+
+
+def _generate_and_upload(prompt, variant, speculation, image_size, seed, cache, cache_key):
+    # A recently uploaded copy of the same generation skips Gemini and GCS entirely
+    urls = cache.get_urls(cache_key) if cache else None
+    if urls:
+        log(f"Generation cache URL hit: {urls['original']}")
+        return urls
+
+    image_data = None
+    if speculation:
+        try:
+            with timed("speculation_wait"):
+                image_data = speculation.result()
+            log("Using speculative generation result")
+        except Exception as e:
+            log(f"Speculative generation failed, generating again: {e}")
+    if image_data is None:
+        image_data = generate_thumbnail(prompt, variant, image_size, seed)
+    with timed("artifact_write"):
+        local_path = save_artifact(image_data)
+
+    # Upload the compressed original and a small preview (GCS unless STORAGE_BACKENDS says otherwise)
+    urls = upload_renditions(image_data, local_path)
+    log(f"Upload result URLs: {urls and {key: urls[key] for key in ('original', 'preview')}}")
+    if urls and cache:
+        cache.put_urls(cache_key, urls)
+    return urls
+
+
+def generate_variations(prompt, count):
+    """
+    Runs `count` generate_and_upload calls in parallel. Returns the URLs of the
+    images that made it (in variant order); raises the first error if none did.
+    """
+    futures = [_variation_pool.submit(contextvars.copy_context().run, generate_and_upload, prompt, variant)
+               for variant in range(count)]
+    results, errors = [], []
+    for future in futures:
+        try:
+            urls = future.result()
+        except Exception as e:
+            log(f"Variation failed: {e}")
+            errors.append(e)
+            continue
+        if urls:
+            results.append(urls)
+    if not results and errors:
+        raise errors[0]
+    return results
+
+
+def _record_delivery(user_id, prompt, images):
+    # The images are delivered and paid for; a history write failure must not fail the job
+    try:
+        record_delivery(user_id, prompt, images)
+    except Exception as e:
+        log(f"Recording delivered assets failed: {e}")
+
+
+def run_generation_job(user_id, prompt, reservation_id, speculation=None, final_attempt=True):
+    """
+    Generates a thumbnail for `prompt`, uploads it and pushes it to the user.
+    A prompt ending in "N案" yields N variations, generated and uploaded in
+    parallel and delivered in one push; `reservation_id` then holds N credits.
+    Credits are committed per delivered image and refunded otherwise.
+    With PROGRESSIVE_DELIVERY a single image is delivered as a fast draft first;
+    the credit covers its full-size final too (see run_upgrade_job).
+    `speculation` is an optional Future of image bytes already being generated
+    for this prompt.
+    With final_attempt=False (a durable job that will be retried) failures
+    raise without refunding or notifying the user.
+    Blocking; meant to be run on the job executor or a worker, off the webhook path.
+    """
+    started = time.time()
+    draft_seed = None
+    try:
+        # Gemini never sees the "N案" suffix, even for "1案" / "0案"
+        base_prompt, count = parse_variations(prompt)
+        if count == 1 and PROGRESSIVE_DELIVERY != "off" and not speculation:
+            # The final reuses the draft's prompt and seed
+            draft_seed = random.randrange(2 ** 31)
+            urls = generate_and_upload(base_prompt, image_size=DRAFT_IMAGE_SIZE, seed=draft_seed)
+            images = [urls] if urls else []
+        elif count == 1:
+            urls = generate_and_upload(base_prompt, speculation=speculation)
+            images = [urls] if urls else []
+        else:
+            with timed("variations"):
+                images = generate_variations(base_prompt, count)
+
+        if images:
+            # Also clears the pending prompt (if unchanged), refunds credits for
+            # variations that failed and returns the new balance
+            credits = commit_reservation(reservation_id, prompt, used=len(images))
+            state_cache.forget_prompt(user_id, prompt)
+            if credits is None:
+                # The reservation expired while we were generating; still deliver the images
+                credits = get_user(user_id)["credits"]
+            log(f"User {user_id} credits after: {credits} ({len(images)}/{count} images)")
+
+            text = f"生成完了！\n残りチケット: {credits}枚"
+            if len(images) < count:
+                text = f"{count}案中{len(images)}案を生成しました（失敗分のチケットは返却済み）\n残りチケット: {credits}枚"
+            elif draft_seed is not None and PROGRESSIVE_DELIVERY == "auto":
+                text = f"下書きができました！高画質版を生成しています...\n残りチケット: {credits}枚"
+            elif draft_seed is not None:
+                text = f"下書きができました！\n高画質版が必要なら「高画質」と送ってください（追加チケット不要）\n残りチケット: {credits}枚"
+            # Send Image and Text (Use Push Message); one push carries all variations
+            with timed("line_push"):
+                line_bot_api.push_message(
+                    user_id,
+                    [TextSendMessage(text=text)] + [
+                        ImageSendMessage(original_content_url=urls["original"], preview_image_url=urls["preview"])
+                        for urls in images
+                    ]
+                )
+            GENERATIONS.inc(len(images), result="success")
+            DELIVERY_SECONDS.observe(time.time() - started, kind="draft" if draft_seed is not None else "standard")
+            _record_delivery(user_id, prompt, images)
+            if draft_seed is not None:
+                PROGRESSIVE.inc(event="draft")
+                save_draft(user_id, base_prompt, draft_seed)
+                if PROGRESSIVE_DELIVERY == "auto" and claim_draft_upgrade(user_id, DRAFT_UPGRADE_TTL_SECONDS):
+                    try:
+                        run_upgrade_job(user_id, base_prompt, draft_seed)
+                    except Exception:
+                        # The draft is delivered and paid for; the user was told about the failed final
+                        pass
+        elif not final_attempt:
+            raise RetryableJobError("Upload failed")
+        else:
+            refund_reservation(reservation_id)
+            GENERATIONS.inc(result="upload_failed")
+            log("Upload failed, credit refunded.")
+            line_bot_api.push_message(
+                user_id,
+                TextSendMessage(text="画像のアップロードに失敗しました。")
+            )
+
+    except Exception as e:
+        if not final_attempt:
+            GENERATIONS.inc(result="retry")
+            raise
+        refund_reservation(reservation_id)
+        GENERATIONS.inc(result="error")
+        line_bot_api.push_message(
+            user_id,
+            TextSendMessage(text=f"エラーが発生しました: {str(e)}")
+        )
+        raise
+
+
+def run_upgrade_job(user_id, prompt, seed, final_attempt=True):
+    """
+    Generates the full-size final of a progressive-delivery draft (same prompt
+    and seed) and pushes it. The draft's credit already covers it.
+    Blocking; meant to be run on the job executor or a worker.
+    """
+    started = time.time()
+    try:
+        urls = generate_and_upload(prompt, image_size=IMAGE_SIZE, seed=seed)
+        if urls:
+            with timed("line_push"):
+                line_bot_api.push_message(
+                    user_id,
+                    [
+                        TextSendMessage(text="高画質版が完成しました！"),
+                        ImageSendMessage(original_content_url=urls["original"], preview_image_url=urls["preview"])
+                    ]
+                )
+            DELIVERY_SECONDS.observe(time.time() - started, kind="final")
+            PROGRESSIVE.inc(event="final")
+            _record_delivery(user_id, prompt, [urls])
+        elif not final_attempt:
+            raise RetryableJobError("Upload failed")
+        else:
+            line_bot_api.push_message(user_id, TextSendMessage(text="高画質版のアップロードに失敗しました。"))
+
+    except Exception as e:
+        if not final_attempt:
+            raise
+        line_bot_api.push_message(
+            user_id,
+            TextSendMessage(text=f"高画質版の生成でエラーが発生しました: {str(e)}")
+        )
+        raise
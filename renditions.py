@@ -0,0 +1,87 @@
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import log
+
+# LINE ImageSendMessage limits: JPEG or PNG, original up to 10 MB, preview up to 1 MB
+ORIGINAL_MAX_BYTES = 10 * 1024 * 1024
+PREVIEW_MAX_BYTES = 1024 * 1024
+ORIGINAL_JPEG_QUALITY = int(os.getenv("ORIGINAL_JPEG_QUALITY", "90"))
+PREVIEW_JPEG_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", "75"))
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "640"))
+# Encoding runs in worker processes so it doesn't hold the GIL of the web process.
+# 0 encodes inline in the calling thread.
+RENDITION_WORKERS = int(os.getenv("RENDITION_WORKERS", "2"))
+
+
+def _encode_jpeg(image, quality, max_bytes):
+    from PIL import Image
+
+    # Step the quality down, then the size, until the output fits max_bytes
+    while True:
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+        if buf.tell() <= max_bytes:
+            return buf.getvalue()
+        if quality > 60:
+            quality -= 10
+        else:
+            image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+
+
+def make_renditions(data):
+    """
+    Builds the LINE renditions of a generated PNG.
+    Returns {"original": (bytes, content_type), "preview": (bytes, content_type)}.
+    """
+    # Imported here so the web process only loads Pillow when RENDITION_WORKERS=0
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+    original = _encode_jpeg(image, ORIGINAL_JPEG_QUALITY, ORIGINAL_MAX_BYTES)
+    preview_image = image.copy()
+    preview_image.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE), Image.LANCZOS)
+    preview = _encode_jpeg(preview_image, PREVIEW_JPEG_QUALITY, PREVIEW_MAX_BYTES)
+    return {
+        "original": (original, "image/jpeg"),
+        "preview": (preview, "image/jpeg"),
+    }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Created lazily from a job thread; forking the threaded web process could
+            # deadlock the child, so workers start from a clean forkserver (spawn where unavailable)
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pool = ProcessPoolExecutor(max_workers=RENDITION_WORKERS, mp_context=multiprocessing.get_context(method))
+    return _pool
+
+
+def create_renditions(data):
+    """
+    Runs make_renditions on the rendition process pool and waits for the result.
+    Blocking; call it from a job thread, not the event loop.
+    """
+    if RENDITION_WORKERS <= 0:
+        return make_renditions(data)
+    renditions = _get_pool().submit(make_renditions, data).result()
+    log(f"Renditions: original {len(renditions['original'][0])} bytes, preview {len(renditions['preview'][0])} bytes")
+    return renditions
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import log
+
+# Start generating as soon as a prompt arrives, before the user confirms with "はい"
+SPECULATIVE_GENERATION = os.getenv("SPECULATIVE_GENERATION", "").lower() in ("1", "true", "yes")
+# Speculative generations allowed to run at once across all users
+SPECULATION_MAX_IN_FLIGHT = int(os.getenv("SPECULATION_MAX_IN_FLIGHT", "2"))
+# Speculative generations started per rolling hour, globally and per user
+SPECULATION_HOURLY_BUDGET = int(os.getenv("SPECULATION_HOURLY_BUDGET", "60"))
+SPECULATION_USER_HOURLY_BUDGET = int(os.getenv("SPECULATION_USER_HOURLY_BUDGET", "5"))
+# Results not claimed within this window are dropped
+SPECULATION_TTL_SECONDS = int(os.getenv("SPECULATION_TTL_SECONDS", "600"))
+
+
+class Speculation:
+    def __init__(self, user_id, prompt, future):
+        self.user_id = user_id
+        self.prompt = prompt
+        self.future = future
+        self.started_at = time.time()
+
+
+class SpeculativeGenerator:
+    """
+    Runs `generate_fn(prompt)` in the background for a user's pending prompt and
+    hands the result over when the user confirms. At most one speculation is
+    held per user; a new prompt or a cancellation discards it.
+    """
+
+    def __init__(self, generate_fn, max_in_flight=SPECULATION_MAX_IN_FLIGHT,
+                 hourly_budget=SPECULATION_HOURLY_BUDGET, user_hourly_budget=SPECULATION_USER_HOURLY_BUDGET,
+                 ttl=SPECULATION_TTL_SECONDS):
+        self.generate_fn = generate_fn
+        self.max_in_flight = max_in_flight
+        self.hourly_budget = hourly_budget
+        self.user_hourly_budget = user_hourly_budget
+        self.ttl = ttl
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="speculate")
+        self._by_user = {}
+        self._started = deque()  # (timestamp, user_id) of recent starts, for the hourly budgets
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.started = 0
+        self.rejected = 0
+        self.hits = 0
+        self.misses = 0
+        self.wasted = 0
+
+    def start(self, user_id, prompt):
+        """
+        Starts a speculative generation for `prompt` unless a budget is exhausted.
+        Returns True if one was started.
+        """
+        self.discard(user_id)
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            while self._started and now - self._started[0][0] > 3600:
+                self._started.popleft()
+            user_count = sum(1 for _, uid in self._started if uid == user_id)
+            if (self._in_flight >= self.max_in_flight or len(self._started) >= self.hourly_budget
+                    or user_count >= self.user_hourly_budget):
+                self.rejected += 1
+                return False
+            self._in_flight += 1
+            self._started.append((now, user_id))
+            self.started += 1
+            future = self._pool.submit(self.generate_fn, prompt)
+            self._by_user[user_id] = Speculation(user_id, prompt, future)
+        # Outside the lock: an already finished future runs _on_done (which takes the lock) right here
+        future.add_done_callback(self._on_done)
+        log(f"Speculative generation started for {user_id}")
+        return True
+
+    def take(self, user_id, prompt):
+        """
+        Claims the speculation for (user_id, prompt). Returns a Future of the
+        image bytes, or None if there is no matching speculation.
+        """
+        with self._lock:
+            speculation = self._by_user.pop(user_id, None)
+            if speculation and speculation.prompt == prompt and time.time() - speculation.started_at <= self.ttl:
+                self.hits += 1
+                return speculation.future
+            self.misses += 1
+            if speculation:
+                self.wasted += 1
+        return None
+
+    def discard(self, user_id):
+        with self._lock:
+            if self._by_user.pop(user_id, None):
+                self.wasted += 1
+
+    def stats(self):
+        with self._lock:
+            claimed = self.hits + self.misses
+            return {
+                "started": self.started,
+                "rejected": self.rejected,
+                "in_flight": self._in_flight,
+                "hits": self.hits,
+                "misses": self.misses,
+                "wasted": self.wasted,
+                "hit_rate": self.hits / claimed if claimed else 0.0,
+            }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _on_done(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _expire(self, now):
+        # Caller holds the lock
+        for user_id, speculation in list(self._by_user.items()):
+            if now - speculation.started_at > self.ttl:
+                del self._by_user[user_id]
+                self.wasted += 1
@@ -0,0 +1,168 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from database import get_or_create_user, get_pending_prompt, set_pending_prompts
+from metrics import log, Counter
+
+# In-process cache of user conversation state (pending prompts) with write-behind to SQLite
+STATE_CACHE_ENABLED = os.getenv("STATE_CACHE_ENABLED", "1").lower() in ("1", "true", "yes")
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "10000"))
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "300"))
+# Dirty pending prompts are written to the users table in one batch this often
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+
+STATE_LOOKUPS = Counter("thumbnail_state_cache_lookups_total", "Conversation state lookups", ["result"])
+STATE_FLUSHED = Counter("thumbnail_state_cache_flushed_total", "Pending prompt writes flushed to SQLite")
+
+
+class StateCache:
+    """
+    Bounded TTL + LRU cache of user records keyed by LINE user ID. Pending
+    prompt changes are applied to the cache immediately and written to the
+    users table in batches by a background thread. Credits in the cached
+    record are only a hint; reserve_credit() stays authoritative.
+    """
+
+    def __init__(self, max_entries=STATE_CACHE_SIZE, ttl=STATE_CACHE_TTL, flush_interval=STATE_FLUSH_INTERVAL,
+                 enabled=STATE_CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._entries = OrderedDict()  # user_id -> (loaded_at, user dict)
+        self._dirty = {}  # user_id -> pending prompt not yet written
+        self._flushing = {}  # user_id -> pending prompt the running flush is writing
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        self._thread = threading.Thread(target=self._flush_loop, name="state-flush", daemon=True)
+        self._thread.start()
+        # Backstop for exits that skip the app's shutdown hook
+        atexit.register(self.flush)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.flush_interval * 2)
+            self._thread = None
+        self.flush()
+
+    def get_user(self, user_id):
+        """
+        Returns the user record (creating the user if needed) with any unflushed
+        pending prompt applied.
+        """
+        if self.enabled:
+            with self._lock:
+                cached = self._entries.get(user_id)
+                if cached and time.time() - cached[0] <= self.ttl:
+                    self._entries.move_to_end(user_id)
+                    STATE_LOOKUPS.inc(result="hit")
+                    return dict(cached[1])
+        STATE_LOOKUPS.inc(result="miss")
+        user = get_or_create_user(user_id)
+        with self._lock:
+            if user_id in self._dirty:
+                user["pending_prompt"] = self._dirty[user_id]
+            if self.enabled:
+                self._store(user_id, user)
+        return dict(user)
+
+    def get_pending_prompt(self, user_id):
+        """
+        The user's pending prompt as it stands in SQLite, unless a newer one is
+        still waiting to be flushed. Jobs in worker processes clear prompts in
+        SQLite only, so a cached copy can be stale; use this before acting on it.
+        """
+        with self._lock:
+            if user_id in self._dirty:
+                return self._dirty[user_id]
+        prompt = get_pending_prompt(user_id)
+        with self._lock:
+            cached = self._entries.get(user_id)
+            if cached and user_id not in self._dirty:
+                cached[1]["pending_prompt"] = prompt
+        return prompt
+
+    def set_pending_prompt(self, user_id, prompt):
+        if not self.enabled:
+            set_pending_prompts([(user_id, prompt)])
+            return
+        with self._lock:
+            self._dirty[user_id] = prompt
+            cached = self._entries.get(user_id)
+            if cached:
+                cached[1]["pending_prompt"] = prompt
+
+    def clear_pending_prompt(self, user_id):
+        self.set_pending_prompt(user_id, None)
+
+    def forget_prompt(self, user_id, prompt):
+        """
+        The database cleared `prompt` (e.g. commit_reservation); drop it from the
+        cache too unless the user has moved on to a newer prompt.
+        """
+        with self._lock:
+            if self._dirty.get(user_id, prompt) != prompt:
+                return
+            if self._flushing.get(user_id) == prompt:
+                # The running flush may write the prompt back after the database
+                # cleared it (or re-queue it if it fails); a cleared entry overrides both
+                self._dirty[user_id] = None
+            else:
+                self._dirty.pop(user_id, None)
+            self._entries.pop(user_id, None)
+
+    def invalidate(self, user_id):
+        """
+        Forces the next lookup to reload from SQLite (e.g. after credits changed).
+        """
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._dirty.items())
+                self._flushing = dict(self._dirty)
+                self._dirty = {}
+            if not batch:
+                return
+            try:
+                set_pending_prompts(batch)
+                STATE_FLUSHED.inc(len(batch))
+            except Exception as e:
+                log(f"State flush failed, will retry: {e}")
+                with self._lock:
+                    for user_id, prompt in batch:
+                        # Newer writes and prompts forgotten during the flush win
+                        self._dirty.setdefault(user_id, prompt)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "dirty": len(self._dirty)}
+
+    def _store(self, user_id, user):
+        # Caller holds the lock
+        self._entries[user_id] = (time.time(), dict(user))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+state_cache = StateCache()
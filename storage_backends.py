@@ -0,0 +1,325 @@
+import mimetypes
+import os
+import threading
+import time
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import log, Counter, Histogram
+
+# Upload backends to use, in fallback order: gcs, drive, tmpfiles
+STORAGE_BACKENDS = os.getenv("STORAGE_BACKENDS", "gcs")
+# Start the next backend in parallel when the current one runs past its p95
+STORAGE_HEDGING = os.getenv("STORAGE_HEDGING", "1").lower() in ("1", "true", "yes")
+# Hedge delay used until a backend has STORAGE_HEDGE_MIN_SAMPLES latencies recorded
+STORAGE_HEDGE_DEFAULT_DELAY = float(os.getenv("STORAGE_HEDGE_DEFAULT_DELAY", "2.0"))
+STORAGE_HEDGE_MIN_SAMPLES = int(os.getenv("STORAGE_HEDGE_MIN_SAMPLES", "20"))
+# Recent successful uploads kept per backend for the p95
+STORAGE_LATENCY_WINDOW = int(os.getenv("STORAGE_LATENCY_WINDOW", "200"))
+STORAGE_UPLOAD_CONCURRENCY = int(os.getenv("STORAGE_UPLOAD_CONCURRENCY", "8"))
+# Uploads at least this large are tracked separately (a 4K original vs a small preview)
+LARGE_UPLOAD_BYTES = 256 * 1024
+
+STORAGE_UPLOAD_SECONDS = Histogram("thumbnail_storage_upload_seconds", "Upload latency by backend", ["backend"])
+STORAGE_UPLOADS = Counter("thumbnail_storage_uploads_total", "Upload attempts by backend and outcome",
+                          ["backend", "result"])
+STORAGE_DISCARDED_COPIES = Counter("thumbnail_storage_discarded_copies_total",
+                                   "Unused uploads deleted again (losing hedges, half-failed renditions), by backend", ["backend"])
+STORAGE_HEDGES = Counter("thumbnail_storage_hedges_total", "Hedged uploads started, by the slow backend", ["backend"])
+
+
+# Where an upload ended up; expires_at is a unix time, or None for URLs that don't expire
+StoredObject = namedtuple("StoredObject", ["backend", "name", "url", "expires_at"])
+
+
+class Backend:
+    """
+    An image host. upload() stores `data` as object `name` and returns a URL
+    LINE can fetch; it raises on failure.
+    """
+    name = None
+    deletable = False
+
+    def upload(self, data, content_type, name):
+        raise NotImplementedError
+
+    def url_ttl(self):
+        """
+        Seconds a freshly returned URL stays valid, or None if it doesn't expire.
+        """
+        return None
+
+    def sign_url(self, name):
+        """
+        (url, expires_at) with a fresh URL for an existing object, or None if
+        the backend can't make one.
+        """
+        return None
+
+    def delete_many(self, names):
+        """
+        Deletes objects; returns the names that are gone. Only called on
+        backends with `deletable` set; the others' objects are kept.
+        """
+        raise NotImplementedError
+
+
+class GCSBackend(Backend):
+    name = "gcs"
+    deletable = True
+
+    def upload(self, data, content_type, name):
+        from gcs_utils import get_uploader
+        return get_uploader().upload_bytes(data, content_type, blob_name=name)
+
+    def url_ttl(self):
+        from gcs_utils import get_uploader, SIGNED_URL_EXPIRATION
+        return SIGNED_URL_EXPIRATION if get_uploader().signed_urls else None
+
+    def sign_url(self, name):
+        from gcs_utils import get_uploader, SIGNED_URL_EXPIRATION
+        return get_uploader().sign_url(name), time.time() + SIGNED_URL_EXPIRATION
+
+    def delete_many(self, names):
+        from gcs_utils import get_uploader
+        return get_uploader().delete_many(names)
+
+
+class DriveBackend(Backend):
+    name = "drive"
+    deletable = True
+
+    def upload(self, data, content_type, name):
+        from drive_utils import upload_bytes_to_drive
+        url = upload_bytes_to_drive(data, content_type, name=name)
+        if not url:
+            raise RuntimeError("Drive upload failed")
+        return url
+
+    def delete_many(self, names):
+        from drive_utils import delete_from_drive
+        return delete_from_drive(list(names))
+
+
+class TmpfilesBackend(Backend):
+    name = "tmpfiles"
+    deletable = True
+    # tmpfiles.org deletes uploads after 60 minutes
+    TTL_SECONDS = 3600
+
+    def upload(self, data, content_type, name):
+        from imgur_utils import upload_bytes_to_imgur
+        # One attempt; falling back to the next backend beats sleeping between retries
+        url = upload_bytes_to_imgur(data, content_type, filename=name, attempts=1)
+        if not url:
+            raise RuntimeError("tmpfiles upload failed")
+        return url
+
+    def url_ttl(self):
+        return self.TTL_SECONDS
+
+    def delete_many(self, names):
+        # Already deleted by tmpfiles.org itself
+        return list(names)
+
+
+BACKENDS = {
+    "gcs": GCSBackend,
+    "drive": DriveBackend,
+    "tmpfiles": TmpfilesBackend,
+}
+
+
+class LatencyTracker:
+    """
+    Rolling window of successful upload latencies plus success / error counts.
+    """
+
+    def __init__(self, window=STORAGE_LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.successes = 0
+        self.errors = 0
+
+    def record(self, seconds, ok):
+        with self._lock:
+            if ok:
+                self.successes += 1
+                self._latencies.append(seconds)
+            else:
+                self.errors += 1
+
+    def percentile(self, pct, min_samples=1):
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+
+class StorageRouter:
+    """
+    Uploads through a list of backends in fallback order. A failed upload moves
+    on to the next backend; with hedging, an upload still running after the
+    backend's p95 also starts the next backend and the first URL back wins.
+    """
+
+    def __init__(self, backends, hedging=STORAGE_HEDGING, concurrency=STORAGE_UPLOAD_CONCURRENCY,
+                 hedge_default_delay=STORAGE_HEDGE_DEFAULT_DELAY, hedge_min_samples=STORAGE_HEDGE_MIN_SAMPLES):
+        self.backends = list(backends)
+        self.hedging = hedging
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._trackers = {}
+        self._lock = threading.Lock()
+        # Attempts and whole uploads get separate pools so upload_many can't starve its own attempts
+        self._attempts = ThreadPoolExecutor(max_workers=concurrency * max(1, len(self.backends)),
+                                            thread_name_prefix="storage")
+        self._uploads = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="storage-upload")
+
+    def upload(self, data, content_type="image/png"):
+        """
+        Returns a URL for `data`, or None if every backend failed.
+        """
+        stored = self.upload_object(data, content_type)
+        return stored.url if stored else None
+
+    def upload_object(self, data, content_type="image/png"):
+        """
+        Like upload(), but returns a StoredObject saying which backend holds the
+        data under what name, or None if every backend failed.
+        """
+        name = f"thumbnail_{uuid.uuid4()}{mimetypes.guess_extension(content_type) or '.png'}"
+        remaining = list(self.backends)
+        in_flight = {}
+
+        def launch():
+            backend = remaining.pop(0)
+            in_flight[self._attempts.submit(self._attempt, backend, data, content_type, name)] = backend
+            return backend
+
+        latest = launch()
+        while in_flight:
+            timeout = self._hedge_delay(latest, len(data)) if self.hedging and remaining else None
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                STORAGE_HEDGES.inc(backend=latest.name)
+                log(f"Upload to {latest.name} past its p95 ({timeout:.2f}s), hedging to {remaining[0].name}")
+                latest = launch()
+                continue
+            for future in done:
+                in_flight.pop(future)
+                stored = future.result()
+                if stored:
+                    # Copies from the other attempts are never used or recorded; delete them once they land
+                    for other in list(in_flight) + [f for f in done if f is not future]:
+                        other.add_done_callback(self._discard_copy)
+                    return stored
+            if remaining and not in_flight:
+                latest = launch()
+        return None
+
+    def upload_many(self, items, content_type="image/png"):
+        """
+        Uploads several images concurrently. Items are byte strings or
+        (bytes, content_type) tuples. Returns URLs in the same order, None for failures.
+        """
+        return [stored.url if stored else None for stored in self.upload_objects(items, content_type)]
+
+    def upload_objects(self, items, content_type="image/png"):
+        """
+        upload_many() returning StoredObjects (None for failures) instead of URLs.
+        """
+        futures = []
+        for item in items:
+            data, item_type = item if isinstance(item, tuple) else (item, content_type)
+            futures.append(self._uploads.submit(self.upload_object, data, item_type))
+        return [future.result() for future in futures]
+
+    def backend(self, name):
+        """
+        The configured backend called `name`, or None.
+        """
+        return next((backend for backend in self.backends if backend.name == name), None)
+
+    def stats(self):
+        with self._lock:
+            trackers = dict(self._trackers)
+        stats = {}
+        for (name, size), tracker in trackers.items():
+            p95 = tracker.percentile(95)
+            stats[f"{name}_{size}_successes"] = tracker.successes
+            stats[f"{name}_{size}_errors"] = tracker.errors
+            stats[f"{name}_{size}_p95"] = round(p95, 4) if p95 is not None else None
+        return stats
+
+    def _tracker(self, backend, size):
+        key = (backend.name, "large" if size >= LARGE_UPLOAD_BYTES else "small")
+        with self._lock:
+            tracker = self._trackers.get(key)
+            if tracker is None:
+                tracker = self._trackers[key] = LatencyTracker()
+            return tracker
+
+    def _hedge_delay(self, backend, size):
+        p95 = self._tracker(backend, size).percentile(95, self.hedge_min_samples)
+        return p95 if p95 is not None else self.hedge_default_delay
+
+    def discard(self, stored):
+        """
+        Deletes uploaded objects that will never be used or recorded (None
+        entries are skipped). Failures are only logged.
+        """
+        for obj in stored:
+            if not obj:
+                continue
+            backend = self.backend(obj.backend)
+            if not (backend and backend.deletable):
+                continue
+            try:
+                deleted = backend.delete_many([obj.name])
+            except Exception as e:
+                log(f"Could not delete unused {obj.backend} copy {obj.name}: {e}")
+                continue
+            if deleted:
+                STORAGE_DISCARDED_COPIES.inc(backend=obj.backend)
+
+    def _discard_copy(self, future):
+        self.discard([future.result()])
+
+    def _attempt(self, backend, data, content_type, name):
+        start = time.perf_counter()
+        try:
+            url = backend.upload(data, content_type, name)
+        except Exception as e:
+            log(f"Upload to {backend.name} failed: {e}")
+            url = None
+        elapsed = time.perf_counter() - start
+        self._tracker(backend, len(data)).record(elapsed, url is not None)
+        STORAGE_UPLOADS.inc(backend=backend.name, result="success" if url else "error")
+        if not url:
+            return None
+        STORAGE_UPLOAD_SECONDS.observe(elapsed, backend=backend.name)
+        ttl = backend.url_ttl()
+        return StoredObject(backend.name, name, url, time.time() + ttl if ttl else None)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    The process-wide StorageRouter for STORAGE_BACKENDS.
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            names = [name.strip() for name in STORAGE_BACKENDS.split(",") if name.strip()]
+            unknown = [name for name in names if name not in BACKENDS]
+            if unknown:
+                raise ValueError(f"Unknown storage backends: {', '.join(unknown)}")
+            _router = StorageRouter([BACKENDS[name]() for name in names])
+            log(f"Storage backends: {', '.join(names)} (hedging {'on' if _router.hedging else 'off'})")
+    return _router
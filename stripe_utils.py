@@ -1,11 +1,27 @@
+import json
 import os
-import stripe
-from database import add_credits, record_transaction
+from database import store_stripe_event, get_stripe_event, pending_stripe_events, apply_credit_purchase, mark_stripe_event
+from state_cache import state_cache
+from metrics import log
 
-stripe.api_key = os.getenv("STRIPE_API_KEY")
+STRIPE_API_KEY = os.getenv("STRIPE_API_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 DOMAIN = "http://localhost:8000" # Update this for production
 
+_stripe = None
+
+def get_stripe():
+    """
+    The stripe module, imported and configured on first use (only Stripe
+    webhooks need it, so LINE cold starts skip the import).
+    """
+    global _stripe
+    if _stripe is None:
+        import stripe
+        stripe.api_key = STRIPE_API_KEY
+        _stripe = stripe
+    return _stripe
+
 def get_payment_link(line_user_id):
     # Use the static Payment Link provided by the user
     # We append client_reference_id so we know who paid
@@ -16,7 +32,13 @@ def get_payment_link(line_user_id):
     payment_link = "https://buy.stripe.com/fZu5kC7kK1vJ3CF7HY8AE00"
     return f"{payment_link}?client_reference_id={line_user_id}"
 
-def handle_stripe_webhook(payload, sig_header):
+def receive_stripe_webhook(payload, sig_header):
+    """
+    Verifies a webhook and stores its event in the inbox. Returns the event id
+    if the event is new and still has to be applied, None for a duplicate.
+    Raises on an invalid payload or signature.
+    """
+    stripe = get_stripe()
     event = None
     try:
         event = stripe.Webhook.construct_event(
@@ -27,12 +49,49 @@ def handle_stripe_webhook(payload, sig_header):
     except stripe.error.SignatureVerificationError as e:
         raise Exception("Invalid signature")
 
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        line_user_id = session.get('client_reference_id')
-        
-        if line_user_id:
-            # Add 10 credits
-            add_credits(line_user_id, 10)
-            record_transaction(session['id'], line_user_id, 980, 10, 'completed')
-            print(f"Credits added for user {line_user_id}")
+    if isinstance(payload, bytes):
+        payload = payload.decode("utf-8")
+    if not store_stripe_event(event['id'], event['type'], payload):
+        log(f"Stripe event {event['id']} already received")
+        return None
+    return event['id']
+
+def apply_stripe_event(event_id):
+    """
+    Applies a stored Stripe event. Safe to call more than once for the same event.
+    """
+    stored = get_stripe_event(event_id)
+    if not stored or stored["status"] != "pending":
+        return
+    event = json.loads(stored["payload"])
+
+    if event['type'] != 'checkout.session.completed':
+        mark_stripe_event(event_id, "ignored")
+        return
+
+    session = event['data']['object']
+    line_user_id = session.get('client_reference_id')
+    if not line_user_id:
+        mark_stripe_event(event_id, "ignored", "no client_reference_id")
+        return
+
+    # Add 10 credits
+    if apply_credit_purchase(event_id, session['id'], line_user_id, 980, 10):
+        # The cached balance is stale now
+        state_cache.invalidate(line_user_id)
+        log(f"Credits added for user {line_user_id}")
+
+def replay_pending_stripe_events(received_before=None):
+    """
+    Applies events that were stored but never applied (e.g. the process stopped
+    in between). Returns how many were attempted.
+    """
+    event_ids = pending_stripe_events(received_before)
+    for event_id in event_ids:
+        try:
+            apply_stripe_event(event_id)
+        except Exception as e:
+            log(f"Stripe event {event_id} failed to apply: {e}")
+    if event_ids:
+        log(f"Replayed {len(event_ids)} pending Stripe events")
+    return len(event_ids)
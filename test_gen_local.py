@@ -7,19 +7,15 @@ if not os.path.exists("output"):
 
 print("Generating test image locally...")
 try:
-    # Override the output path in generate_thumbnail to use our local output folder
-    # Actually generate_thumbnail saves to static/generated by default.
-    # We can just copy it or let it save there and print the path.
+    # generate_thumbnail returns the image bytes; save them to our local output folder
+    # for user visibility.
+    image_data = generate_thumbnail("A cute cat eating a burger")
+    print(f"Success! Generated {len(image_data)} bytes")
     
-    path = generate_thumbnail("A cute cat eating a burger")
-    print(f"Success! Image saved to: {path}")
-    
-    # Copy to output folder for user visibility
-    import shutil
-    filename = os.path.basename(path)
-    dest = os.path.join("output", filename)
-    shutil.copy(path, dest)
-    print(f"Copied to: {dest}")
+    dest = os.path.join("output", "thumb_local_test.png")
+    with open(dest, "wb") as f:
+        f.write(image_data)
+    print(f"Saved to: {dest}")
     
 except Exception as e:
     print(f"Error: {e}")
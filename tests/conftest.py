@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """
+    The database module pointed at a fresh SQLite file for one test.
+    """
+    import database
+
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "bot.db"))
+    yield database
+    database.close_connection()
@@ -0,0 +1,47 @@
+import os
+import time
+
+import pytest
+
+import artifact_store
+
+
+@pytest.fixture
+def artifact_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact_store, "ARTIFACT_DIR", str(tmp_path))
+    return tmp_path
+
+
+def age(path, seconds):
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+
+
+def test_sweep_leaves_files_the_store_did_not_write(artifact_dir):
+    foreign = artifact_dir / "thumb_1764434129.png"
+    foreign.write_bytes(b"x" * 100)
+    age(foreign, 10 * 24 * 3600)
+
+    stored = artifact_store.save_artifact(b"y" * 10, force=True)
+    removed = artifact_store.sweep(max_bytes=0, max_age=1)
+
+    assert removed == [stored]
+    assert foreign.exists()
+
+
+def test_sweep_removes_expired_stored_files(artifact_dir):
+    old = artifact_store.save_artifact(b"a", force=True)
+    age(old, 3600)
+    new = artifact_store.save_artifact(b"b", force=True)
+
+    assert artifact_store.sweep(max_age=60) == [old]
+    assert os.path.exists(new)
+
+
+def test_sweep_trims_oldest_stored_files_to_max_bytes(artifact_dir):
+    paths = []
+    for i in range(3):
+        paths.append(artifact_store.save_artifact(b"z" * 10, force=True))
+        age(paths[-1], 100 - i)
+
+    assert artifact_store.sweep(max_bytes=15, max_age=0) == paths[:2]
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def user_with_credits(db, user_id, credits):
+    db.create_user(user_id)
+    db.add_credits(user_id, credits - db.get_user(user_id)["credits"])
+    return user_id
+
+
+def credits(db, user_id):
+    return db.get_user(user_id)["credits"]
+
+
+def test_concurrent_reserves_never_overdraw(db):
+    user_id = user_with_credits(db, "U1", 5)
+
+    def reserve(_):
+        try:
+            return db.reserve_credit(user_id, 2)
+        finally:
+            db.close_connection()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        reservations = [r for r in pool.map(reserve, range(8)) if r]
+
+    assert len(reservations) == 2
+    assert credits(db, user_id) == 1
+
+
+def test_reserve_fails_without_enough_credits(db):
+    user_id = user_with_credits(db, "U1", 1)
+
+    assert db.reserve_credit(user_id, 2) is None
+    assert credits(db, user_id) == 1
+
+
+def test_commit_with_used_refunds_the_rest(db):
+    user_id = user_with_credits(db, "U1", 5)
+    reservation_id = db.reserve_credit(user_id, 4)
+
+    assert db.commit_reservation(reservation_id, used=1) == 4
+    assert credits(db, user_id) == 4
+
+
+def test_commit_clears_only_the_committed_prompt(db):
+    user_id = user_with_credits(db, "U1", 3)
+    db.set_pending_prompt(user_id, "猫")
+    db.commit_reservation(db.reserve_credit(user_id), prompt="犬")
+    assert db.get_pending_prompt(user_id) == "猫"
+
+    db.commit_reservation(db.reserve_credit(user_id), prompt="猫")
+    assert db.get_pending_prompt(user_id) is None
+
+
+def test_refund_after_commit_is_a_no_op(db):
+    user_id = user_with_credits(db, "U1", 3)
+    reservation_id = db.reserve_credit(user_id)
+    db.commit_reservation(reservation_id)
+
+    assert db.refund_reservation(reservation_id) is False
+    assert db.commit_reservation(reservation_id) is None
+    assert credits(db, user_id) == 2
+
+
+def test_refund_returns_the_credits_once(db):
+    user_id = user_with_credits(db, "U1", 3)
+    reservation_id = db.reserve_credit(user_id, 2)
+
+    assert db.refund_reservation(reservation_id) is True
+    assert db.refund_reservation(reservation_id) is False
+    assert credits(db, user_id) == 3
+
+
+def test_expire_returns_held_credits(db, monkeypatch):
+    user_id = user_with_credits(db, "U1", 3)
+    monkeypatch.setattr(db, "RESERVATION_TTL_SECONDS", -1)
+    stale = db.reserve_credit(user_id, 2)
+    monkeypatch.setattr(db, "RESERVATION_TTL_SECONDS", 900)
+    fresh = db.reserve_credit(user_id)
+
+    assert db.expire_stale_reservations() == 1
+    assert credits(db, user_id) == 2
+    assert db.commit_reservation(stale) is None
+    assert db.commit_reservation(fresh) == 2
@@ -0,0 +1,158 @@
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from coalesce import RecentKeys
+from dispatch import KeyedDispatcher, DispatcherFullError
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = KeyedDispatcher(workers=4, queue_limit=100)
+    dispatcher.start()
+    yield dispatcher
+    dispatcher.shutdown(timeout=5)
+
+
+def test_work_for_one_key_runs_in_order(dispatcher):
+    seen = []
+
+    def handle(i):
+        time.sleep(random.uniform(0, 0.005))
+        seen.append(i)
+
+    for i in range(30):
+        dispatcher.submit("U1", handle, i)
+    dispatcher.shutdown(timeout=5)
+
+    assert seen == list(range(30))
+
+
+def test_different_keys_run_concurrently(dispatcher):
+    # Each handler waits for the other; run one at a time, the barrier times out
+    barrier = threading.Barrier(2, timeout=2)
+    results = []
+
+    def handle(key):
+        barrier.wait()
+        results.append(key)
+
+    dispatcher.submit("U1", handle, "U1")
+    dispatcher.submit("U2", handle, "U2")
+    dispatcher.shutdown(timeout=5)
+
+    assert sorted(results) == ["U1", "U2"]
+
+
+def test_a_handler_error_does_not_stop_the_key(dispatcher):
+    seen = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    dispatcher.submit("U1", fail)
+    dispatcher.submit("U1", seen.append, "next")
+    dispatcher.shutdown(timeout=5)
+
+    assert seen == ["next"]
+
+
+def test_submit_pushes_back_at_the_queue_limit():
+    # Not started, so nothing drains the queue
+    dispatcher = KeyedDispatcher(workers=1, queue_limit=2)
+    dispatcher.submit("U1", print)
+    dispatcher.submit("U2", print)
+
+    with pytest.raises(DispatcherFullError):
+        dispatcher.submit("U3", print, timeout=0.05)
+    assert dispatcher.stats()["rejected"] == 1
+    assert dispatcher.stats()["pending"] == 2
+
+
+def test_submit_waits_for_room():
+    dispatcher = KeyedDispatcher(workers=1, queue_limit=1)
+    release = threading.Event()
+    dispatcher.submit("U1", release.wait)
+    dispatcher.start()
+    threading.Timer(0.05, release.set).start()
+
+    dispatcher.submit("U2", print, timeout=2)
+    dispatcher.shutdown(timeout=5)
+    assert dispatcher.stats()["rejected"] == 0
+
+
+def test_recent_keys_forget_after_the_ttl():
+    keys = RecentKeys(max_size=10, ttl=0.05)
+
+    assert keys.add("e1")
+    assert not keys.add("e1")
+    time.sleep(0.1)
+    assert keys.add("e1")
+
+
+def test_recent_keys_drop_the_oldest_past_max_size():
+    keys = RecentKeys(max_size=2, ttl=60)
+    for key in ("e1", "e2", "e3"):
+        keys.add(key)
+
+    assert len(keys) == 2
+    assert not keys.add("e3")
+    assert keys.add("e1")
+
+
+def webhook_event(event_id, user_id="U1"):
+    return SimpleNamespace(webhook_event_id=event_id, source=SimpleNamespace(user_id=user_id))
+
+
+@pytest.fixture
+def main(monkeypatch):
+    monkeypatch.setenv("LINE_CHANNEL_SECRET", "test")
+    import main
+
+    monkeypatch.setattr(main, "recent_events", RecentKeys())
+    return main
+
+
+@pytest.fixture
+def webhook(main, monkeypatch):
+    handled = []
+    dispatcher = KeyedDispatcher(workers=2, queue_limit=100)
+    monkeypatch.setattr(main, "dispatcher", dispatcher)
+    monkeypatch.setattr(main, "handle_event", handled.append)
+    dispatcher.start()
+    yield dispatcher, handled
+    dispatcher.shutdown(timeout=5)
+
+
+def test_redelivered_webhook_events_are_dropped(main, webhook):
+    dispatcher, handled = webhook
+    first, other = webhook_event("e1"), webhook_event("e2")
+
+    main.dispatch_events([first, other])
+    main.dispatch_events([webhook_event("e1")])
+    dispatcher.shutdown(timeout=5)
+
+    assert handled == [first, other]
+
+
+def test_events_without_an_id_are_never_dropped(main, webhook):
+    dispatcher, handled = webhook
+
+    main.dispatch_events([webhook_event(None), webhook_event(None)])
+    dispatcher.shutdown(timeout=5)
+
+    assert len(handled) == 2
+
+
+def test_rejected_webhook_event_is_accepted_when_redelivered(main, monkeypatch):
+    def full(*args):
+        raise DispatcherFullError("full")
+
+    monkeypatch.setattr(main.dispatcher, "submit", full)
+
+    with pytest.raises(DispatcherFullError):
+        main.dispatch_events([webhook_event("e1")])
+    assert main.recent_events.add("e1")
@@ -0,0 +1,56 @@
+import httplib2
+from googleapiclient.errors import HttpError
+
+import drive_utils
+from storage_backends import DriveBackend
+
+
+class Request:
+    def __init__(self, result=None, error=None):
+        self.result = result
+        self.error = error
+
+    def execute(self):
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class FakeFiles:
+    def __init__(self, files, missing=(), failing=()):
+        self.files = files  # name -> id
+        self.missing = set(missing)
+        self.failing = set(failing)
+        self.deleted = []
+
+    def list(self, q, fields, pageSize, pageToken):
+        return Request({"files": [{"id": file_id, "name": name} for name, file_id in self.files.items()
+                                  if f"name = '{name}'" in q]})
+
+    def delete(self, fileId):
+        if fileId in self.missing or fileId in self.failing:
+            status = 404 if fileId in self.missing else 500
+            return Request(error=HttpError(httplib2.Response({"status": status}), b"{}"))
+        self.deleted.append(fileId)
+        return Request({})
+
+
+class FakeService:
+    def __init__(self, files):
+        self._files = files
+
+    def files(self):
+        return self._files
+
+
+def test_drive_backend_deletes_files_by_name(monkeypatch):
+    files = FakeFiles({"a.png": "1", "b.png": "2", "c.png": "3", "d.png": "4"}, missing={"3"}, failing={"4"})
+    monkeypatch.setattr(drive_utils, "get_service", lambda: FakeService(files))
+    monkeypatch.setattr(drive_utils, "DRIVE_DELETE_QUERY_BATCH", 2)
+
+    gone = DriveBackend().delete_many(["a.png", "b.png", "c.png", "d.png", "never-uploaded.png"])
+
+    assert DriveBackend.deletable
+    assert files.deleted == ["1", "2"]
+    # Already missing counts as gone; a failed delete is retried by the next sweep
+    assert gone == ["a.png", "b.png", "c.png", "never-uploaded.png"]
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from fakes import FakeGCS
+
+import gcs_utils
+
+
+@pytest.fixture
+def uploader(monkeypatch):
+    with FakeGCS(latency=0) as fake:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", fake.url)
+        from google.cloud import storage
+
+        client = storage.Client(project="test")
+        yield gcs_utils.GCSUploader("test-thumbnails", client=client)
+
+
+def upload(uploader, *names):
+    for name in names:
+        uploader.upload_bytes(b"png", "image/png", blob_name=name)
+
+
+def test_delete_many_batches_deletes(uploader, monkeypatch):
+    monkeypatch.setattr(gcs_utils, "GCS_BATCH_SIZE", 2)
+    upload(uploader, "a.png", "b.png", "c.png")
+
+    assert uploader.delete_many(["a.png", "b.png", "c.png"]) == ["a.png", "b.png", "c.png"]
+    assert uploader.delete_many(["a.png"]) == ["a.png"]
+
+
+def test_delete_many_counts_missing_blobs_as_gone(uploader):
+    upload(uploader, "a.png", "b.png")
+
+    assert uploader.delete_many(["a.png", "missing.png", "b.png"]) == ["a.png", "missing.png", "b.png"]
+    # Really deleted, not just reported
+    assert not uploader.bucket.blob("a.png").exists()
+    assert not uploader.bucket.blob("b.png").exists()
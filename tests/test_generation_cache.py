@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from generation_cache import GenerationCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return GenerationCache(str(tmp_path), url_max_age=3000, url_min_ttl=600)
+
+
+def urls(*expires_at):
+    assets = {f"r{i}": {"url": f"https://example.com/{i}", "expires_at": expiry} for i, expiry in enumerate(expires_at)}
+    return {"original": "https://example.com/0", "preview": "https://example.com/1", "assets": assets}
+
+
+def test_urls_valid_past_the_margin_are_reused(cache):
+    cache.put_urls("k", urls(time.time() + 3600, time.time() + 3600))
+
+    assert cache.get_urls("k")["original"] == "https://example.com/0"
+
+
+def test_urls_close_to_expiry_are_not_reused(cache):
+    # Signed with a TTL shorter than url_max_age: the earliest expiry decides
+    cache.put_urls("k", urls(time.time() + 3600, time.time() + 300))
+
+    assert cache.get_urls("k") is None
+
+
+def test_urls_that_never_expire_fall_back_to_max_age(cache):
+    cache.put_urls("k", urls(None, None))
+    assert cache.get_urls("k") is not None
+
+    cache.url_max_age = -1
+    assert cache.get_urls("k") is None
+
+
+def test_entries_without_assets_use_max_age(cache):
+    cache.put_urls("k", {"original": "o", "preview": "p"})
+
+    assert cache.get_urls("k") == {"original": "o", "preview": "p"}
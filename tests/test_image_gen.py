@@ -0,0 +1,28 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import image_gen
+
+
+def test_concurrent_first_calls_share_one_client(monkeypatch):
+    created = []
+
+    class SlowClient:
+        def __init__(self, api_key=None):
+            time.sleep(0.05)
+            created.append(self)
+
+    monkeypatch.setattr(image_gen, "GeminiClient", SlowClient)
+    monkeypatch.setattr(image_gen, "_client", None)
+    start = threading.Barrier(8)
+
+    def first_call(_):
+        start.wait()
+        return image_gen.get_client()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        clients = set(pool.map(first_call, range(8)))
+
+    assert len(created) == 1
+    assert clients == {created[0]}
@@ -0,0 +1,86 @@
+import pytest
+
+import pipeline
+import worker
+from job_executor import SQLiteJobQueue
+
+
+class FakeMessenger:
+    def __init__(self):
+        self.pushes = []
+
+    def push_message(self, to, messages, retry_key=None):
+        self.pushes.append((to, messages))
+
+
+def fail(*args, **kwargs):
+    raise RuntimeError("Gemini is down")
+
+
+def test_duplicate_dedup_key_submit_is_merged(db):
+    queue = SQLiteJobQueue()
+
+    first, created = queue.submit_once("generate:k", "generate", None, "U1", "猫", "r1")
+    assert created
+    second, created = queue.submit_once("generate:k", "generate", None, "U1", "猫", "r2")
+    assert not created
+    assert second.id == first.id
+    assert db.count_jobs() == 1
+    assert queue.find("generate:k").id == first.id
+
+    job = db.claim_job("w1")
+    db.complete_job(job["id"], "w1")
+    assert queue.find("generate:k") is None
+    third, created = queue.submit_once("generate:k", "generate", None, "U1", "猫", "r3")
+    assert created and third.id != first.id
+
+
+def test_expired_lease_is_claimed_again(db):
+    job_id = db.enqueue_job("generate", {"args": []})
+
+    first = db.claim_job("w1", lease_seconds=-1)
+    assert first["id"] == job_id and first["attempts"] == 1
+    second = db.claim_job("w2")
+    assert second["id"] == job_id and second["attempts"] == 2
+    assert db.claim_job("w3") is None
+
+
+def test_live_lease_is_not_claimed_again(db):
+    db.enqueue_job("generate", {"args": []})
+
+    assert db.claim_job("w1") is not None
+    assert db.claim_job("w2") is None
+
+
+def test_stale_owner_cannot_complete_or_renew(db):
+    job_id = db.enqueue_job("generate", {"args": []})
+    db.claim_job("w1", lease_seconds=-1)
+    db.claim_job("w2")
+
+    assert db.complete_job(job_id, "w1") is False
+    assert db.heartbeat_job(job_id, "w1") is False
+    assert db.fail_job(job_id, "w1", "late") is None
+    assert db.complete_job(job_id, "w2") is True
+    assert db.get_job(job_id)["status"] == "succeeded"
+
+
+def test_failed_job_is_refunded_only_on_its_last_attempt(db, monkeypatch):
+    messenger = FakeMessenger()
+    monkeypatch.setattr(pipeline, "line_bot_api", messenger)
+    monkeypatch.setattr(pipeline, "generate_and_upload", fail)
+    monkeypatch.setattr(worker, "JOB_RETRY_DELAY", 0)
+    db.create_user("U1")
+    reservation_id = db.reserve_credit("U1")
+    job_id = db.enqueue_job("generate", {"args": ["U1", "猫", reservation_id]}, max_attempts=2)
+    runner = worker.Worker(threads=1)
+
+    runner._run(db.claim_job(runner.id))
+    assert db.get_job(job_id)["status"] == "queued"
+    assert db.get_user("U1")["credits"] == 0
+    assert messenger.pushes == []
+
+    runner._run(db.claim_job(runner.id))
+    assert db.get_job(job_id)["status"] == "failed"
+    assert db.get_user("U1")["credits"] == 1
+    assert len(messenger.pushes) == 1
+    assert db.refund_reservation(reservation_id) is False
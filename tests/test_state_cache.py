@@ -0,0 +1,78 @@
+import pytest
+
+import state_cache as state_cache_module
+from state_cache import StateCache
+
+
+@pytest.fixture
+def cache(db):
+    db.create_user("U1")
+    return StateCache(enabled=True)
+
+
+def flush_during(cache, monkeypatch, action, fail=False):
+    """
+    Runs cache.flush() and calls `action` while its batch is being written.
+    """
+    real_write = state_cache_module.set_pending_prompts
+
+    def write(updates):
+        action()
+        if fail:
+            raise RuntimeError("database is locked")
+        real_write(updates)
+
+    monkeypatch.setattr(state_cache_module, "set_pending_prompts", write)
+    cache.flush()
+    monkeypatch.setattr(state_cache_module, "set_pending_prompts", real_write)
+
+
+def test_prompt_forgotten_during_a_failed_flush_is_not_requeued(db, cache, monkeypatch):
+    cache.set_pending_prompt("U1", "猫")
+
+    flush_during(cache, monkeypatch, lambda: cache.forget_prompt("U1", "猫"), fail=True)
+    cache.flush()
+
+    assert cache.get_pending_prompt("U1") is None
+    assert db.get_pending_prompt("U1") is None
+
+
+def test_prompt_forgotten_during_a_flush_is_cleared_again(db, cache, monkeypatch):
+    cache.set_pending_prompt("U1", "猫")
+
+    def commit():
+        # commit_reservation clears the prompt in SQLite before the flush writes it
+        db.set_pending_prompt("U1", None)
+        cache.forget_prompt("U1", "猫")
+
+    flush_during(cache, monkeypatch, commit)
+    assert cache.get_pending_prompt("U1") is None
+    cache.flush()
+
+    assert db.get_pending_prompt("U1") is None
+
+
+def test_newer_prompt_set_during_a_failed_flush_wins(db, cache, monkeypatch):
+    cache.set_pending_prompt("U1", "猫")
+
+    flush_during(cache, monkeypatch, lambda: cache.set_pending_prompt("U1", "犬"), fail=True)
+    cache.flush()
+
+    assert db.get_pending_prompt("U1") == "犬"
+
+
+def test_failed_flush_is_retried(db, cache, monkeypatch):
+    cache.set_pending_prompt("U1", "猫")
+
+    flush_during(cache, monkeypatch, lambda: None, fail=True)
+    assert db.get_pending_prompt("U1") is None
+    cache.flush()
+
+    assert db.get_pending_prompt("U1") == "猫"
+
+
+def test_forget_without_a_flush_drops_the_dirty_prompt(db, cache):
+    cache.set_pending_prompt("U1", "猫")
+    cache.forget_prompt("U1", "猫")
+
+    assert cache.stats()["dirty"] == 0
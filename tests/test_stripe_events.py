@@ -0,0 +1,84 @@
+import hashlib
+import hmac
+import json
+import time
+
+import pytest
+
+import stripe_utils
+
+SECRET = "whsec_test"
+
+
+@pytest.fixture
+def user(db, monkeypatch):
+    monkeypatch.setattr(stripe_utils, "STRIPE_WEBHOOK_SECRET", SECRET)
+    db.create_user("U1")
+    return "U1"
+
+
+def checkout_event(event_id, user_id, session_id="cs_1"):
+    return json.dumps({
+        "id": event_id,
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": session_id, "object": "checkout.session", "client_reference_id": user_id}},
+    })
+
+
+def signature(payload):
+    timestamp = int(time.time())
+    digest = hmac.new(SECRET.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def credits(db, user_id):
+    return db.get_user(user_id)["credits"]
+
+
+def test_redelivered_event_is_stored_once(db, user):
+    payload = checkout_event("evt_1", user)
+
+    assert stripe_utils.receive_stripe_webhook(payload, signature(payload)) == "evt_1"
+    assert stripe_utils.receive_stripe_webhook(payload, signature(payload)) is None
+
+
+def test_same_event_applied_twice_grants_credits_once(db, user):
+    payload = checkout_event("evt_1", user)
+    stripe_utils.receive_stripe_webhook(payload, signature(payload))
+
+    stripe_utils.apply_stripe_event("evt_1")
+    stripe_utils.apply_stripe_event("evt_1")
+
+    assert credits(db, user) == 11
+    assert db.get_stripe_event("evt_1")["status"] == "applied"
+
+
+def test_apply_credit_purchase_is_idempotent_per_event_and_transaction(db, user):
+    db.store_stripe_event("evt_1", "checkout.session.completed", "{}")
+    db.store_stripe_event("evt_2", "checkout.session.completed", "{}")
+
+    assert db.apply_credit_purchase("evt_1", "cs_1", user, 980, 10) is True
+    assert db.apply_credit_purchase("evt_1", "cs_1", user, 980, 10) is False
+    # A different event for the same checkout session doesn't grant again either
+    assert db.apply_credit_purchase("evt_2", "cs_1", user, 980, 10) is False
+    assert credits(db, user) == 11
+
+
+def test_replay_skips_applied_events(db, user):
+    payload = checkout_event("evt_1", user)
+    stripe_utils.receive_stripe_webhook(payload, signature(payload))
+    stripe_utils.apply_stripe_event("evt_1")
+
+    assert stripe_utils.replay_pending_stripe_events() == 0
+    assert credits(db, user) == 11
+
+
+def test_replay_applies_stored_events_once(db, user):
+    payload = checkout_event("evt_1", user)
+    stripe_utils.receive_stripe_webhook(payload, signature(payload))
+
+    assert stripe_utils.replay_pending_stripe_events() == 1
+    assert stripe_utils.replay_pending_stripe_events() == 0
+    stripe_utils.apply_stripe_event("evt_1")
+    assert credits(db, user) == 11
@@ -0,0 +1,50 @@
+import threading
+
+import pipeline
+from storage_backends import Backend, StorageRouter
+
+
+class MemoryBackend(Backend):
+    name = "memory"
+    deletable = True
+
+    def __init__(self, fail_sizes=()):
+        self.fail_sizes = set(fail_sizes)
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def upload(self, data, content_type, name):
+        if len(data) in self.fail_sizes:
+            raise RuntimeError("upload failed")
+        with self._lock:
+            self.objects[name] = data
+        return f"https://example.com/{name}"
+
+    def delete_many(self, names):
+        with self._lock:
+            return [name for name in names if self.objects.pop(name, None) is not None]
+
+
+def renditions(data):
+    return {"original": (b"o" * 10, "image/jpeg"), "preview": (b"p", "image/jpeg")}
+
+
+def test_half_failed_renditions_are_deleted_again(monkeypatch):
+    backend = MemoryBackend(fail_sizes={1})
+    monkeypatch.setattr(pipeline, "get_storage", lambda: StorageRouter([backend], hedging=False))
+    monkeypatch.setattr(pipeline, "create_renditions", renditions)
+
+    assert pipeline.upload_renditions(b"png") is None
+    assert backend.objects == {}
+
+
+def test_uploaded_renditions_are_kept(monkeypatch):
+    backend = MemoryBackend()
+    monkeypatch.setattr(pipeline, "get_storage", lambda: StorageRouter([backend], hedging=False))
+    monkeypatch.setattr(pipeline, "create_renditions", renditions)
+
+    urls = pipeline.upload_renditions(b"png")
+
+    assert urls["assets"]["original"]["bytes"] == 10
+    assert urls["assets"]["preview"]["bytes"] == 1
+    assert len(backend.objects) == 2
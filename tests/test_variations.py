@@ -0,0 +1,47 @@
+import pytest
+
+import pipeline
+from pipeline import parse_variations, MAX_VARIATIONS
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("猫のサムネ", ("猫のサムネ", 1)),
+    ("猫のサムネ 3案", ("猫のサムネ", 3)),
+    ("猫のサムネ３案", ("猫のサムネ", 3)),
+    ("猫のサムネ 2 案", ("猫のサムネ 2 案", 1)),
+    ("猫のサムネ 12案", ("猫のサムネ", MAX_VARIATIONS)),
+    ("猫のサムネ 10案", ("猫のサムネ", MAX_VARIATIONS)),
+    ("ベスト10案", ("ベスト", MAX_VARIATIONS)),
+    ("iPhone15 2案", ("iPhone15", 2)),
+    ("猫のサムネ 0案", ("猫のサムネ", 1)),
+    ("猫のサムネ 1案", ("猫のサムネ", 1)),
+    ("猫のサムネ1案", ("猫のサムネ", 1)),
+    ("猫のサムネ 00案", ("猫のサムネ", 1)),
+    ("猫のサムネ 4案", ("猫のサムネ", MAX_VARIATIONS)),
+    ("猫のサムネ 5案", ("猫のサムネ", MAX_VARIATIONS)),
+    ("10案", ("10案", 1)),
+])
+def test_parse_variations(text, expected):
+    assert parse_variations(text) == expected
+
+
+@pytest.mark.parametrize("text", ["猫のサムネ 1案", "猫のサムネ 0案"])
+def test_single_image_prompt_is_generated_without_the_suffix(text, db, monkeypatch):
+    prompts = []
+
+    def generate_and_upload(prompt, **kwargs):
+        prompts.append(prompt)
+        return None
+
+    class Messenger:
+        def push_message(self, to, messages, retry_key=None):
+            pass
+
+    monkeypatch.setattr(pipeline, "generate_and_upload", generate_and_upload)
+    monkeypatch.setattr(pipeline, "line_bot_api", Messenger())
+    monkeypatch.setattr(pipeline, "PROGRESSIVE_DELIVERY", "off")
+    db.create_user("U1")
+
+    pipeline.run_generation_job("U1", text, db.reserve_credit("U1"))
+
+    assert prompts == ["猫のサムネ"]
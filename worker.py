@@ -0,0 +1,155 @@
+"""
+Generation worker for JOB_BACKEND=sqlite.
+
+Claims jobs from the durable jobs table, runs them and records the outcome.
+A claimed job holds a lease that a heartbeat thread keeps renewing; if the
+worker dies the lease runs out and another worker retries the job.
+
+Usage: python -m worker [--processes 2] [--threads 4]
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+# Load .env before importing modules that read configuration at import time
+load_dotenv()
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database import get_connection, close_connection, claim_job, heartbeat_job, complete_job, fail_job, JOB_LEASE_SECONDS
+from pipeline import run_generation_job, run_upgrade_job
+from renditions import shutdown_pool as shutdown_rendition_pool
+from metrics import log, trace_id_var
+
+# Jobs each worker process runs at the same time
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "2"))
+# Idle poll interval when the queue is empty
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "0.5"))
+# Delay before a failed attempt is retried, multiplied by the attempt number
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))
+
+JOB_HANDLERS = {
+    "generate": run_generation_job,
+    "upgrade": run_upgrade_job,
+}
+
+
+class Worker:
+    def __init__(self, threads=WORKER_THREADS, lease_seconds=JOB_LEASE_SECONDS):
+        self.id = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.threads = threads
+        self.lease_seconds = lease_seconds
+        self._active = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def run(self):
+        log(f"Worker {self.id} started (threads={self.threads})")
+        heartbeat = threading.Thread(target=self._heartbeat, name="heartbeat", daemon=True)
+        heartbeat.start()
+        runners = [threading.Thread(target=self._loop, name=f"worker-{i}") for i in range(self.threads)]
+        for thread in runners:
+            thread.start()
+        for thread in runners:
+            thread.join()
+        log(f"Worker {self.id} stopped")
+
+    def stop(self):
+        # Running jobs finish; nothing new is claimed
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                job = claim_job(self.id, self.lease_seconds)
+            except Exception as e:
+                log(f"Claim failed: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(WORKER_POLL_INTERVAL)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        trace_id_var.set(job["payload"].get("trace_id") or job["id"][:12])
+        handler = JOB_HANDLERS.get(job["name"])
+        final_attempt = job["attempts"] >= job["max_attempts"]
+        with self._lock:
+            self._active.add(job["id"])
+        start = time.time()
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown job {job['name']}")
+            handler(*job["payload"]["args"], final_attempt=final_attempt)
+        except Exception as e:
+            status = fail_job(job["id"], self.id, e, retry_delay=JOB_RETRY_DELAY * job["attempts"])
+            log(f"Job {job['id']} ({job['name']}) attempt {job['attempts']}/{job['max_attempts']} failed, {status}: {e}")
+        else:
+            complete_job(job["id"], self.id)
+            log(f"Job {job['id']} ({job['name']}) succeeded in {time.time() - start:.1f}s")
+        finally:
+            with self._lock:
+                self._active.discard(job["id"])
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._lock:
+                active = list(self._active)
+            for job_id in active:
+                try:
+                    if not heartbeat_job(job_id, self.id, self.lease_seconds):
+                        log(f"Lost the lease on job {job_id}")
+                except Exception as e:
+                    log(f"Heartbeat failed for {job_id}: {e}")
+
+
+def run_worker(threads):
+    worker = Worker(threads)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop())
+    try:
+        worker.run()
+    finally:
+        shutdown_rendition_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES)
+    parser.add_argument("--threads", type=int, default=WORKER_THREADS)
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker(args.threads)
+        return
+
+    # Create the schema once up front, then let each process open its own connection
+    get_connection()
+    close_connection()
+    processes = [multiprocessing.Process(target=run_worker, args=(args.threads,), name=f"worker-{i}")
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()